@@ -0,0 +1,244 @@
+"""
+Benchmarks the REST API hot paths through the create_app factory against a
+seeded database, using the Flask test client so that no network is
+involved. Reports p50/p99 latency, throughput and SQL queries per request
+for each scenario.
+
+    python -m benchmarks.api_bench [--database-uri URI] [--save FILE] [--check FILE]
+
+Without --database-uri a temporary SQLite database is used. A Postgres URI
+must point at an empty scratch database: the tables are created, seeded and
+dropped again afterwards. --save writes the results as a baseline and
+--check compares against one, exiting with status 1 if any scenario's p50
+latency is more than --tolerance slower or it runs more queries than the
+baseline did. Baselines are only comparable on the same machine and with
+the same seed options.
+
+Stats misses publish to a local stand-in broker that discards messages.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from sqlalchemy import event, select
+
+from sensorhub import create_app, db
+from sensorhub.generator import generate
+from sensorhub.models import ApiKey, Measurement, Sensor, Stats
+from sensorhub.utils import RabbitPublisher, encode_cursor
+
+ADMIN_KEY = "benchmark-admin-key"
+SENSOR_KEY = "benchmark-sensor-key"
+SPAN = datetime.timedelta(days=30)
+
+
+class NullChannel:
+
+    is_closed = False
+
+    def confirm_delivery(self):
+        pass
+
+    def queue_declare(self, queue, **kwargs):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, **kwargs):
+        pass
+
+
+class NullConnection:
+
+    is_closed = False
+
+    def channel(self):
+        return NullChannel()
+
+    def close(self):
+        pass
+
+
+def seed(sensors, measurements):
+    """
+    Fills the database with *sensors* sensors of *measurements* each, plus
+    one sensor without stats, and the keys used by the scenarios.
+    """
+
+    generate(
+        "bench", sensors, sensors, max(sensors // 4, 1), measurements, SPAN,
+        seed=1, echo=lambda message: None
+    )
+    generate("bench-cold", 1, 0, 0, measurements, SPAN, seed=2, echo=lambda message: None)
+    db.session.execute(db.delete(Stats).where(
+        Stats.sensor_id == select(Sensor.id).filter_by(name="bench-cold-1").scalar_subquery()
+    ))
+    sensor = db.session.scalars(select(Sensor).filter_by(name="bench-1")).one()
+    db.session.add(ApiKey(key=ApiKey.key_hash(ADMIN_KEY), admin=True))
+    db.session.add(ApiKey(key=ApiKey.key_hash(SENSOR_KEY), sensor=sensor))
+    db.session.commit()
+
+def deep_cursor(measurements):
+    # the cursor of a page two pages from the end of bench-1's history
+    row = db.session.execute(
+        select(Measurement.time, Measurement.id).join(Sensor).where(
+            Sensor.name == "bench-1"
+        ).order_by(
+            Measurement.time, Measurement.id
+        ).offset(max(measurements - 100, 0)).limit(1)
+    ).one()
+    return encode_cursor(row.time, row.id)
+
+def scenarios(measurements):
+    base = "/api/sensors/bench-1/"
+    batch = [{"value": float(i)} for i in range(100)]
+    return {
+        "sensor_collection": ("GET", "/api/sensors/", ADMIN_KEY, None),
+        "sensor_item": ("GET", base, None, None),
+        "measurements_shallow": ("GET", base + "measurements/", None, None),
+        "measurements_deep": (
+            "GET", base + "measurements/?after=" + deep_cursor(measurements), None, None
+        ),
+        "measurements_aggregate": (
+            "GET", base + "measurements/?agg=mean,max&bucket=1h", None, None
+        ),
+        "stats_hit": ("GET", base + "stats/", None, None),
+        "stats_miss": ("GET", "/api/sensors/bench-cold-1/stats/", None, None),
+        "measurements_ingest": ("POST", base + "measurements/", SENSOR_KEY, batch),
+    }
+
+def run_scenario(client, queries, request, iterations, warmup):
+    method, url, key, body = request
+    headers = {"Sensorhub-Api-Key": key} if key else {}
+    expected = 201 if method == "POST" else None
+    timings = []
+    query_total = 0
+    for i in range(warmup + iterations):
+        queries[0] = 0
+        start = time.perf_counter()
+        response = client.open(url, method=method, headers=headers, json=body)
+        # streamed responses do their work while the body is read
+        response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400 or (expected and response.status_code != expected):
+            raise RuntimeError(f"{method} {url} returned {response.status_code}")
+        if i >= warmup:
+            timings.append(elapsed)
+            query_total += queries[0]
+    timings.sort()
+    return {
+        "p50": timings[len(timings) // 2],
+        "p99": timings[int(len(timings) * 0.99)],
+        "rps": len(timings) / sum(timings),
+        "queries": query_total / len(timings),
+    }
+
+def run(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        uri = args.database_uri or "sqlite:///" + os.path.join(workdir, "bench.db")
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": uri,
+            "CACHE_TYPE": args.cache,
+            "CACHE_SHARED_PATH": os.path.join(workdir, "cache.db"),
+            "ARCHIVE_DIR": os.path.join(workdir, "archive"),
+            "STATS_TASK_BACKEND": "rabbitmq",
+        })
+        with app.app_context():
+            db.create_all()
+            try:
+                seed(args.sensors, args.measurements)
+                requests = scenarios(args.measurements)
+                app.extensions["rabbit_publisher"] = RabbitPublisher(NullConnection)
+
+                queries = [0]
+                @event.listens_for(db.engine, "before_cursor_execute")
+                def count_query(*event_args):
+                    queries[0] += 1
+
+                client = app.test_client()
+                results = {}
+                for name, request in requests.items():
+                    if args.only and name not in args.only:
+                        continue
+                    results[name] = run_scenario(
+                        client, queries, request, args.iterations, args.warmup
+                    )
+                    print_result(name, results[name])
+            finally:
+                db.session.remove()
+                if args.database_uri:
+                    db.drop_all()
+    return results
+
+def print_result(name, result, baseline=None):
+    line = (
+        f"{name:<26}{result['p50'] * 1e3:>9.2f}{result['p99'] * 1e3:>9.2f}"
+        f"{result['rps']:>10.0f}{result['queries']:>9.1f}"
+    )
+    if baseline is not None:
+        line += f"{(result['p50'] / baseline['p50'] - 1) * 100:>+9.1f}%"
+    print(line)
+
+def check(results, baseline, tolerance):
+    """
+    Returns the names of the scenarios that regressed against *baseline*.
+    """
+
+    print(f"\n{'compared to baseline':<26}{'p50 ms':>9}{'p99 ms':>9}{'req/s':>10}"
+          f"{'queries':>9}{'p50':>10}")
+    failed = []
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        print_result(name, result, base)
+        if result["p50"] > base["p50"] * (1 + tolerance) or result["queries"] > base["queries"]:
+            failed.append(name)
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--database-uri", default=None)
+    parser.add_argument("--cache", default="NullCache", help="CACHE_TYPE for the app")
+    parser.add_argument("--sensors", type=int, default=20)
+    parser.add_argument("--measurements", type=int, default=20000, help="per sensor")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--only", nargs="*", help="scenarios to run")
+    parser.add_argument("--save", metavar="FILE", help="write results as a baseline")
+    parser.add_argument("--check", metavar="FILE", help="compare against a baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed p50 slowdown, as a fraction")
+    args = parser.parse_args()
+
+    print(f"{'scenario':<26}{'p50 ms':>9}{'p99 ms':>9}{'req/s':>10}{'queries':>9}")
+    results = run(args)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "meta": {
+                    "database": (args.database_uri or "sqlite").split(":")[0],
+                    "cache": args.cache,
+                    "sensors": args.sensors,
+                    "measurements": args.measurements,
+                    "python": platform.python_version(),
+                    "machine": platform.node(),
+                },
+                "results": results,
+            }, f, indent=2)
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        failed = check(results, baseline, args.tolerance)
+        if failed:
+            print("\nRegressed: " + ", ".join(failed))
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
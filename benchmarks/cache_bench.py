@@ -0,0 +1,75 @@
+"""
+Compares cache hit latency across the cache backends available to the app.
+Each backend gets the same page-sized (etag, bytes) entry and is read back
+repeatedly, as MeasurementCollection.get does on a hit.
+
+    python -m benchmarks.cache_bench [--iterations N] [--size BYTES]
+
+RedisCache is included when CACHE_REDIS_URL is set in the environment and
+the redis package is installed.
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from cachelib import FileSystemCache, SimpleCache
+from sensorhub.caching import LRUCache, SharedMemoryCache
+
+
+def make_backends(workdir):
+    backends = {
+        "SimpleCache": SimpleCache(threshold=100000),
+        "FileSystemCache": FileSystemCache(os.path.join(workdir, "fs"), threshold=100000),
+        "LRUCache": LRUCache(threshold=100000),
+        "SharedMemoryCache": SharedMemoryCache(
+            os.path.join(workdir, "shared.db"), threshold=100000
+        ),
+    }
+    if os.environ.get("CACHE_REDIS_URL"):
+        try:
+            from cachelib import RedisCache
+            import redis
+        except ImportError:
+            print("redis package not installed, skipping RedisCache")
+        else:
+            backends["RedisCache"] = RedisCache(
+                redis.Redis.from_url(os.environ["CACHE_REDIS_URL"]), key_prefix="bench:"
+            )
+    return backends
+
+def bench(backend, iterations, size):
+    entry = ("0" * 32, os.urandom(size))
+    backend.set("page", entry, timeout=0)
+    timings = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        value = backend.get("page")
+        timings.append(time.perf_counter() - start)
+        assert value == entry
+    timings.sort()
+    return {
+        "p50": timings[len(timings) // 2],
+        "p99": timings[int(len(timings) * 0.99)],
+        "mean": statistics.fmean(timings),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=4096, help="entry size in bytes")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"{'backend':<20}{'p50 us':>10}{'p99 us':>10}{'hits/s':>12}")
+        for name, backend in make_backends(workdir).items():
+            result = bench(backend, args.iterations, args.size)
+            print(
+                f"{name:<20}{result['p50'] * 1e6:>10.1f}{result['p99'] * 1e6:>10.1f}"
+                f"{1 / result['mean']:>12.0f}"
+            )
+
+if __name__ == "__main__":
+    main()
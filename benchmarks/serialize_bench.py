@@ -0,0 +1,131 @@
+"""
+Measures how many rows per second the API can turn into JSON, comparing the
+old path of hydrating ORM objects, formatting each timestamp and encoding
+with json.dumps against column tuples encoded with sensorhub.serialization.
+The column path is timed with the standard library encoder and, when it is
+installed, with orjson.
+
+    python -m benchmarks.serialize_bench [--sensors N] [--measurements N] [--rounds N]
+
+Each round selects and encodes every measurement of one sensor, as a page
+of MeasurementCollection does, and every sensor with its location and
+stats. Reported numbers are the best of the rounds and include the query.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import tempfile
+import time
+
+from sqlalchemy import select
+
+from sensorhub import create_app, db
+from sensorhub.generator import generate
+from sensorhub.models import Measurement, Sensor, Stats
+from sensorhub.serialization import orjson, stdlib_dumps
+
+SPAN = datetime.timedelta(days=30)
+
+
+def orm_measurements(sensor_id, dumps):
+    rows = db.session.scalars(select(Measurement).where(Measurement.sensor_id == sensor_id))
+    return len(json.dumps([
+        {"value": meas.value, "time": meas.time.isoformat()} for meas in rows
+    ]))
+
+def column_measurements(sensor_id, dumps):
+    rows = db.session.execute(
+        select(Measurement.id, Measurement.time, Measurement.value).where(
+            Measurement.sensor_id == sensor_id
+        )
+    )
+    return len(dumps([{"value": value, "time": time} for id, time, value in rows]))
+
+def orm_sensors(sensor_id, dumps):
+    sensors = db.session.scalars(select(Sensor))
+    # location and stats are lazy loaded per sensor
+    return len(json.dumps([
+        dict(sensor.serialize(), stats=sensor.stats and sensor.stats.serialize())
+        for sensor in sensors
+    ], default=datetime.datetime.isoformat))
+
+def column_sensors(sensor_id, dumps):
+    columns = Sensor.row_columns()
+    rows = db.session.execute(
+        select(*columns, *Stats.row_columns()).outerjoin(
+            Sensor.location
+        ).outerjoin(
+            Stats, Stats.sensor_id == Sensor.id
+        )
+    )
+    return len(dumps([
+        dict(
+            Sensor.serialize_row(row[:len(columns)]),
+            stats=None if row[len(columns)] is None else Stats.serialize_row(
+                row[len(columns):]
+            )
+        )
+        for row in rows
+    ]))
+
+def bench(func, sensor_id, dumps, rows, rounds):
+    best = None
+    for i in range(rounds):
+        # a fresh session so that the ORM path hydrates every time
+        db.session.remove()
+        start = time.perf_counter()
+        func(sensor_id, dumps)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return rows / best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sensors", type=int, default=200)
+    parser.add_argument("--measurements", type=int, default=50000, help="for one sensor")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(workdir, "bench.db"),
+            "CACHE_TYPE": "NullCache",
+            "ARCHIVE_DIR": os.path.join(workdir, "archive"),
+        })
+        with app.app_context():
+            db.create_all()
+            echo = lambda message: None
+            generate("bench", 1, 1, 1, args.measurements, SPAN, seed=1, echo=echo)
+            generate("bench-fleet", args.sensors - 1, args.sensors - 1, 0, 1, SPAN,
+                     seed=2, echo=echo)
+            sensor_id = db.session.scalars(
+                select(Sensor.id).filter_by(name="bench-1")
+            ).one()
+            sensor_count = db.session.scalar(select(db.func.count(Sensor.id)))
+
+            encoders = {"stdlib": stdlib_dumps}
+            if orjson is not None:
+                encoders["orjson"] = orjson.dumps
+            else:
+                print("orjson not installed, timing the standard library encoder only")
+
+            cases = [
+                ("measurements", args.measurements, orm_measurements, column_measurements),
+                ("sensors", sensor_count, orm_sensors, column_sensors),
+            ]
+            print(f"{'case':<14}{'path':<18}{'rows/s':>12}{'speedup':>9}")
+            for name, rows, orm_func, column_func in cases:
+                baseline = bench(orm_func, sensor_id, None, rows, args.rounds)
+                print(f"{name:<14}{'orm+json.dumps':<18}{baseline:>12.0f}{1:>8.2f}x")
+                for encoder, dumps in encoders.items():
+                    rate = bench(column_func, sensor_id, dumps, rows, args.rounds)
+                    print(
+                        f"{name:<14}{'columns+' + encoder:<18}{rate:>12.0f}"
+                        f"{rate / baseline:>8.2f}x"
+                    )
+            db.session.remove()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+# Picked up by gunicorn from the working directory.
+
+# live measurement streams hold a thread each for as long as they're open,
+# keep LIVE_MAX_STREAMS below this so that other requests are still served
+threads = 8
+
+def worker_exit(server, worker):
+    # write out measurements still held by the ingest buffer
+    from sensorhub.buffer import flush_all
+    flush_all()
@@ -15,10 +15,34 @@ def create_app(test_config=None):
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
-        CACHE_TYPE="FileSystemCache",
+        CACHE_TYPE="sensorhub.caching.SharedMemoryCache",
+        CACHE_THRESHOLD=100000,
         CACHE_DIR=os.path.join(app.instance_path, "cache"),
+        PAGE_CACHE_TIMEOUT=0,
+        PAGE_CACHE_TAIL_TIMEOUT=300,
         RABBITMQ_BROKER_ADDR="amqp://localhost/",
-        RABBIT_USE_TLS=False,
+        RABBITMQ_HOST="localhost",
+        RABBITMQ_PORT=5672,
+        RABBITMQ_VHOST="/",
+        RABBITMQ_USE_TLS=False,
+        RABBITMQ_CONFIRM=True,
+        STATS_TASK_BACKEND="rabbitmq",
+        STATS_TASK_DATA=True,
+        MEASUREMENT_PARTITIONING=False,
+        PARTITION_MONTHS_AHEAD=3,
+        MEASUREMENT_RETENTION_MONTHS=None,
+        ARCHIVE_DIR=os.path.join(app.instance_path, "archive"),
+        ARCHIVE_AFTER_DAYS=30,
+        INSTRUMENTATION=False,
+        INGEST_BUFFER=False,
+        INGEST_BUFFER_DIR=os.path.join(app.instance_path, "ingest-buffer"),
+        INGEST_BUFFER_SIZE=5000,
+        INGEST_BUFFER_AGE=1.0,
+        INGEST_BUFFER_MAX_ATTEMPTS=3,
+        LIVE_SOCKET_DIR=os.path.join(app.instance_path, "live"),
+        # below the threads of a worker in gunicorn.conf.py, so that streams
+        # can't take every thread
+        LIVE_MAX_STREAMS=6,
     )
 
     if test_config is None:
@@ -33,11 +57,26 @@ def create_app(test_config=None):
 
     from . import models
     from . import api
+    from . import migrations
+    from . import partitions
+    from . import archive
+    from . import consumer
     from sensorhub.utils import SensorConverter
     app.cli.add_command(models.init_db_command)
     app.cli.add_command(models.generate_test_data)
     app.cli.add_command(models.generate_master_key)
+    app.cli.add_command(models.revoke_key_command)
+    app.cli.add_command(models.rebuild_rollups_command)
+    app.cli.add_command(models.stats_worker_command)
+    app.cli.add_command(migrations.migrate_command)
+    app.cli.add_command(partitions.partitions_command)
+    app.cli.add_command(archive.archive_command)
+    app.cli.add_command(consumer.ingest_consumer_command)
     app.url_map.converters["sensor"] = SensorConverter
     app.register_blueprint(api.api_bp)
 
+    if app.config["INSTRUMENTATION"]:
+        from . import instrumentation
+        instrumentation.init_app(app)
+
     return app
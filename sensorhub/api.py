@@ -1,21 +1,37 @@
 import json
 from flask import Blueprint, Response
 from flask_restful import Api
+from werkzeug.exceptions import NotFound
 
 from sensorhub.resources.sensor import SensorCollection, SensorItem
 from sensorhub.resources.location import LocationItem
-from sensorhub.resources.measurement import MeasurementCollection
+from sensorhub.resources.measurement import (
+    MeasurementCollection, MeasurementExport, MeasurementLive
+)
 from sensorhub.resources.stats import SensorStats
+from sensorhub.resources.batch import BatchRead
+from sensorhub.instrumentation import render_metrics
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
 
 api.add_resource(SensorCollection, "/sensors/")
-api.add_resource(SensorItem, "/sensors/<sensor:sensor>/")
+api.add_resource(SensorItem, "/sensors/<sensor(load='location'):sensor>/")
 api.add_resource(LocationItem, "/locations/<location>/")
 api.add_resource(MeasurementCollection, "/sensors/<sensor:sensor>/measurements/")
-api.add_resource(SensorStats, "/sensors/<sensor:sensor>/stats/")
+api.add_resource(MeasurementExport, "/sensors/<sensor:sensor>/measurements/export")
+api.add_resource(MeasurementLive, "/sensors/<sensor:sensor>/measurements/live")
+api.add_resource(SensorStats, "/sensors/<sensor(load='stats'):sensor>/stats/")
+api.add_resource(BatchRead, "/batch/")
 
 @api_bp.route("/")
 def entry():
     return Response(json.dumps({"api_version": "1.0", "api_name": "sensorhub"}), 200)
+
+@api_bp.route("/metrics")
+def metrics():
+    # only exists with INSTRUMENTATION enabled
+    response = render_metrics()
+    if response is None:
+        raise NotFound
+    return response
@@ -0,0 +1,386 @@
+"""
+Archive tier for cold measurements. flask archive moves measurements older
+than ARCHIVE_AFTER_DAYS out of the measurement table into one columnar file
+per sensor and UTC day under ARCHIVE_DIR, and records each file as an
+ArchiveSegment. Reads of raw measurements, aggregates, exports and stats
+combine the archive with the rows still in the database, so archiving is
+not visible through the API.
+
+    flask archive [--days N]
+
+A segment file is a small JSON header followed by three columns, each
+aligned to 64 bytes so that it can be memory-mapped directly:
+
+- time: microsecond deltas from the previous row, the first one from the
+  time_base in the header, as the narrowest integer type that fits
+- id: deltas of the measurement ids, encoded the same way
+- value: float32 when every value survives the round trip, else float64
+
+Rows are sorted by (time, id). Measurements that arrive later for an
+archived day stay in the database until the next run, which rewrites the
+day's file with them included.
+"""
+
+import datetime
+import json
+import os
+import secrets
+import struct
+import time
+from collections import namedtuple
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, select
+from sensorhub import db
+from sensorhub.constants import *
+from sensorhub.models import EPOCH, ArchiveSegment, Measurement, epoch, utcnow
+
+MAGIC = b"SHARCHV1"
+ALIGN = 64
+DELTA_TYPES = ("<i2", "<i4", "<i8")
+
+ArchivedMeasurement = namedtuple("ArchivedMeasurement", ["id", "time", "value"])
+ArchivedBucket = namedtuple("ArchivedBucket", ["bucket", "count", "total", "minimum", "maximum"])
+
+
+def _delta_encode(column):
+    # ids can go backwards when late measurements were sent in time order
+    deltas = np.diff(column, prepend=column[0])
+    for dtype in DELTA_TYPES:
+        limits = np.iinfo(dtype)
+        if limits.min <= deltas.min() and deltas.max() <= limits.max:
+            return deltas.astype(dtype)
+
+def _value_column(values):
+    narrow = values.astype("<f4")
+    if np.array_equal(narrow.astype(np.float64), values):
+        return narrow
+    return values.astype("<f8")
+
+def encode_segment(times, ids, values):
+    """
+    Encodes one segment's columns into the archive file format. *times* is
+    a datetime64[us] array and the rows must be sorted by (time, id).
+    """
+
+    times = times.astype("datetime64[us]").astype(np.int64)
+    columns = {
+        "time": _delta_encode(times),
+        "id": _delta_encode(ids.astype(np.int64)),
+        "value": _value_column(values.astype(np.float64)),
+    }
+    header = {
+        "count": len(times),
+        "time_base": int(times[0]),
+        "id_base": int(ids[0]),
+        "columns": {},
+    }
+    # offsets depend on the header length, which depends on the offsets
+    header_size = ALIGN
+    while True:
+        offset = header_size
+        for name, column in columns.items():
+            header["columns"][name] = [column.dtype.str, offset]
+            offset += -(-column.nbytes // ALIGN) * ALIGN
+        encoded = json.dumps(header).encode()
+        if len(MAGIC) + 4 + len(encoded) <= header_size:
+            break
+        header_size += ALIGN
+
+    chunks = [MAGIC, struct.pack("<I", len(encoded)), encoded]
+    position = len(MAGIC) + 4 + len(encoded)
+    for name, column in columns.items():
+        offset = header["columns"][name][1]
+        chunks.append(b"\0" * (offset - position))
+        chunks.append(column.tobytes())
+        position = offset + column.nbytes
+    return b"".join(chunks)
+
+def read_segment(path):
+    """
+    Reads the segment file at *path*, relative to ARCHIVE_DIR. Returns the
+    times as a datetime64[us] array, the ids, and the values as a
+    memory-mapped array.
+    """
+
+    path = os.path.join(current_app.config["ARCHIVE_DIR"], path)
+    with open(path, "rb") as f:
+        prefix = f.read(len(MAGIC) + 4)
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not an archive segment")
+        header = json.loads(f.read(struct.unpack("<I", prefix[len(MAGIC):])[0]))
+
+    count = header["count"]
+    columns = {
+        name: np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+        for name, (dtype, offset) in header["columns"].items()
+    }
+    times = np.cumsum(columns["time"], dtype=np.int64) + header["time_base"]
+    ids = np.cumsum(columns["id"], dtype=np.int64) + header["id_base"]
+    return times.astype("datetime64[us]"), ids, columns["value"]
+
+def write_segment(sensor_id, day, times, ids, values):
+    """
+    Writes a new segment file and returns its path relative to ARCHIVE_DIR.
+    Every write gets a new name so that readers of the previous version of
+    the day are not disturbed.
+    """
+
+    relative = os.path.join(
+        str(sensor_id), f"{day:%Y-%m-%d}-{secrets.token_hex(4)}.col"
+    )
+    path = os.path.join(current_app.config["ARCHIVE_DIR"], relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        f.write(encode_segment(times, ids, values))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+    return relative
+
+
+def segments(sensor_id, start=None, end=None, descending=False):
+    query = select(ArchiveSegment).where(ArchiveSegment.sensor_id == sensor_id)
+    if start is not None:
+        query = query.where(ArchiveSegment.last >= start)
+    if end is not None:
+        query = query.where(ArchiveSegment.first < end)
+    order = ArchiveSegment.day.desc() if descending else ArchiveSegment.day
+    return db.session.scalars(query.order_by(order)).all()
+
+def read_range(sensor_id, start=None, end=None, descending=False):
+    """
+    Yields the (times, ids, values) columns of each archived day of the
+    sensor within [start, end), in time order or in reverse.
+    """
+
+    for segment in segments(sensor_id, start, end, descending):
+        times, ids, values = read_segment(segment.path)
+        lo = 0 if start is None else np.searchsorted(times, np.datetime64(start, "us"))
+        hi = len(times) if end is None else np.searchsorted(times, np.datetime64(end, "us"))
+        if lo >= hi:
+            continue
+        columns = (times[lo:hi], ids[lo:hi], values[lo:hi])
+        if descending:
+            columns = tuple(column[::-1] for column in columns)
+        yield columns
+
+def read_rows(sensor_id, start, end, after, before, limit):
+    """
+    Returns up to *limit* archived measurements within [start, end) that
+    come after the *after* or before the *before* (time, id) key, ordered
+    like a page of keyset pagination: descending when paging backwards.
+    """
+
+    descending = before is not None
+    if after is not None:
+        start = after[0] if start is None else max(start, after[0])
+    if before is not None:
+        # the cursor row itself is excluded by the key check below
+        cursor_end = before[0] + datetime.timedelta(microseconds=1)
+        end = cursor_end if end is None else min(end, cursor_end)
+
+    rows = []
+    for times, ids, values in read_range(sensor_id, start, end, descending):
+        if after is not None or before is not None:
+            cursor_time, cursor_id = after or before
+            cursor_time = np.datetime64(cursor_time, "us")
+            if after is not None:
+                keep = (times > cursor_time) | ((times == cursor_time) & (ids > cursor_id))
+            else:
+                keep = (times < cursor_time) | ((times == cursor_time) & (ids < cursor_id))
+            times, ids, values = times[keep], ids[keep], values[keep]
+        needed = limit - len(rows)
+        rows.extend(
+            ArchivedMeasurement(*row) for row in zip(
+                ids[:needed].tolist(), times[:needed].tolist(), values[:needed].tolist()
+            )
+        )
+        if len(rows) >= limit:
+            break
+    return rows
+
+def read_buckets(sensor_id, seconds, start, end, descending, limit):
+    """
+    Aggregates the archived measurements within [start, end) into *seconds*
+    long buckets and returns up to *limit* of them, in time order or in
+    reverse, as ArchivedBuckets keyed by the bucket's start in epoch seconds.
+    """
+
+    buckets = {}
+    for times, ids, values in read_range(sensor_id, start, end, descending):
+        if descending:
+            times, values = times[::-1], values[::-1]
+        starts = times.astype("datetime64[s]").astype(np.int64) // seconds * seconds
+        keys, first = np.unique(starts, return_index=True)
+        values = np.asarray(values, dtype=np.float64)
+        counts = np.diff(np.append(first, len(values)))
+        totals = np.add.reduceat(values, first)
+        minimums = np.minimum.reduceat(values, first)
+        maximums = np.maximum.reduceat(values, first)
+        order = range(len(keys) - 1, -1, -1) if descending else range(len(keys))
+        for i in order:
+            key = int(keys[i])
+            bucket = ArchivedBucket(
+                key, int(counts[i]), float(totals[i]),
+                float(minimums[i]), float(maximums[i])
+            )
+            if key in buckets:
+                bucket = combine_buckets(buckets[key], bucket)
+            buckets[key] = bucket
+        # a bucket can continue into the next day, so only stop once there
+        # are more than enough complete ones
+        if len(buckets) > limit:
+            break
+    return list(buckets.values())[:limit]
+
+def combine_buckets(a, b):
+    return ArchivedBucket(
+        a.bucket, a.count + b.count, a.total + b.total,
+        min(a.minimum, b.minimum), max(a.maximum, b.maximum)
+    )
+
+def iter_rows(sensor_id):
+    """
+    Yields every archived (time, id, value) of the sensor in time order.
+    """
+
+    for times, ids, values in read_range(sensor_id):
+        for start in range(0, len(times), EXPORT_CHUNK_SIZE):
+            chunk = slice(start, start + EXPORT_CHUNK_SIZE)
+            yield from zip(
+                times[chunk].tolist(), ids[chunk].tolist(), values[chunk].tolist()
+            )
+
+
+def archive_day(sensor_id, day):
+    """
+    Moves the sensor's measurements from the UTC day starting at *day* into
+    its archive segment, merging them with an existing one. The measurement
+    rows are deleted in the same transaction that records the segment.
+    """
+
+    rows = db.session.execute(
+        select(
+            Measurement.time, Measurement.id, Measurement.value
+        ).where(
+            Measurement.sensor_id == sensor_id,
+            Measurement.time >= day,
+            Measurement.time < day + datetime.timedelta(days=1)
+        )
+    ).all()
+    if not rows:
+        return 0
+    times = np.array([row.time for row in rows], dtype="datetime64[us]")
+    ids = np.fromiter((row.id for row in rows), dtype=np.int64, count=len(rows))
+    values = np.fromiter((row.value for row in rows), dtype=np.float64, count=len(rows))
+
+    segment = db.session.scalars(
+        select(ArchiveSegment).where(
+            ArchiveSegment.sensor_id == sensor_id,
+            ArchiveSegment.day == day
+        ).with_for_update()
+    ).first()
+    old_path = None
+    if segment is None:
+        segment = ArchiveSegment(sensor_id=sensor_id, day=day)
+        db.session.add(segment)
+    else:
+        old_path = segment.path
+        old_times, old_ids, old_values = read_segment(old_path)
+        times = np.concatenate([old_times, times])
+        ids = np.concatenate([old_ids, ids])
+        values = np.concatenate([old_values, values])
+    order = np.lexsort((ids, times))
+    times, ids, values = times[order], ids[order], values[order]
+
+    mean = values.mean()
+    segment.path = write_segment(sensor_id, day, times, ids, values)
+    segment.first = times[0].item()
+    segment.last = times[-1].item()
+    segment.count = len(values)
+    segment.mean = float(mean)
+    segment.m2 = float(np.square(values - mean).sum())
+    segment.minimum = float(values.min())
+    segment.maximum = float(values.max())
+
+    # delete exactly the rows that were read, rows that arrived meanwhile
+    # are left for the next run
+    archived = [row.id for row in rows]
+    for start in range(0, len(archived), EXPORT_CHUNK_SIZE):
+        db.session.execute(
+            delete(Measurement).where(
+                Measurement.id.in_(archived[start:start + EXPORT_CHUNK_SIZE])
+            )
+        )
+    db.session.commit()
+
+    if old_path is not None:
+        try:
+            os.remove(os.path.join(current_app.config["ARCHIVE_DIR"], old_path))
+        except FileNotFoundError:
+            pass
+    return len(rows)
+
+def archive_measurements(cutoff, echo=print):
+    """
+    Archives every sensor's measurements from before *cutoff*, which must be
+    the start of a UTC day, one sensor day at a time.
+    """
+
+    width = db.literal(86400, literal_execute=True)
+    day = (epoch(Measurement.time) // width).label("day")
+    pairs = db.session.execute(
+        select(
+            Measurement.sensor_id, day
+        ).where(
+            Measurement.sensor_id.is_not(None),
+            Measurement.time < cutoff
+        ).group_by(
+            Measurement.sensor_id, day
+        ).order_by(
+            Measurement.sensor_id, day
+        )
+    ).all()
+    db.session.commit()
+
+    total = 0
+    for sensor_id, days in pairs:
+        start = EPOCH + datetime.timedelta(days=days)
+        count = archive_day(sensor_id, start)
+        echo(f"Archived {count} measurements of sensor {sensor_id} on {start:%Y-%m-%d}")
+        total += count
+    return total
+
+def sweep(min_age=3600):
+    """
+    Removes segment files that no segment refers to anymore, e.g. those of
+    deleted sensors or left behind by an interrupted run. Recent files are
+    kept since another run may be about to record them.
+    """
+
+    root = current_app.config["ARCHIVE_DIR"]
+    known = set(db.session.scalars(select(ArchiveSegment.path)))
+    removed = 0
+    for directory, subdirs, files in os.walk(root):
+        for name in files:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root)
+            if relative not in known and os.path.getmtime(path) < time.time() - min_age:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+@click.command("archive")
+@click.option("--days", type=int, default=None, help="Archive measurements older than this.")
+@with_appcontext
+def archive_command(days):
+    if days is None:
+        days = current_app.config["ARCHIVE_AFTER_DAYS"]
+    today = utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    total = archive_measurements(today - datetime.timedelta(days=days), echo=click.echo)
+    removed = sweep()
+    click.echo(f"Archived {total} measurements, removed {removed} stale files")
@@ -0,0 +1,382 @@
+"""
+Write-behind ingest buffer, enabled with INGEST_BUFFER. Instead of one
+transaction per request, each worker process collects the measurements it
+receives and writes them in one transaction (group commit) once
+INGEST_BUFFER_SIZE rows are pending or the oldest has waited
+INGEST_BUFFER_AGE seconds. Buffered measurements become visible through
+the API when they are flushed.
+
+A request is acknowledged once its measurements are in the worker's
+journal, an append-only file in INGEST_BUFFER_DIR that is fsynced before
+the response is sent. Concurrent requests share one fsync. A journal is
+deleted once its contents have been committed. Every journal is held with
+an exclusive flock by the buffer that owns it until then, so a journal
+that can be locked was left behind by a worker that died, and is claimed
+and replayed by the next buffer to start.
+
+A failed flush is retried with the next one. Batches that keep failing on
+their own are set aside after INGEST_BUFFER_MAX_ATTEMPTS flushes, into a
+rejected-*.ndjson file in INGEST_BUFFER_DIR in the journal format, so that
+they don't hold back the batches behind them.
+
+The buffer is flushed when the worker exits, through atexit and the
+worker_exit hook in gunicorn.conf.py.
+"""
+
+import atexit
+import datetime
+import fcntl
+import glob
+import json
+import os
+import secrets
+import threading
+import time
+import weakref
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sensorhub import db
+from sensorhub.ingest import ingest_rows, write_rows
+from sensorhub.models import Sensor
+
+_buffers = weakref.WeakSet()
+
+
+def get_buffer():
+    """
+    Returns this worker's IngestBuffer, creating it on first use.
+    """
+
+    buffer = current_app.extensions.get("ingest_buffer")
+    if buffer is None or buffer.pid != os.getpid():
+        # threads and open journals don't survive a fork
+        buffer = current_app.extensions["ingest_buffer"] = IngestBuffer(
+            current_app._get_current_object(),
+            current_app.config["INGEST_BUFFER_DIR"],
+            current_app.config["INGEST_BUFFER_SIZE"],
+            current_app.config["INGEST_BUFFER_AGE"],
+            current_app.config["INGEST_BUFFER_MAX_ATTEMPTS"],
+        )
+    return buffer
+
+def flush_all():
+    for buffer in list(_buffers):
+        if buffer.pid == os.getpid():
+            buffer.close()
+
+atexit.register(flush_all)
+
+
+def _fsync_directory(directory):
+    # makes a file created or renamed in *directory* survive a power failure
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _encode(sensor_id, rows):
+    return json.dumps({
+        "sensor": sensor_id,
+        "rows": [[row["value"], row["time"].isoformat()] for row in rows],
+    }) + "\n"
+
+def _decode(line):
+    batch = json.loads(line)
+    return batch["sensor"], [
+        {
+            "sensor_id": batch["sensor"],
+            "value": value,
+            "time": datetime.datetime.fromisoformat(time),
+        }
+        for value, time in batch["rows"]
+    ]
+
+
+class IngestBuffer:
+    """
+    One worker's buffer. append() journals a batch and returns once it is
+    durable; a background thread flushes the pending batches to the
+    database when either threshold is reached.
+
+    Pending batches are (sensor id, rows, failed flushes) tuples. Journals
+    are kept as (path, open file) pairs, the file holding the flock.
+    """
+
+    def __init__(self, app, directory, max_rows, max_age, max_attempts=3):
+        self.app = app
+        self.directory = directory
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.max_attempts = max_attempts
+        self.pid = os.getpid()
+        # _lock guards the pending batches and the journal, _sync_lock is
+        # held by whoever is running fsync, _flush_lock by the flusher
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = []
+        self._count = 0
+        self._oldest = None
+        self._journal = None
+        self._written = 0
+        self._synced = 0
+        # journals whose batches are all pending
+        self._retired = []
+        self._closed = False
+        self._wakeup = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        self._replay()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        _buffers.add(self)
+
+    def append(self, sensor_id, rows):
+        """
+        Journals *rows* (dicts as made by measurement_rows) for one sensor
+        and returns once they are on disk.
+        """
+
+        line = _encode(sensor_id, rows)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Ingest buffer is closed")
+            if self._journal is None:
+                self._journal = self._open_journal()
+            self._journal[1].write(line)
+            self._written += 1
+            sequence = self._written
+            self._pending.append((sensor_id, rows, 0))
+            self._count += len(rows)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = self._count >= self.max_rows
+        self._sync(sequence)
+        if full:
+            self._wakeup.set()
+        return len(rows)
+
+    def _open_journal(self):
+        # locked under a temporary name and only then renamed into place, so
+        # that no other buffer can take it for an orphan in between
+        name = f"journal-{self.pid}-{secrets.token_hex(4)}.ndjson"
+        temp = os.path.join(self.directory, "." + name)
+        journal = open(temp, "a")
+        fcntl.flock(journal, fcntl.LOCK_EX)
+        path = os.path.join(self.directory, name)
+        os.rename(temp, path)
+        _fsync_directory(self.directory)
+        return path, journal
+
+    def _sync(self, sequence):
+        # group fsync: one call covers every line written before it started
+        with self._sync_lock:
+            if self._synced >= sequence:
+                return
+            with self._lock:
+                target = self._written
+                path, journal = self._journal
+                journal.flush()
+            os.fsync(journal.fileno())
+            self._synced = target
+
+    def flush(self):
+        """
+        Writes every pending batch in one transaction. Returns the number of
+        rows written. If the transaction fails the batches stay pending and
+        their journals are kept, except for those set aside by _set_aside().
+        """
+
+        with self._flush_lock:
+            with self._sync_lock, self._lock:
+                if not self._pending:
+                    return 0
+                batches, self._pending = self._pending, []
+                count, self._count = self._count, 0
+                self._oldest = None
+                if self._journal is not None:
+                    # later appends go to a new journal, this one stays
+                    # open to keep its lock until it is removed
+                    self._journal[1].flush()
+                    os.fsync(self._journal[1].fileno())
+                    self._retired.append(self._journal)
+                    self._journal = None
+                self._synced = self._written
+                journals, self._retired = self._retired, []
+
+            try:
+                with self.app.app_context():
+                    self._write(batches)
+            except Exception as e:
+                try:
+                    with self.app.app_context():
+                        batches = self._set_aside(batches, e)
+                except Exception:
+                    self.app.logger.exception("Setting aside failing batches failed")
+                if not batches:
+                    # everything was set aside, nothing left to replay
+                    self._remove(journals)
+                    raise
+                with self._lock:
+                    self._pending[:0] = batches
+                    self._count += sum(len(rows) for sensor_id, rows, failures in batches)
+                    self._oldest = self._oldest or time.monotonic()
+                    self._retired[:0] = journals
+                raise
+            self._remove(journals)
+            return count
+
+    def _remove(self, journals):
+        # removed before unlocking, so that no buffer can claim them after
+        for path, journal in journals:
+            os.remove(path)
+            journal.close()
+
+    def _write(self, batches, dry_run=False):
+        """
+        Writes *batches* in one transaction. With *dry_run* the rows are
+        only flushed to the database and rolled back.
+        """
+
+        rows_by_sensor = {}
+        for sensor_id, rows, failures in batches:
+            rows_by_sensor.setdefault(sensor_id, []).extend(rows)
+        # sensors deleted since their measurements were accepted
+        existing = set(db.session.scalars(
+            select(Sensor.id).where(Sensor.id.in_(rows_by_sensor))
+        ))
+        for sensor_id in set(rows_by_sensor) - existing:
+            dropped = rows_by_sensor.pop(sensor_id)
+            if not dry_run:
+                self.app.logger.warning(
+                    "Dropping %d buffered measurements of deleted sensor %s",
+                    len(dropped), sensor_id
+                )
+        if dry_run:
+            try:
+                for sensor_id, rows in rows_by_sensor.items():
+                    write_rows(sensor_id, rows)
+                db.session.flush()
+            finally:
+                db.session.rollback()
+            return
+        try:
+            if rows_by_sensor:
+                # raises only if the commit fails, so a retry never writes
+                # rows twice
+                ingest_rows(rows_by_sensor)
+        except Exception:
+            db.session.rollback()
+            raise
+
+    def _set_aside(self, batches, error):
+        """
+        Called when writing *batches* failed with *error*. Counts a failed
+        flush against the batches to blame and sets aside those that have
+        failed max_attempts times. Returns the batches to retry.
+
+        Each batch is tried alone in a transaction that is rolled back, and
+        only those that fail alone are blamed, or all of them when none
+        does. Nothing is blamed when the database could not be reached.
+        """
+
+        if isinstance(error, OperationalError):
+            return batches
+        failing = set()
+        for i, batch in enumerate(batches):
+            try:
+                self._write([batch], dry_run=True)
+            except Exception:
+                failing.add(i)
+        if not failing:
+            failing = set(range(len(batches)))
+
+        retry = []
+        rejected = []
+        for i, (sensor_id, rows, failures) in enumerate(batches):
+            if i in failing:
+                failures += 1
+            if failures >= self.max_attempts:
+                rejected.append((sensor_id, rows, failures))
+            else:
+                retry.append((sensor_id, rows, failures))
+        if rejected:
+            path = os.path.join(
+                self.directory, f"rejected-{self.pid}-{secrets.token_hex(4)}.ndjson"
+            )
+            with open(path, "w") as f:
+                f.writelines(_encode(sensor_id, rows) for sensor_id, rows, failures in rejected)
+                f.flush()
+                os.fsync(f.fileno())
+            _fsync_directory(self.directory)
+            self.app.logger.error(
+                "Set aside %d measurement batches that failed %d flushes in %s",
+                len(rejected), self.max_attempts, path
+            )
+        return retry
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+        self._wakeup.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+        _buffers.discard(self)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                closed = self._closed
+                due = self._pending and (
+                    self._count >= self.max_rows
+                    or time.monotonic() - self._oldest >= self.max_age
+                )
+                timeout = self.max_age
+                if self._oldest is not None:
+                    timeout = max(self._oldest + self.max_age - time.monotonic(), 0)
+            if closed:
+                return
+            if due:
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception("Flushing the ingest buffer failed")
+                    # back off before trying again
+                    self._wakeup.wait(self.max_age)
+                continue
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+    def _replay(self):
+        """
+        Claims the journals that no buffer holds a lock on, which were left
+        by workers that died, and queues their batches. The lock is kept
+        until they have been written, so that only this buffer replays them.
+        """
+
+        for path in sorted(glob.glob(os.path.join(self.directory, "journal-*.ndjson"))):
+            try:
+                journal = open(path)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # replayed and removed by another buffer since it was listed
+                if os.fstat(journal.fileno()).st_ino != os.stat(path).st_ino:
+                    raise FileNotFoundError(path)
+            except (BlockingIOError, FileNotFoundError):
+                # owned by a live buffer, or gone
+                journal.close()
+                continue
+            for line in journal:
+                try:
+                    sensor_id, rows = _decode(line)
+                except ValueError:
+                    # torn final line, its request was never acknowledged
+                    continue
+                self._pending.append((sensor_id, rows, 0))
+                self._count += len(rows)
+            self._retired.append((path, journal))
+            self._oldest = self._oldest or time.monotonic()
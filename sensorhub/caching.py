@@ -0,0 +1,239 @@
+"""
+Cache backends for Flask-Caching. Select one with CACHE_TYPE:
+
+- "sensorhub.caching.SharedMemoryCache" (default): one SQLite database on a
+  tmpfs such as /dev/shm, shared by every worker process on the host.
+- "sensorhub.caching.LRUCache": in-process LRU capped at CACHE_THRESHOLD
+  entries. Fastest, but every worker has its own copy, so invalidation done
+  by one worker is not seen by the others. Only for single process setups.
+- "RedisCache" (Flask-Caching built-in, needs the redis package): any Redis
+  protocol server, e.g. a local one on a unix socket via CACHE_REDIS_URL.
+
+benchmarks/cache_bench.py compares hit latency across them.
+"""
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from flask_caching.backends.base import BaseCache
+
+
+class LRUCache(BaseCache):
+    """
+    In-process cache that evicts the least recently used entry once it holds
+    more than *threshold* entries. Values are stored as they are, without
+    pickling, so callers must not mutate them.
+    """
+
+    def __init__(self, threshold=500, default_timeout=300):
+        super().__init__(default_timeout=default_timeout)
+        self._threshold = threshold
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs["threshold"] = config["CACHE_THRESHOLD"]
+        return cls(*args, **kwargs)
+
+    def _expiry(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.monotonic() + timeout if timeout else 0
+
+    def _lookup(self, key):
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            return None
+        if expires and expires < time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def get(self, key):
+        with self._lock:
+            return self._lookup(key)
+
+    def get_many(self, *keys):
+        with self._lock:
+            return [self._lookup(key) for key in keys]
+
+    def _store(self, key, value, timeout):
+        # callers hold the lock
+        self._data[key] = (self._expiry(timeout), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._threshold:
+            self._data.popitem(last=False)
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._store(key, value, timeout)
+        return True
+
+    def add(self, key, value, timeout=None):
+        # checked and stored under one lock, so that only one thread adds
+        with self._lock:
+            if self._lookup(key) is not None:
+                return False
+            self._store(key, value, timeout)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def has(self, key):
+        return self.get(key) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            expires, value = self._data.get(key, (0, 0))
+            value = (value or 0) + delta
+            self._data[key] = (expires, value)
+            return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+
+class SharedMemoryCache(BaseCache):
+    """
+    Cache stored in a single SQLite database that all worker processes open.
+    Placed on a tmpfs (CACHE_SHARED_PATH, /dev/shm by default) it never
+    touches the disk, and WAL mode lets readers proceed while one process
+    writes. add() is atomic across processes. Once the cache holds more than
+    *threshold* entries the oldest ones are pruned.
+    """
+
+    PRUNE_INTERVAL = 64
+
+    def __init__(self, path, threshold=500, default_timeout=300):
+        super().__init__(default_timeout=default_timeout)
+        self._path = path
+        self._threshold = threshold
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                "expires REAL NOT NULL, stored REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_stored ON cache (stored)")
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        path = config.get("CACHE_SHARED_PATH")
+        if path is None:
+            # one cache per instance and database, so that other deployments
+            # on the host don't serve each other's pages and markers
+            instance = hashlib.blake2b(
+                "\0".join((app.instance_path, config["SQLALCHEMY_DATABASE_URI"])).encode(),
+                digest_size=8
+            ).hexdigest()
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else app.instance_path
+            path = os.path.join(directory, f"sensorhub-cache-{os.getuid()}-{instance}.db")
+        kwargs["threshold"] = config["CACHE_THRESHOLD"]
+        return cls(path, *args, **kwargs)
+
+    def _connection(self):
+        # sqlite connections can't cross threads or forks
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _expiry(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout else 0
+
+    def get(self, key):
+        return self.get_many(key)[0]
+
+    def get_many(self, *keys):
+        rows = self._connection().execute(
+            "SELECT key, value FROM cache WHERE key IN ({}) "
+            "AND (expires = 0 OR expires > ?)".format(",".join("?" * len(keys))),
+            (*keys, time.time())
+        ).fetchall()
+        found = {key: pickle.loads(value) for key, value in rows}
+        return [found.get(key) for key in keys]
+
+    def set(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._connection().execute(
+            "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+            (key, data, self._expiry(timeout), time.time())
+        )
+        self._maybe_prune()
+        return True
+
+    def add(self, key, value, timeout=None):
+        # only replaces an existing row if it has expired
+        now = time.time()
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        cursor = self._connection().execute(
+            "INSERT INTO cache VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET "
+            "value = excluded.value, expires = excluded.expires, stored = excluded.stored "
+            "WHERE cache.expires != 0 AND cache.expires <= ?",
+            (key, data, self._expiry(timeout), now, now)
+        )
+        self._maybe_prune()
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        cursor = self._connection().execute("DELETE FROM cache WHERE key = ?", (key,))
+        return cursor.rowcount == 1
+
+    def has(self, key):
+        return self._connection().execute(
+            "SELECT 1 FROM cache WHERE key = ? AND (expires = 0 OR expires > ?)",
+            (key, time.time())
+        ).fetchone() is not None
+
+    def clear(self):
+        self._connection().execute("DELETE FROM cache")
+        return True
+
+    def inc(self, key, delta=1):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            value = (self.get(key) or 0) + delta
+            self.set(key, value, timeout=0)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def dec(self, key, delta=1):
+        return self.inc(key, -delta)
+
+    def _maybe_prune(self):
+        self._writes += 1
+        if self._writes % self.PRUNE_INTERVAL:
+            return
+        conn = self._connection()
+        conn.execute(
+            "DELETE FROM cache WHERE expires != 0 AND expires <= ?", (time.time(),)
+        )
+        conn.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "SELECT key FROM cache ORDER BY stored DESC LIMIT -1 OFFSET ?)",
+            (self._threshold,)
+        )
@@ -1,2 +1,30 @@
 JSON = "application/json"
 MEASUREMENT_PAGE_SIZE = 50
+NDJSON = "application/x-ndjson"
+INGEST_BATCH_LIMIT = 10000
+CSV = "text/csv"
+EXPORT_CHUNK_SIZE = 5000
+ROLLUP_RESOLUTIONS = {"1m": 60, "1h": 3600, "1d": 86400}
+AUTH_CACHE_SIZE = 4096
+AUTH_CACHE_TTL = 60
+STATS_TASK_TTL = 600
+STATS_RETRY_AFTER = 5
+STATS_CHUNK_SIZE = 50000
+STATS_WORKER_POLL = 1
+STATS_TASK_LEASE = 300
+AGGREGATE_PAGE_SIZE = 1000
+BUCKET_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+GENERATE_BATCH_SIZE = 100000
+SENSOR_PAGE_SIZE = 1000
+INGEST_CONSUMER_PREFETCH = 1000
+INGEST_CONSUMER_WAIT = 0.5
+EVENT_STREAM = "text/event-stream"
+LIVE_KEEPALIVE = 15
+LIVE_MAX_DURATION = 600
+LIVE_RETRY = 3000
+LIVE_QUEUE_SIZE = 256
+LIVE_BUSY_RETRY_AFTER = 5
+LIVE_BACKFILL_LIMIT = 1000
+LIVE_DATAGRAM_ROWS = 1000
+LIVE_DATAGRAM_MAX = 262144
+BATCH_SENSOR_LIMIT = 500
@@ -0,0 +1,220 @@
+"""
+Ingestion from the broker. Sensors that already publish their readings over
+AMQP can send them to the measurements queue instead of POSTing them. Each
+message is a JSON object naming the sensor and carrying either one
+measurement or a batch of them:
+
+    {"sensor": "name", "value": 1.5, "time": "2025-01-01T00:00:00Z"}
+    {"sensor": "name", "measurements": [{"value": 1.5}, ...]}
+
+Items are validated like those of MeasurementCollection.post. The consumer
+takes up to --prefetch messages at a time, writes them in one transaction
+and acks them as soon as it has committed, so a crash redelivers rather
+than loses them, and nothing that happens after the commit can have them
+written twice. Messages that can never be written (bad JSON or items,
+unknown sensors) are rejected without requeueing.
+
+When a batch fails to commit, its messages go back on the queue, except
+those that had already been redelivered: these are retried one at a time
+and any that fails again is moved to the measurements.failed queue, so
+that a message that can't be written doesn't block the ones behind it.
+"""
+
+import json
+import time
+import click
+import pika
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sensorhub import db
+from sensorhub.constants import *
+from sensorhub.ingest import (
+    first_expired, first_non_finite, ingest_rows, measurement_rows,
+    measurement_validator
+)
+from sensorhub.models import Sensor
+from sensorhub.utils import get_rabbit_connection
+
+QUEUE = "measurements"
+FAILED_QUEUE = "measurements.failed"
+
+
+def parse_message(body):
+    """
+    Returns the sensor name and measurement items of a message body, or
+    raises ValueError if it is malformed.
+    """
+
+    message = json.loads(body)
+    if not isinstance(message, dict) or not isinstance(message.get("sensor"), str):
+        raise ValueError("Expected an object with a sensor name")
+    name = message.pop("sensor")
+    items = message.get("measurements", [message])
+    if not isinstance(items, list):
+        raise ValueError("Expected measurements to be an array")
+    if len(items) > INGEST_BATCH_LIMIT:
+        raise ValueError(f"At most {INGEST_BATCH_LIMIT} measurements per message")
+    for i, item in enumerate(items):
+        if not measurement_validator.is_valid(item):
+            raise ValueError(f"Item {i} is not a valid measurement")
+    non_finite = first_non_finite(items)
+    if non_finite is not None:
+        raise ValueError(f"Item {non_finite}: value must be a finite number")
+    expired = first_expired(items)
+    if expired is not None:
+        raise ValueError(f"Item {expired} is older than the retention period")
+    return name, items
+
+def write_parsed(channel, parsed):
+    """
+    Writes the measurements of (method, sensor name, items) deliveries in
+    one transaction. Deliveries for unknown sensors are rejected once the
+    rest are committed. Raises, having settled nothing, if the commit fails.
+    Returns the number of measurements written and the delivery tag of the
+    last one to ack, if any.
+    """
+
+    names = {name for method, name, items in parsed}
+    sensor_ids = dict(db.session.execute(
+        select(Sensor.name, Sensor.id).where(Sensor.name.in_(names))
+    ).all())
+    rows_by_sensor = {}
+    unknown = []
+    last = None
+    for method, name, items in parsed:
+        sensor_id = sensor_ids.get(name)
+        if sensor_id is None:
+            unknown.append((method, name))
+            continue
+        rows_by_sensor.setdefault(sensor_id, []).extend(measurement_rows(sensor_id, items))
+        last = method.delivery_tag
+
+    rows_by_sensor = {sensor_id: rows for sensor_id, rows in rows_by_sensor.items() if rows}
+    try:
+        if rows_by_sensor:
+            # raises only if the commit fails
+            ingest_rows(rows_by_sensor)
+        else:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for method, name in unknown:
+        current_app.logger.warning("Rejected measurements of unknown sensor %s", name)
+        channel.basic_reject(method.delivery_tag, requeue=False)
+    return sum(len(rows) for rows in rows_by_sensor.values()), last
+
+def write_deliveries(channel, deliveries):
+    """
+    Writes the measurements of a batch of (method, body) deliveries in one
+    transaction, then acks them. Malformed messages are rejected first.
+    If the batch can't be committed, every delivery is settled as described
+    in the module docstring, and the error is raised again if any of them
+    was requeued. Returns the number of measurements written.
+    """
+
+    parsed = []
+    bodies = {}
+    for method, body in deliveries:
+        try:
+            parsed.append((method, *parse_message(body)))
+            bodies[method.delivery_tag] = body
+        except ValueError as e:
+            current_app.logger.warning("Rejected measurement message: %s", e)
+            channel.basic_reject(method.delivery_tag, requeue=False)
+
+    try:
+        written, last = write_parsed(channel, parsed)
+    except Exception as e:
+        written, requeued = settle_failed(channel, parsed, bodies, e)
+        if requeued:
+            raise
+        current_app.logger.exception("Writing measurements from the queue failed")
+        return written
+    if last is not None:
+        # rejected tags are already settled, this acks the rest
+        channel.basic_ack(last, multiple=True)
+    return written
+
+def settle_failed(channel, parsed, bodies, error):
+    """
+    Settles the deliveries of a batch that failed to commit with *error*.
+    Those seen for the first time are requeued. Redelivered ones are written
+    one at a time and acked, or moved to FAILED_QUEUE if they fail again.
+    Everything is requeued when the database could not be reached. Returns
+    the number of measurements written and whether any were requeued.
+    """
+
+    total = 0
+    requeued = False
+    for delivery in parsed:
+        method = delivery[0]
+        if not method.redelivered or isinstance(error, OperationalError):
+            channel.basic_nack(method.delivery_tag, requeue=True)
+            requeued = True
+            continue
+        try:
+            written, last = write_parsed(channel, [delivery])
+        except Exception:
+            current_app.logger.exception(
+                "Moved a measurement message that failed repeatedly to %s", FAILED_QUEUE
+            )
+            channel.basic_publish(
+                exchange="",
+                routing_key=FAILED_QUEUE,
+                body=bodies[method.delivery_tag],
+                properties=pika.BasicProperties(delivery_mode=2)
+            )
+            channel.basic_ack(method.delivery_tag)
+            continue
+        total += written
+        if last is not None:
+            channel.basic_ack(last)
+    return total, requeued
+
+def run_consumer(prefetch=INGEST_CONSUMER_PREFETCH, once=False, channel=None):
+    """
+    Consumes the measurements queue. A batch is written once *prefetch*
+    messages have arrived or none has for INGEST_CONSUMER_WAIT seconds.
+    With *once* set, returns after the queue has been drained. Returns the
+    number of measurements written.
+    """
+
+    if channel is None:
+        channel = get_rabbit_connection().channel()
+    channel.queue_declare(queue=QUEUE, durable=True)
+    channel.queue_declare(queue=FAILED_QUEUE, durable=True)
+    channel.basic_qos(prefetch_count=prefetch)
+    written = 0
+    deliveries = []
+    for method, properties, body in channel.consume(
+        QUEUE, inactivity_timeout=INGEST_CONSUMER_WAIT
+    ):
+        if method is not None:
+            deliveries.append((method, body))
+        if deliveries and (method is None or len(deliveries) >= prefetch):
+            try:
+                written += write_deliveries(channel, deliveries)
+            except Exception:
+                # the deliveries have been settled, requeued ones are tried again
+                if once:
+                    raise
+                current_app.logger.exception("Writing measurements from the queue failed")
+                time.sleep(STATS_WORKER_POLL)
+            deliveries = []
+        elif method is None and once:
+            channel.cancel()
+            return written
+
+
+@click.command("ingest-consumer")
+@click.option("--prefetch", type=int, default=INGEST_CONSUMER_PREFETCH,
+              help="Messages taken and written at a time.")
+@click.option("--once", is_flag=True, help="Exit once the queue is empty.")
+@with_appcontext
+def ingest_consumer_command(prefetch, once):
+    written = run_consumer(prefetch, once=once)
+    if once:
+        click.echo(f"Wrote {written} measurements")
@@ -0,0 +1,181 @@
+"""
+Synthetic data for development and capacity testing, used by flask testgen.
+Measurement values are generated with NumPy a batch at a time and written
+with COPY on Postgres (psycopg2) or driver-level executemany inserts
+elsewhere. Stats and rollups are computed from the same batches as they are
+written, so the generated data never has to be read back.
+"""
+
+import datetime
+import io
+import numpy as np
+from flask import current_app
+from sqlalchemy import insert, select
+from sensorhub import db
+from sensorhub.constants import *
+from sensorhub.models import (
+    EPOCH, Deployment, Location, Measurement, Rollup, Sensor, Stats, deployments, utcnow
+)
+
+
+def create_sensors(prefix, sensors, locations, rng):
+    """
+    Creates *sensors* sensors named prefix-1, prefix-2, ... and gives the
+    first *locations* of them a location. Returns the new sensor ids.
+    """
+
+    location_names = [f"{prefix}-location-{i}" for i in range(1, locations + 1)]
+    if location_names:
+        db.session.execute(insert(Location), [
+            {
+                "name": name,
+                "latitude": float(rng.uniform(-90, 90)),
+                "longitude": float(rng.uniform(-180, 180)),
+                "altitude": float(rng.uniform(0, 500)),
+            }
+            for name in location_names
+        ])
+    location_ids = dict(db.session.execute(
+        select(Location.name, Location.id).where(Location.name.in_(location_names))
+    ).all())
+
+    names = [f"{prefix}-{i}" for i in range(1, sensors + 1)]
+    db.session.execute(insert(Sensor), [
+        {
+            "name": name,
+            "model": "testsensor",
+            "location_id": location_ids.get(f"{prefix}-location-{i}"),
+        }
+        for i, name in enumerate(names, 1)
+    ])
+    return db.session.scalars(
+        select(Sensor.id).where(Sensor.name.in_(names)).order_by(Sensor.id)
+    ).all()
+
+def create_deployments(prefix, count, sensor_ids, start, end, rng):
+    # sensors are spread round robin over the deployments
+    if not count:
+        return
+    span = (end - start).total_seconds()
+    rows = []
+    for i in range(1, count + 1):
+        offsets = np.sort(rng.uniform(0, span, 2))
+        rows.append({
+            "name": f"{prefix}-deployment-{i}",
+            "start": start + datetime.timedelta(seconds=float(offsets[0])),
+            "end": start + datetime.timedelta(seconds=float(offsets[1])),
+        })
+    db.session.execute(insert(Deployment), rows)
+    # deployment names aren't unique, take the ones just inserted
+    deployment_ids = db.session.scalars(
+        select(Deployment.id).order_by(Deployment.id.desc()).limit(count)
+    ).all()[::-1]
+    db.session.execute(insert(deployments), [
+        {"deployment_id": deployment_ids[i % count], "sensor_id": sensor_id}
+        for i, sensor_id in enumerate(sensor_ids)
+    ])
+
+def write_batch(sensor_id, times, values):
+    dialect = db.engine.dialect
+    if dialect.driver == "psycopg2":
+        # COPY skips per-row statement overhead entirely
+        buffer = io.StringIO()
+        stamps = np.datetime_as_string(times, unit="us")
+        buffer.write("".join(
+            f"{sensor_id}\t{value!r}\t{stamp}\n"
+            for value, stamp in zip(values.tolist(), stamps.tolist())
+        ))
+        buffer.seek(0)
+        cursor = db.session.connection().connection.driver_connection.cursor()
+        cursor.copy_expert("COPY measurement (sensor_id, value, time) FROM STDIN", buffer)
+    elif dialect.name == "sqlite":
+        # straight to the driver, with times formatted the way SQLAlchemy
+        # stores them in SQLite
+        stamps = np.datetime_as_string(times, unit="us")
+        db.session.connection().exec_driver_sql(
+            "INSERT INTO measurement (sensor_id, value, time) VALUES (?, ?, ?)",
+            [
+                (sensor_id, value, stamp.replace("T", " "))
+                for value, stamp in zip(values.tolist(), stamps.tolist())
+            ]
+        )
+    else:
+        db.session.execute(insert(Measurement.__table__), [
+            {"sensor_id": sensor_id, "value": value, "time": time}
+            for value, time in zip(values.tolist(), times.tolist())
+        ])
+
+def accumulate_batch(sensor_id, stats, times, values):
+    seconds = (times - np.datetime64(EPOCH, "us")) // np.timedelta64(1, "s")
+    for resolution in ROLLUP_RESOLUTIONS.values():
+        keys, first = np.unique(seconds // resolution * resolution, return_index=True)
+        buckets = zip(
+            np.diff(np.append(first, len(values))).tolist(),
+            np.add.reduceat(values, first).tolist(),
+            np.minimum.reduceat(values, first).tolist(),
+            np.maximum.reduceat(values, first).tolist(),
+        )
+        Rollup.upsert(sensor_id, resolution, {
+            EPOCH + datetime.timedelta(seconds=key): bucket
+            for key, bucket in zip(keys.tolist(), buckets)
+        })
+
+    mean = values.mean()
+    stats.merge(
+        len(values),
+        float(mean),
+        float(np.square(values - mean).sum()),
+        float(values.min()),
+        float(values.max()),
+        times[-1].item()
+    )
+
+def generate_measurements(sensor_id, count, start, interval, batch_size, rng):
+    """
+    Writes *count* measurements for one sensor, evenly spaced by *interval*
+    from *start*. Values are a random walk rounded to two decimals.
+    """
+
+    stats = Stats(sensor_id=sensor_id, count=0, mean=0.0, m2=0.0)
+    level = rng.uniform(0, 100)
+    step = np.timedelta64(int(interval.total_seconds() * 1e6), "us")
+    origin = np.datetime64(start, "us")
+    for offset in range(0, count, batch_size):
+        size = min(batch_size, count - offset)
+        times = origin + np.arange(offset, offset + size) * step
+        walk = level + np.cumsum(rng.normal(0, 1, size))
+        level = walk[-1]
+        values = np.round(walk, 2)
+        write_batch(sensor_id, times, values)
+        accumulate_batch(sensor_id, stats, times, values)
+    stats.generated = utcnow()
+    db.session.add(stats)
+    db.session.commit()
+
+def generate(prefix, sensors, locations, deployment_count, measurements, span,
+             batch_size=GENERATE_BATCH_SIZE, seed=None, echo=print):
+    """
+    Generates a complete data set: sensors, their locations and deployments,
+    and *measurements* measurements per sensor spread over the *span* that
+    ends now.
+    """
+
+    rng = np.random.default_rng(seed)
+    end = utcnow()
+    start = end - span
+    sensor_ids = create_sensors(prefix, sensors, min(locations, sensors), rng)
+    create_deployments(prefix, deployment_count, sensor_ids, start, end, rng)
+    db.session.commit()
+
+    if (current_app.config["MEASUREMENT_PARTITIONING"]
+            and db.engine.dialect.name == "postgresql"):
+        from sensorhub.partitions import ensure_partitions_for
+        # no month is shorter than 28 days, so this touches every one
+        ensure_partitions_for([end] + [
+            start + datetime.timedelta(days=days) for days in range(0, span.days + 1, 28)
+        ])
+
+    interval = span / max(measurements, 1)
+    for sensor_id in sensor_ids:
+        generate_measurements(sensor_id, measurements, start, interval, batch_size, rng)
+        echo(f"Generated {measurements} measurements for sensor {sensor_id}")
@@ -0,0 +1,161 @@
+import datetime
+import math
+from flask import current_app
+from jsonschema import Draft7Validator
+from sqlalchemy import func, insert, select
+from sensorhub import db
+from sensorhub.live import get_hub
+from sensorhub.models import Measurement, Rollup, Stats, utcnow
+from sensorhub.partitions import ensure_partitions_for, retention_cutoff
+from sensorhub.utils import invalidate_pages
+
+# compiled once at import, reused for every item of every batch
+measurement_validator = Draft7Validator(Measurement.json_schema())
+
+
+def parse_time(value):
+    # timestamps are validated against Measurement.json_schema() so they are
+    # always in the "YYYY-MM-DDTHH:MM:SSZ" form; store naive UTC
+    if value is None:
+        return utcnow()
+    return datetime.datetime.fromisoformat(value).replace(tzinfo=None)
+
+def first_non_finite(items):
+    """
+    Returns the index of the first of the validated measurement documents
+    *items* whose value is NaN or infinite, which JSON parsers accept but
+    the value column and the running stats can't hold, or None if there is
+    none.
+    """
+
+    for i, item in enumerate(items):
+        if not math.isfinite(item["value"]):
+            return i
+    return None
+
+def first_expired(items):
+    """
+    Returns the index of the first of the validated measurement documents
+    *items* that is older than the retention period, and whose partition
+    may have been dropped, or None if there is none.
+    """
+
+    cutoff = retention_cutoff()
+    if cutoff is None:
+        return None
+    for i, item in enumerate(items):
+        if item.get("time") is not None and parse_time(item["time"]) < cutoff:
+            return i
+    return None
+
+def update_stats(sensor_id, rows):
+    """
+    Folds *rows* into the sensor's running stats. Returns the sensor's latest
+    measurement time from before the batch, or None if it is not known.
+    """
+
+    # lock the sensor's stats row so concurrent batches merge one at a time
+    stats = Stats.lock(sensor_id)
+    if stats.count is None:
+        # new, or delivered by an external worker without the aggregates
+        stats.rebuild()
+        return None
+    else:
+        previous = stats.last
+        stats.merge(
+            *Stats.aggregate(row["value"] for row in rows),
+            max(row["time"] for row in rows)
+        )
+        return previous
+
+def measurement_rows(sensor_id, items):
+    return [
+        {
+            "sensor_id": sensor_id,
+            "value": item["value"],
+            "time": parse_time(item.get("time")),
+        }
+        for item in items
+    ]
+
+def write_rows(sensor_id, rows):
+    """
+    Inserts *rows* for one sensor and folds them into its running stats and
+    rollups without committing. Returns what update_stats() returns and,
+    if the sensor has live subscribers, the inserted rows with their ids for
+    LiveHub.publish(), otherwise None.
+    """
+
+    partitioned = current_app.config["MEASUREMENT_PARTITIONING"]
+    if partitioned and db.engine.dialect.name == "postgresql":
+        ensure_partitions_for(row["time"] for row in rows)
+    live = get_hub().listening(sensor_id)
+    if live:
+        # writers of the sensor take turns from here until they commit, so
+        # the rows above its highest id after the insert are this batch
+        Stats.lock(sensor_id)
+        highest = db.session.scalar(
+            select(func.max(Measurement.id)).where(Measurement.sensor_id == sensor_id)
+        )
+    db.session.execute(insert(Measurement), rows)
+    inserted = None
+    if live:
+        inserted = [
+            {"time": time, "id": id, "value": value}
+            for time, id, value in db.session.execute(
+                select(Measurement.time, Measurement.id, Measurement.value).where(
+                    Measurement.sensor_id == sensor_id,
+                    Measurement.id > (highest or 0)
+                )
+            )
+        ]
+    previous = update_stats(sensor_id, rows)
+    Rollup.accumulate(sensor_id, rows)
+    return previous, inserted
+
+def ingest_rows(rows_by_sensor):
+    """
+    Writes the rows of every sensor in *rows_by_sensor* in one transaction,
+    invalidates the cached measurement pages they affect and publishes them
+    to live subscribers. Only a failure to write raises: once the rows are
+    committed, failures to invalidate or publish are logged, so that callers
+    never retry a write that already happened.
+    """
+
+    written = {}
+    for sensor_id, rows in rows_by_sensor.items():
+        written[sensor_id] = write_rows(sensor_id, rows)
+    db.session.commit()
+    for sensor_id, (previous, inserted) in written.items():
+        # rows landing before the previous latest one change pages that were
+        # considered complete, otherwise only the tail page is affected
+        rows = rows_by_sensor[sensor_id]
+        backfill = previous is None or min(row["time"] for row in rows) <= previous
+        try:
+            invalidate_pages(sensor_id, history=backfill)
+        except Exception:
+            current_app.logger.exception(
+                "Invalidating cached pages of sensor %s failed", sensor_id
+            )
+        if not inserted:
+            continue
+        try:
+            get_hub().publish(sensor_id, inserted)
+        except Exception:
+            current_app.logger.exception(
+                "Publishing measurements of sensor %s to live streams failed", sensor_id
+            )
+
+def ingest_measurements(sensor, items):
+    """
+    Writes a batch of validated measurement documents for *sensor* with a
+    single executemany insert, folds the batch into the sensor's running
+    stats and time-bucketed rollups and commits everything together.
+    Cached measurement pages affected by the batch are invalidated. Returns
+    the number of rows.
+    """
+
+    rows = measurement_rows(sensor.id, items)
+    if rows:
+        ingest_rows({sensor.id: rows})
+    return len(rows)
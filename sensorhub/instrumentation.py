@@ -0,0 +1,257 @@
+"""
+Opt-in per-request instrumentation, enabled with INSTRUMENTATION. For every
+request it records the number of SQL queries and the time spent in them,
+the time spent serializing the response, and hits and misses of the shared
+cache (pages, versions and task markers) and the auth cache. Each response
+carries them in a Server-Timing header, and totals per route are exported
+in Prometheus text format at /api/metrics.
+
+Queries that run while a response is being serialized, typically lazy
+loads of relationships, are counted separately as a hint of N+1 queries.
+Serialization time excludes the time spent in those queries. The header is
+sent before the body, so for streamed responses it only covers the work
+done up to then; the exported totals cover the whole response.
+
+Totals are kept per process: with several workers each scrape sees only
+the worker that answered it.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sensorhub import cache, db
+
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.lazy_queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.serializing = False
+        self.cache = {}
+
+    def cache_result(self, name, hit):
+        hits, misses = self.cache.get(name, (0, 0))
+        self.cache[name] = (hits + 1, misses) if hit else (hits, misses + 1)
+
+    def server_timing(self, total):
+        db_desc = f"{self.queries} queries"
+        if self.lazy_queries:
+            db_desc += f", {self.lazy_queries} while serializing"
+        parts = [
+            f'db;dur={self.db_time * 1000:.2f};desc="{db_desc}"',
+            f"serialize;dur={self.serialize_time * 1000:.2f}",
+        ]
+        for name, (hits, misses) in sorted(self.cache.items()):
+            parts.append(f'cache-{name};desc="{hits} hit, {misses} miss"')
+        parts.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(parts)
+
+
+class MetricsRegistry:
+    """
+    Per-route totals of the recorded request metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}
+        self.durations = {}
+        self.totals = {}
+        self.cache = {}
+
+    def record(self, route, method, status, metrics, duration):
+        key = (route, method)
+        with self._lock:
+            self.requests[key + (status,)] = self.requests.get(key + (status,), 0) + 1
+            counts, total, count = self.durations.get(
+                key, ([0] * len(DURATION_BUCKETS), 0.0, 0)
+            )
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if duration <= bound:
+                    counts[i] += 1
+            self.durations[key] = (counts, total + duration, count + 1)
+            queries, lazy, db_time, serialize_time = self.totals.get(key, (0, 0, 0.0, 0.0))
+            self.totals[key] = (
+                queries + metrics.queries,
+                lazy + metrics.lazy_queries,
+                db_time + metrics.db_time,
+                serialize_time + metrics.serialize_time,
+            )
+            for name, (hits, misses) in metrics.cache.items():
+                for result, n in (("hit", hits), ("miss", misses)):
+                    cache_key = key + (name, result)
+                    self.cache[cache_key] = self.cache.get(cache_key, 0) + n
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines.append("# TYPE sensorhub_requests_total counter")
+            for (route, method, status), n in sorted(self.requests.items()):
+                labels = f'route="{route}",method="{method}",status="{status}"'
+                lines.append(f"sensorhub_requests_total{{{labels}}} {n}")
+
+            lines.append("# TYPE sensorhub_request_duration_seconds histogram")
+            for (route, method), (counts, total, count) in sorted(self.durations.items()):
+                labels = f'route="{route}",method="{method}"'
+                for bound, n in zip(DURATION_BUCKETS, counts):
+                    lines.append(
+                        f'sensorhub_request_duration_seconds_bucket{{{labels},le="{bound}"}} {n}'
+                    )
+                lines.append(
+                    f'sensorhub_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}'
+                )
+                lines.append(f"sensorhub_request_duration_seconds_sum{{{labels}}} {total}")
+                lines.append(f"sensorhub_request_duration_seconds_count{{{labels}}} {count}")
+
+            series = (
+                ("sensorhub_db_queries_total", "counter", 0),
+                ("sensorhub_db_lazy_queries_total", "counter", 1),
+                ("sensorhub_db_seconds_total", "counter", 2),
+                ("sensorhub_serialize_seconds_total", "counter", 3),
+            )
+            for name, kind, index in series:
+                lines.append(f"# TYPE {name} {kind}")
+                for (route, method), values in sorted(self.totals.items()):
+                    labels = f'route="{route}",method="{method}"'
+                    lines.append(f"{name}{{{labels}}} {values[index]}")
+
+            lines.append("# TYPE sensorhub_cache_requests_total counter")
+            for (route, method, name, result), n in sorted(self.cache.items()):
+                labels = f'route="{route}",method="{method}",cache="{name}",result="{result}"'
+                lines.append(f"sensorhub_cache_requests_total{{{labels}}} {n}")
+        return "\n".join(lines) + "\n"
+
+
+def current_metrics():
+    # created on first use, since URL converters such as the sensor lookup
+    # run while the request is matched, before any before_request hook
+    if not has_request_context():
+        return None
+    metrics = g.get("instrumentation")
+    if metrics is None and "instrumentation" in current_app.extensions:
+        metrics = g.instrumentation = RequestMetrics()
+    return metrics
+
+@contextmanager
+def serializing():
+    """
+    Marks the enclosed block as response serialization. Does nothing when
+    instrumentation is off.
+    """
+
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    start = time.perf_counter()
+    db_time = metrics.db_time
+    metrics.serializing = True
+    try:
+        yield
+    finally:
+        metrics.serializing = False
+        metrics.serialize_time += time.perf_counter() - start - (metrics.db_time - db_time)
+
+def record_cache(name, hit):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.cache_result(name, hit)
+
+def instrument_cache(name, target):
+    """
+    Wraps the get and get_many methods of a cache object so that requests
+    record their hits and misses under *name*. A multi-key lookup counts as
+    one hit if any of the keys was found.
+    """
+
+    if getattr(target, "_instrumented", False):
+        return
+    # some backends implement get with get_many, count only the outer call
+    state = threading.local()
+
+    def counted(method, hit):
+        def wrapper(*keys):
+            if getattr(state, "active", False):
+                return method(*keys)
+            state.active = True
+            try:
+                result = method(*keys)
+            finally:
+                state.active = False
+            record_cache(name, hit(result))
+            return result
+        return wrapper
+
+    target.get = counted(target.get, lambda value: value is not None)
+    if hasattr(target, "get_many"):
+        target.get_many = counted(
+            target.get_many, lambda values: any(value is not None for value in values)
+        )
+    target._instrumented = True
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_metrics() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = current_metrics()
+    starts = conn.info.get("query_start")
+    if metrics is None or not starts:
+        return
+    metrics.db_time += time.perf_counter() - starts.pop()
+    metrics.queries += 1
+    if metrics.serializing:
+        metrics.lazy_queries += 1
+
+def _before_request():
+    current_metrics()
+
+def _after_request(response):
+    metrics = g.get("instrumentation")
+    if metrics is None:
+        return response
+    response.headers["Server-Timing"] = metrics.server_timing(
+        time.perf_counter() - metrics.start
+    )
+
+    # streamed responses keep running queries after this, so the totals
+    # are recorded once the response has been sent
+    registry = current_app.extensions["instrumentation"]
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    method = request.method
+    def record():
+        registry.record(
+            route, method, response.status_code, metrics,
+            time.perf_counter() - metrics.start
+        )
+    response.call_on_close(record)
+    return response
+
+def render_metrics():
+    registry = current_app.extensions.get("instrumentation")
+    if registry is None:
+        return None
+    return Response(registry.render(), 200, mimetype="text/plain; version=0.0.4")
+
+def init_app(app):
+    from sensorhub.utils import auth_cache
+
+    app.extensions["instrumentation"] = MetricsRegistry()
+    with app.app_context():
+        engine = db.engine
+        if not event.contains(engine, "before_cursor_execute", _before_cursor_execute):
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        instrument_cache("shared", cache.cache)
+    instrument_cache("auth", auth_cache)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
@@ -0,0 +1,253 @@
+"""
+Fan-out of newly ingested measurements to live subscribers, used by the
+Server-Sent Events stream at /api/sensors/<sensor>/measurements/live.
+
+Each worker process has one LiveHub. Committed batches are serialized once
+into an SSE frame and handed to every local subscriber of the sensor, so a
+write reaches any number of viewers without queries or per-viewer work.
+Workers share batches over unix datagram sockets in LIVE_SOCKET_DIR: a
+worker binds its socket once it has had a subscriber, and publishers send
+each batch to every socket found there. Sends never block ingestion; a
+worker that can't keep up loses batches, and a subscriber whose queue
+fills up is disconnected so that it reconnects and catches up from the
+database with Last-Event-ID. A worker takes at most LIVE_MAX_STREAMS
+subscribers, as each holds one of its threads.
+
+Event ids are cursors of the (time, id) key of a batch's latest row, like
+those of the measurement pages. Batches can arrive out of time order, so a
+stream resuming from an event may get again rows it had already seen after
+that event, but never misses any.
+"""
+
+import atexit
+import collections
+import datetime
+import json
+import os
+import socket
+import threading
+from flask import current_app
+from sensorhub.constants import *
+from sensorhub.utils import encode_cursor
+
+SOCKET_SUFFIX = ".sock"
+
+
+def get_hub():
+    """
+    Returns this worker's LiveHub, creating it on first use.
+    """
+
+    hub = current_app.extensions.get("live_hub")
+    if hub is None or hub.pid != os.getpid():
+        hub = current_app.extensions["live_hub"] = LiveHub(
+            current_app.config["LIVE_SOCKET_DIR"],
+            max_streams=current_app.config["LIVE_MAX_STREAMS"]
+        )
+    return hub
+
+def row_key(row):
+    return row["time"], row["id"]
+
+def format_frame(rows):
+    """
+    Returns the (time, id) key of the latest row and the SSE frame carrying
+    *rows*, which must be in key order. The key's cursor is the event id.
+    """
+
+    last = row_key(rows[-1])
+    data = json.dumps([
+        {"value": row["value"], "time": row["time"].isoformat()} for row in rows
+    ])
+    return last, f"id: {encode_cursor(*last)}\nevent: measurements\ndata: {data}\n\n"
+
+
+class Subscription:
+    """
+    A bounded queue of frames for one stream. Once it overflows the queued
+    frames are dropped and get() returns None straight away; the stream is
+    ended and catches up from the database when it reconnects.
+    """
+
+    def __init__(self, hub, sensor_id, size=None):
+        self.hub = hub
+        self.sensor_id = sensor_id
+        self.size = size or LIVE_QUEUE_SIZE
+        self.overflowed = False
+        self._frames = collections.deque()
+        self._ready = threading.Condition()
+
+    def put(self, frame):
+        with self._ready:
+            if len(self._frames) >= self.size:
+                self.overflowed = True
+                self._frames.clear()
+            elif not self.overflowed:
+                self._frames.append(frame)
+            self._ready.notify()
+
+    def get(self, timeout):
+        """
+        Returns the next (key, frame) pair, or None if there was none
+        within *timeout* seconds or the subscription has overflowed.
+        """
+
+        with self._ready:
+            self._ready.wait_for(lambda: self._frames or self.overflowed, timeout)
+            if self.overflowed or not self._frames:
+                return None
+            return self._frames.popleft()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class LiveHub:
+
+    def __init__(self, directory, name=None, max_streams=None):
+        self.directory = directory
+        self.max_streams = max_streams
+        self.pid = os.getpid()
+        self.path = os.path.join(directory, (name or str(self.pid)) + SOCKET_SUFFIX)
+        self._lock = threading.Lock()
+        self._subscribers = {}
+        self._streams = 0
+        self._receiver = None
+        self._sender = None
+
+    def subscribe(self, sensor_id):
+        """
+        Returns a new Subscription to *sensor_id*, or None if the worker
+        already has max_streams subscribers.
+        """
+
+        with self._lock:
+            if self.max_streams is not None and self._streams >= self.max_streams:
+                return None
+            self._streams += 1
+        try:
+            self._listen()
+        except Exception:
+            with self._lock:
+                self._streams -= 1
+            raise
+        subscription = Subscription(self, sensor_id)
+        with self._lock:
+            self._subscribers.setdefault(sensor_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.sensor_id, set())
+            if subscription in subscribers:
+                # closed by both the stream and the response
+                self._streams -= 1
+            subscribers.discard(subscription)
+            if not subscribers:
+                self._subscribers.pop(subscription.sensor_id, None)
+
+    def listening(self, sensor_id):
+        """
+        Returns whether batches of *sensor_id* can reach a subscriber, in
+        this worker or another one.
+        """
+
+        return sensor_id in self._subscribers or bool(self._peers())
+
+    def publish(self, sensor_id, rows):
+        """
+        Delivers committed *rows* of a sensor, with their ids, to the
+        subscribers of this and every other worker. Does nothing if no
+        worker has subscribers.
+        """
+
+        peers = self._peers()
+        if not peers and sensor_id not in self._subscribers:
+            return
+        rows = sorted(rows, key=row_key)
+        for start in range(0, len(rows), LIVE_DATAGRAM_ROWS):
+            last, frame = format_frame(rows[start:start + LIVE_DATAGRAM_ROWS])
+            self.dispatch(sensor_id, last, frame)
+            if peers:
+                header = f"{sensor_id} {last[0].isoformat()} {last[1]}"
+                message = f"{header}\n{frame}".encode()
+                for peer in peers:
+                    self._send(peer, message)
+
+    def dispatch(self, sensor_id, last, frame):
+        with self._lock:
+            subscribers = list(self._subscribers.get(sensor_id, ()))
+        for subscription in subscribers:
+            subscription.put((last, frame))
+
+    def close(self):
+        with self._lock:
+            receiver, self._receiver = self._receiver, None
+        if receiver is None:
+            return
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        # wakes up the receiving thread
+        receiver.shutdown(socket.SHUT_RDWR)
+        receiver.close()
+
+    def _peers(self):
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        own = os.path.basename(self.path)
+        return [
+            os.path.join(self.directory, name)
+            for name in names
+            if name.endswith(SOCKET_SUFFIX) and name != own
+        ]
+
+    def _send(self, peer, message):
+        if self._sender is None:
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sender.setblocking(False)
+        try:
+            self._sender.sendto(message, peer)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # left behind by a worker that is gone
+            try:
+                os.unlink(peer)
+            except FileNotFoundError:
+                pass
+        except OSError:
+            # the peer's buffer is full or the batch is too large, the
+            # peer's subscribers miss it
+            current_app.logger.debug("Live batch to %s dropped", peer)
+
+    def _listen(self):
+        with self._lock:
+            if self._receiver is not None:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            receiver.bind(self.path)
+            self._receiver = receiver
+        threading.Thread(target=self._receive, args=(receiver,), daemon=True).start()
+        atexit.register(self.close)
+
+    def _receive(self, receiver):
+        while True:
+            try:
+                message = receiver.recv(LIVE_DATAGRAM_MAX)
+            except OSError:
+                message = None
+            if not message:
+                # closed
+                return
+            header, frame = message.decode().split("\n", 1)
+            sensor_id, time, id = header.split(" ")
+            self.dispatch(
+                int(sensor_id), (datetime.datetime.fromisoformat(time), int(id)), frame
+            )
@@ -0,0 +1,132 @@
+"""
+Minimal schema migrations for deployments whose database was created with
+an older version of the models. Each migration is applied once, in order,
+and the last applied version is kept in the schema_version table. init-db
+creates the current schema directly and marks it as fully migrated.
+
+Migrations are written to be safe on a live database: indexes are built
+with CREATE INDEX CONCURRENTLY on Postgres, and new columns are nullable so
+adding them doesn't rewrite the table.
+
+    flask migrate status
+    flask migrate upgrade [--target VERSION]
+    flask migrate stamp [VERSION]
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from sensorhub import db
+from sensorhub.models import ArchiveSegment, Rollup, StatsTask
+
+schema_version = db.Table(
+    "schema_version",
+    db.Column("version", db.Integer, nullable=False)
+)
+
+
+def create_index(conn, name, table, columns):
+    if name in {index["name"] for index in inspect(conn).get_indexes(table)}:
+        return
+    # builds without blocking writes on Postgres
+    concurrently = "CONCURRENTLY " if conn.dialect.name == "postgresql" else ""
+    conn.execute(text(
+        f"CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"
+    ))
+
+def add_columns(conn, table, columns):
+    existing = {column["name"] for column in inspect(conn).get_columns(table)}
+    for name, type_ in columns:
+        if name not in existing:
+            type_sql = type_.compile(dialect=conn.dialect)
+            conn.execute(text(f'ALTER TABLE {table} ADD COLUMN "{name}" {type_sql}'))
+
+def measurement_indexes(conn):
+    create_index(
+        conn, "ix_measurement_sensor_time_id", "measurement", ["sensor_id", "time", "id"]
+    )
+    create_index(conn, "ix_deployments_sensor_id", "deployments", ["sensor_id"])
+    create_index(conn, "ix_api_key_sensor_id", "api_key", ["sensor_id"])
+
+def running_stats_columns(conn):
+    add_columns(conn, "stats", [
+        ("count", db.Integer()),
+        ("m2", db.Float()),
+        ("minimum", db.Float()),
+        ("maximum", db.Float()),
+        ("last", db.DateTime()),
+    ])
+
+def rollup_table(conn):
+    # existing data is folded in with flask rebuild-rollups
+    Rollup.__table__.create(conn, checkfirst=True)
+
+def stats_task_table(conn):
+    StatsTask.__table__.create(conn, checkfirst=True)
+
+def archive_segment_table(conn):
+    ArchiveSegment.__table__.create(conn, checkfirst=True)
+
+def stats_task_lease(conn):
+    add_columns(conn, "stats_task", [("claimed_until", db.DateTime())])
+
+MIGRATIONS = [
+    (1, "indexes for measurement, deployment and key lookups", measurement_indexes),
+    (2, "running aggregate columns on stats", running_stats_columns),
+    (3, "measurement rollup table", rollup_table),
+    (4, "stats task table", stats_task_table),
+    (5, "archive segment table", archive_segment_table),
+    (6, "lease column on stats tasks", stats_task_lease),
+]
+HEAD = MIGRATIONS[-1][0]
+
+
+def current_version(conn):
+    schema_version.create(conn, checkfirst=True)
+    return conn.execute(db.select(schema_version.c.version)).scalar() or 0
+
+def set_version(conn, version):
+    conn.execute(schema_version.delete())
+    conn.execute(schema_version.insert().values(version=version))
+
+def stamp(version=HEAD):
+    with db.engine.begin() as conn:
+        current_version(conn)
+        set_version(conn, version)
+
+def upgrade(target=HEAD, echo=print):
+    # autocommit so that Postgres can build indexes concurrently; each
+    # migration is idempotent so a failed one can simply be rerun
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        version = current_version(conn)
+        for number, description, migration in MIGRATIONS:
+            if version < number <= target:
+                echo(f"Applying {number}: {description}")
+                migration(conn)
+                set_version(conn, number)
+
+
+@click.group("migrate")
+def migrate_command():
+    """Inspect and upgrade the database schema."""
+
+@migrate_command.command("status")
+@with_appcontext
+def status_command():
+    with db.engine.begin() as conn:
+        version = current_version(conn)
+    for number, description, migration in MIGRATIONS:
+        mark = "x" if number <= version else " "
+        click.echo(f"[{mark}] {number}: {description}")
+
+@migrate_command.command("upgrade")
+@click.option("--target", type=int, default=HEAD)
+@with_appcontext
+def upgrade_command(target):
+    upgrade(target, echo=click.echo)
+
+@migrate_command.command("stamp")
+@click.argument("version", type=int, default=HEAD)
+@with_appcontext
+def stamp_command(version):
+    stamp(version)
@@ -1,19 +1,49 @@
 import datetime
 import click
 import hashlib
+import math
 from flask.cli import with_appcontext
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 from sensorhub import db
+from sensorhub.constants import *
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+def utcnow():
+    # all timestamps are stored as naive UTC
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+class epoch(FunctionElement):
+    """
+    Whole seconds since the Unix epoch of a naive UTC DateTime expression,
+    for bucketing times in SQL.
+    """
+
+    type = db.BigInteger()
+    inherit_cache = True
+    name = "epoch"
+
+@compiles(epoch)
+def _compile_epoch(element, compiler, **kw):
+    return "CAST(strftime('%s', {}) AS INTEGER)".format(compiler.process(element.clauses, **kw))
+
+@compiles(epoch, "postgresql")
+def _compile_epoch_postgresql(element, compiler, **kw):
+    return "CAST(FLOOR(EXTRACT(EPOCH FROM {})) AS BIGINT)".format(
+        compiler.process(element.clauses, **kw)
+    )
 
 deployments = db.Table(
     "deployments",
     db.Column("deployment_id", db.Integer, db.ForeignKey("deployment.id"), primary_key=True),
-    db.Column("sensor_id", db.Integer, db.ForeignKey("sensor.id"), primary_key=True)
+    db.Column("sensor_id", db.Integer, db.ForeignKey("sensor.id"), primary_key=True, index=True)
 )
 
 class ApiKey(db.Model):
     
     key = db.Column(db.LargeBinary, nullable=False, unique=True, primary_key=True)
-    sensor_id = db.Column(db.Integer, db.ForeignKey("sensor.id"), nullable=True)
+    sensor_id = db.Column(db.Integer, db.ForeignKey("sensor.id"), nullable=True, index=True)
     admin =  db.Column(db.Boolean, default=False)
     
     sensor = db.relationship("Sensor", uselist=False)
@@ -34,14 +64,31 @@ class Location(db.Model):
     sensor = db.relationship("Sensor", back_populates="location", uselist=False)
 
     def serialize(self, short_form=False):
+        return Location.serialize_row(
+            (self.name, self.longitude, self.latitude, self.altitude, self.description),
+            short_form=short_form
+        )
+
+    @staticmethod
+    def row_columns(short_form=False):
+        columns = (Location.name,)
+        if not short_form:
+            columns += (
+                Location.longitude, Location.latitude, Location.altitude, Location.description
+            )
+        return columns
+
+    @staticmethod
+    def serialize_row(row, short_form=False):
+        # row holds the values of row_columns(short_form) in order
         doc = {
-            "name": self.name
+            "name": row[0]
         }
         if not short_form:
-            doc["longitude"] = self.longitude
-            doc["latitude"] = self.latitude
-            doc["altitude"] = self.altitude
-            doc["description"] = self.description
+            doc["longitude"] = row[1]
+            doc["latitude"] = row[2]
+            doc["altitude"] = row[3]
+            doc["description"] = row[4]
         return doc
 
     def deserialize(self, doc):
@@ -70,7 +117,10 @@ class Sensor(db.Model):
     location = db.relationship("Location", back_populates="sensor")
     measurements = db.relationship("Measurement", back_populates="sensor")
     deployments = db.relationship("Deployment", secondary=deployments, back_populates="sensors")
-    stats = db.relationship("Stats", back_populates="sensor", uselist=False)
+    # every sensor that has had measurements has a stats row
+    stats = db.relationship(
+        "Stats", back_populates="sensor", uselist=False, cascade="all, delete-orphan"
+    )
 
     def serialize(self, short_form=False):
         return {
@@ -79,6 +129,22 @@ class Sensor(db.Model):
             "location": self.location and self.location.serialize(short_form=short_form)
         }
 
+    @staticmethod
+    def row_columns(short_form=False):
+        # the location columns need Sensor.location outer joined
+        return (Sensor.name, Sensor.model) + Location.row_columns(short_form)
+
+    @staticmethod
+    def serialize_row(row, short_form=False):
+        # a sensor without a location has None in every location column
+        return {
+            "name": row[0],
+            "model": row[1],
+            "location": None if row[2] is None else Location.serialize_row(
+                row[2:], short_form=short_form
+            )
+        }
+
     def deserialize(self, doc):
         self.name = doc["name"]
         self.model = doc["model"]
@@ -102,6 +168,10 @@ class Sensor(db.Model):
 
 
 class Measurement(db.Model):
+    __table_args__ = (
+        db.Index("ix_measurement_sensor_time_id", "sensor_id", "time", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     sensor_id = db.Column(db.Integer, db.ForeignKey("sensor.id", ondelete="SET NULL"))
     value = db.Column(db.Float, nullable=False)
@@ -128,11 +198,142 @@ class Measurement(db.Model):
         return schema
 
 
+class Rollup(db.Model):
+    """
+    Materialized per-sensor aggregates of measurements over fixed time
+    buckets. *resolution* is the bucket length in seconds, one of the values
+    in ROLLUP_RESOLUTIONS, and *bucket* is the start of the bucket.
+    """
+
+    sensor_id = db.Column(
+        db.Integer,
+        db.ForeignKey("sensor.id", ondelete="CASCADE"),
+        primary_key=True
+    )
+    resolution = db.Column(db.Integer, primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    count = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Float, nullable=False)
+    minimum = db.Column(db.Float, nullable=False)
+    maximum = db.Column(db.Float, nullable=False)
+
+    @staticmethod
+    def bucket_start(time, resolution):
+        step = datetime.timedelta(seconds=resolution)
+        return EPOCH + (time - EPOCH) // step * step
+
+    @classmethod
+    def accumulate(cls, sensor_id, rows):
+        """
+        Folds *rows* (dicts with value and time) into the sensor's rollups at
+        every resolution with one upsert statement per resolution.
+        """
+
+        for resolution in ROLLUP_RESOLUTIONS.values():
+            buckets = {}
+            for row in rows:
+                start = cls.bucket_start(row["time"], resolution)
+                value = row["value"]
+                agg = buckets.get(start)
+                if agg is None:
+                    buckets[start] = [1, value, value, value]
+                else:
+                    agg[0] += 1
+                    agg[1] += value
+                    if value < agg[2]:
+                        agg[2] = value
+                    if value > agg[3]:
+                        agg[3] = value
+            cls.upsert(sensor_id, resolution, buckets)
+
+    @classmethod
+    def upsert(cls, sensor_id, resolution, buckets):
+        """
+        Adds *buckets*, a dict of bucket start to (count, total, minimum,
+        maximum), to the sensor's rollups at *resolution*.
+        """
+
+        if db.session.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+
+        # Core insert, the ORM bulk path adds nothing here
+        stmt = insert(cls.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.sensor_id, cls.resolution, cls.bucket],
+            set_={
+                "count": cls.count + stmt.excluded.count,
+                "total": cls.total + stmt.excluded.total,
+                "minimum": db.case(
+                    (stmt.excluded.minimum < cls.minimum, stmt.excluded.minimum),
+                    else_=cls.minimum
+                ),
+                "maximum": db.case(
+                    (stmt.excluded.maximum > cls.maximum, stmt.excluded.maximum),
+                    else_=cls.maximum
+                ),
+            }
+        )
+        db.session.execute(
+            stmt,
+            [
+                {
+                    "sensor_id": sensor_id,
+                    "resolution": resolution,
+                    "bucket": start,
+                    "count": count,
+                    "total": total,
+                    "minimum": minimum,
+                    "maximum": maximum,
+                }
+                for start, (count, total, minimum, maximum) in buckets.items()
+            ]
+        )
+
+
+class ArchiveSegment(db.Model):
+    """
+    One UTC day of a sensor's measurements that flask archive has moved out
+    of the measurement table into a columnar file under ARCHIVE_DIR. The
+    aggregates of the archived values are kept here so that stats can be
+    rebuilt without reading the file.
+    """
+
+    __table_args__ = (
+        db.UniqueConstraint("sensor_id", "day"),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    sensor_id = db.Column(
+        db.Integer,
+        db.ForeignKey("sensor.id", ondelete="CASCADE"),
+        nullable=False
+    )
+    day = db.Column(db.DateTime, nullable=False)
+    # relative to ARCHIVE_DIR
+    path = db.Column(db.String, nullable=False)
+    first = db.Column(db.DateTime, nullable=False)
+    last = db.Column(db.DateTime, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    mean = db.Column(db.Float, nullable=False)
+    m2 = db.Column(db.Float, nullable=False)
+    minimum = db.Column(db.Float, nullable=False)
+    maximum = db.Column(db.Float, nullable=False)
+
+
 class Stats(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     generated = db.Column(db.DateTime, nullable=False)
     mean = db.Column(db.Float, nullable=False)
+    # running aggregates, kept current on ingest; None when the stats were
+    # delivered by an external worker that only reports the mean
+    count = db.Column(db.Integer, nullable=True)
+    m2 = db.Column(db.Float, nullable=True)
+    minimum = db.Column(db.Float, nullable=True)
+    maximum = db.Column(db.Float, nullable=True)
+    last = db.Column(db.DateTime, nullable=True)
     sensor_id = db.Column(
         db.Integer,
         db.ForeignKey("sensor.id"),
@@ -142,14 +343,150 @@ class Stats(db.Model):
     sensor = db.relationship("Sensor", back_populates="stats")
 
     def serialize(self):
-        return {
-            "generated": self.generated.isoformat(),
-            "mean": self.mean
+        return Stats.serialize_row(
+            (self.generated, self.mean, self.count, self.m2, self.minimum, self.maximum, self.last)
+        )
+
+    @staticmethod
+    def row_columns():
+        return (
+            Stats.generated, Stats.mean, Stats.count, Stats.m2,
+            Stats.minimum, Stats.maximum, Stats.last
+        )
+
+    @staticmethod
+    def serialize_row(row):
+        # times are left as datetimes for serialization.dumps to format
+        generated, mean, count, m2, minimum, maximum, last = row
+        doc = {
+            "generated": generated,
+            "mean": mean
         }
+        if count is not None:
+            doc["count"] = count
+            doc["min"] = minimum
+            doc["max"] = maximum
+            doc["stdev"] = math.sqrt(m2 / count) if count else 0.0
+            doc["last"] = last
+        return doc
 
     def deserialize(self, doc):
+        # documents only carry the mean, the running aggregates are rebuilt
+        # on the next ingest
         self.generated = datetime.datetime.fromisoformat(doc["generated"])
         self.mean = doc["mean"]
+        self.count = self.m2 = self.minimum = self.maximum = self.last = None
+
+    @staticmethod
+    def aggregate(values):
+        """
+        Single pass Welford aggregation of *values*. Returns a tuple of
+        (count, mean, m2, minimum, maximum) suitable for merge().
+        """
+
+        count = 0
+        mean = m2 = 0.0
+        minimum = maximum = None
+        for value in values:
+            count += 1
+            delta = value - mean
+            mean += delta / count
+            m2 += delta * (value - mean)
+            if minimum is None or value < minimum:
+                minimum = value
+            if maximum is None or value > maximum:
+                maximum = value
+        return count, mean, m2, minimum, maximum
+
+    @classmethod
+    def lock(cls, sensor_id):
+        """
+        Returns the sensor's stats row locked for update, creating it first
+        if there is none. The row is created with INSERT ... ON CONFLICT DO
+        NOTHING so that concurrent first batches don't both add one and
+        collide on sensor_id; a created row has no count and needs rebuild().
+        """
+
+        if db.session.get_bind().dialect.name == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert
+
+        db.session.execute(
+            insert(cls.__table__).values(
+                sensor_id=sensor_id, generated=utcnow(), mean=0.0
+            ).on_conflict_do_nothing(index_elements=[cls.sensor_id])
+        )
+        # refreshed in case the row was loaded earlier in the session
+        return db.session.scalars(
+            db.select(cls).where(cls.sensor_id == sensor_id).with_for_update(
+            ).execution_options(populate_existing=True)
+        ).one()
+
+    def merge(self, count, mean, m2, minimum, maximum, last):
+        """
+        Combines the aggregates of a new batch into the running totals using
+        the pairwise form of Welford's update (Chan et al.).
+        """
+
+        if not count:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.minimum = minimum if self.minimum is None else min(self.minimum, minimum)
+        self.maximum = maximum if self.maximum is None else max(self.maximum, maximum)
+        if last is not None and (self.last is None or last > self.last):
+            self.last = last
+        self.generated = utcnow()
+
+    def rebuild(self):
+        """
+        Recomputes the running aggregates from the sensor's full history with
+        two aggregate queries. Used to seed the row the first time it is
+        needed. The sum of squared deviations is taken from the mean found by
+        the first query, as the sum of squares minus count * mean^2 loses
+        all precision for values far from zero.
+        """
+
+        count, mean, minimum, maximum, last = db.session.execute(
+            db.select(
+                db.func.count(Measurement.value),
+                db.func.avg(Measurement.value),
+                db.func.min(Measurement.value),
+                db.func.max(Measurement.value),
+                db.func.max(Measurement.time),
+            ).where(Measurement.sensor_id == self.sensor_id)
+        ).one()
+        m2 = None
+        if count:
+            deviation = Measurement.value - mean
+            m2 = db.session.scalar(
+                db.select(db.func.sum(deviation * deviation)).where(
+                    Measurement.sensor_id == self.sensor_id
+                )
+            )
+        self.count = count
+        self.mean = mean or 0.0
+        self.m2 = m2 or 0.0
+        self.minimum = minimum
+        self.maximum = maximum
+        self.last = last
+        self.merge_archived()
+        self.generated = utcnow()
+
+    def merge_archived(self):
+        # archived days only exist as their stored aggregates here
+        segments = db.session.scalars(
+            db.select(ArchiveSegment).where(ArchiveSegment.sensor_id == self.sensor_id)
+        )
+        for segment in segments:
+            self.merge(
+                segment.count, segment.mean, segment.m2,
+                segment.minimum, segment.maximum, segment.last
+            )
 
     @staticmethod
     def json_schema():
@@ -170,32 +507,96 @@ class Stats(db.Model):
         return schema
 
 
+class StatsTask(db.Model):
+    """
+    Pending stats computation for the built-in stats worker, used instead of
+    the stats queue when STATS_TASK_BACKEND is "db".
+    """
+
+    id = db.Column(db.Integer, primary_key=True)
+    sensor_id = db.Column(
+        db.Integer,
+        db.ForeignKey("sensor.id", ondelete="CASCADE"),
+        unique=True, nullable=False
+    )
+    created = db.Column(db.DateTime, nullable=False, default=utcnow)
+    # set while a worker computes the task, which is retried once it passes
+    claimed_until = db.Column(db.DateTime, nullable=True)
+
+
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
+    from sensorhub.migrations import stamp
     db.create_all()
+    stamp()
+
+@click.command("rebuild-rollups")
+@with_appcontext
+def rebuild_rollups_command():
+    db.session.execute(db.delete(Rollup))
+    query = db.select(
+        Measurement.sensor_id, Measurement.value, Measurement.time
+    ).where(
+        Measurement.sensor_id.is_not(None)
+    ).order_by(
+        Measurement.sensor_id
+    ).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    for chunk in db.session.execute(query).partitions():
+        by_sensor = {}
+        for sensor_id, value, time in chunk:
+            by_sensor.setdefault(sensor_id, []).append({"value": value, "time": time})
+        for sensor_id, rows in by_sensor.items():
+            Rollup.accumulate(sensor_id, rows)
+
+    from sensorhub.archive import read_segment
+    for segment in db.session.scalars(db.select(ArchiveSegment)):
+        times, ids, values = read_segment(segment.path)
+        Rollup.accumulate(segment.sensor_id, [
+            {"value": value, "time": time}
+            for time, value in zip(times.tolist(), values.tolist())
+        ])
+    db.session.commit()
+
+@click.command("stats-worker")
+@click.option("--source", type=click.Choice(["queue", "db"]), default="db")
+@click.option("--processes", type=int, default=2)
+@click.option("--once", is_flag=True, help="Exit once there are no more tasks.")
+@with_appcontext
+def stats_worker_command(source, processes, once):
+    from sensorhub.worker import run_worker
+    run_worker(source, processes, once=once)
 
 @click.command("testgen")
+@click.option("--prefix", default="test-sensor", help="Sensor name prefix.")
+@click.option("--sensors", type=int, default=1)
+@click.option("--locations", type=int, default=0, help="How many sensors get a location.")
+@click.option("--deployments", type=int, default=0)
+@click.option("--measurements", type=int, default=1000, help="Measurements per sensor.")
+@click.option("--span", default="3h", help="Time span ending now, e.g. 90m, 12h or 365d.")
+@click.option("--batch-size", type=int, default=GENERATE_BATCH_SIZE)
+@click.option("--seed", type=int, default=None)
 @with_appcontext
-def generate_test_data():
-    import datetime
-    import random
-    s = Sensor(
-        name="test-sensor-1",
-        model="testsensor"
+def generate_test_data(prefix, sensors, locations, deployments, measurements, span,
+                       batch_size, seed):
+    import re
+    import time
+    from sensorhub.generator import generate
+    match = re.fullmatch(r"([1-9][0-9]*)([smhd])", span)
+    if match is None:
+        raise click.BadParameter("Use a length like 90m, 12h or 365d", param_hint="--span")
+    span = datetime.timedelta(seconds=int(match.group(1)) * BUCKET_UNITS[match.group(2)])
+    if db.session.scalars(db.select(Sensor).filter_by(name=f"{prefix}-1")).first():
+        raise click.ClickException(f"Sensors named {prefix}-N already exist, use --prefix")
+
+    started = time.perf_counter()
+    generate(
+        prefix, sensors, locations, deployments, measurements, span,
+        batch_size=batch_size, seed=seed, echo=click.echo
     )
-    now = datetime.datetime.now()
-    interval = datetime.timedelta(seconds=10)
-    for i in range(1000):
-        m = Measurement(
-            value=round(random.random() * 100, 2),
-            time=now
-        )
-        now += interval
-        s.measurements.append(m)
-    
-    db.session.add(s)
-    db.session.commit()
+    elapsed = time.perf_counter() - started
+    total = sensors * measurements
+    click.echo(f"Wrote {total} measurements in {elapsed:.1f}s ({total / elapsed:.0f} rows/s)")
 
 @click.command("masterkey")
 @with_appcontext
@@ -209,3 +610,13 @@ def generate_master_key():
     db.session.add(db_key)
     db.session.commit()
     print(token)
+
+@click.command("revokekey")
+@click.argument("token")
+@with_appcontext
+def revoke_key_command(token):
+    db_key = db.session.get(ApiKey, ApiKey.key_hash(token))
+    if db_key is None:
+        raise click.ClickException("No such key")
+    db.session.delete(db_key)
+    db.session.commit()
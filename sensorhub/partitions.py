@@ -0,0 +1,250 @@
+"""
+Optional monthly range partitioning of the measurement table on Postgres,
+enabled with MEASUREMENT_PARTITIONING. SQLite deployments keep the single
+table and none of this applies to them.
+
+    flask partitions setup     convert measurement into a partitioned table
+    flask partitions create    create partitions PARTITION_MONTHS_AHEAD ahead
+    flask partitions prune     drop partitions older than the retention
+
+setup keeps the existing rows where they are: the old table becomes the
+first partition, covering everything before the first monthly one, so no
+data is copied. Partitions for new months are also created on demand when
+ingest sees them, but running create from cron keeps that off the request
+path. prune detaches and drops whole partitions, so enforcing retention
+never runs a large DELETE. Running stats and rollups keep covering dropped
+data, and cached measurement pages of the sensors that had rows in them are
+invalidated. Ingest rejects measurements older than the retention set in
+MEASUREMENT_RETENTION_MONTHS, as their partitions may be gone; prune with a
+shorter --retain-months than that leaves a window where such rows fail.
+"""
+
+import datetime
+import re
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+from sensorhub import db
+from sensorhub.models import utcnow
+from sensorhub.utils import invalidate_pages
+
+LEGACY_TABLE = "measurement_legacy"
+
+_known_months = set()
+
+
+def month_start(time):
+    return datetime.datetime(time.year, time.month, 1)
+
+def add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime.datetime(index // 12, index % 12 + 1, 1)
+
+def retention_cutoff(retain_months=None):
+    """
+    Returns the start of the oldest month kept when retaining *retain_months*
+    months before the current one, by default MEASUREMENT_RETENTION_MONTHS,
+    or None if there is no retention.
+    """
+
+    if retain_months is None:
+        retain_months = current_app.config["MEASUREMENT_RETENTION_MONTHS"]
+    if retain_months is None:
+        return None
+    return add_months(month_start(utcnow()), -retain_months)
+
+def partition_name(month):
+    return f"measurement_p{month:%Y%m}"
+
+def is_partitioned(conn):
+    if conn.dialect.name != "postgresql":
+        return False
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('measurement')"
+    )).scalar() is not None
+
+def create_partition(conn, month):
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF measurement "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{add_months(month, 1):%Y-%m-%d}')"
+    ))
+    _known_months.add(month)
+
+def ensure_partitions(conn, first, count):
+    for i in range(count):
+        create_partition(conn, add_months(month_start(first), i))
+
+def ensure_partitions_for(times):
+    """
+    Makes sure every month in *times* has a partition before rows for it are
+    inserted. Uses its own autocommit connection so the brief lock taken on
+    the parent table isn't held by the ingest transaction.
+    """
+
+    months = {month_start(time) for time in times} - _known_months
+    if not months:
+        return
+    with db.engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        if not is_partitioned(conn):
+            # partitions setup hasn't been run yet
+            return
+        floor = legacy_bound(conn)
+        for month in sorted(months):
+            # rows before the first monthly partition go to the legacy one
+            if floor is None or month >= floor:
+                create_partition(conn, month)
+            else:
+                _known_months.add(month)
+
+def partition_bounds(conn):
+    """
+    Returns (name, upper bound) for every partition of measurement.
+    """
+
+    rows = conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'measurement'::regclass"
+    )).all()
+    bounds = []
+    for name, expr in rows:
+        match = re.search(r"TO \('([^']+)'\)", expr)
+        if match:
+            bounds.append((name, datetime.datetime.fromisoformat(match.group(1))))
+    return bounds
+
+def legacy_bound(conn):
+    for name, upper in partition_bounds(conn):
+        if name == LEGACY_TABLE:
+            return upper
+    return None
+
+def convert(conn, months_ahead):
+    """
+    Turns the plain measurement table into a table partitioned by month on
+    time, attaching the old table as the partition for everything before
+    the next month. The range check is validated before the short exclusive
+    lock is taken, so attaching doesn't scan the old table under it.
+    """
+
+    latest = conn.execute(text("SELECT max(time) FROM measurement")).scalar()
+    now = utcnow()
+    bound = add_months(month_start(max(latest or now, now)), 1)
+
+    conn.execute(text(
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS measurement_legacy_id_time_key "
+        "ON measurement (id, time)"
+    ))
+    conn.execute(text(
+        "ALTER TABLE measurement DROP CONSTRAINT IF EXISTS measurement_legacy_range"
+    ))
+    conn.execute(text(
+        "ALTER TABLE measurement ADD CONSTRAINT measurement_legacy_range "
+        f"CHECK (time < '{bound:%Y-%m-%d}') NOT VALID"
+    ))
+    conn.execute(text("ALTER TABLE measurement VALIDATE CONSTRAINT measurement_legacy_range"))
+
+    conn.execute(text("BEGIN"))
+    try:
+        conn.execute(text("LOCK TABLE measurement IN ACCESS EXCLUSIVE MODE"))
+        conn.execute(text(f"ALTER TABLE measurement RENAME TO {LEGACY_TABLE}"))
+        conn.execute(text(
+            f"ALTER TABLE {LEGACY_TABLE} "
+            "RENAME CONSTRAINT measurement_pkey TO measurement_legacy_pkey"
+        ))
+        conn.execute(text(
+            "ALTER INDEX IF EXISTS ix_measurement_sensor_time_id "
+            "RENAME TO measurement_legacy_sensor_time_id_idx"
+        ))
+        # the id sequence must outlive the legacy partition
+        conn.execute(text("ALTER SEQUENCE measurement_id_seq OWNED BY NONE"))
+        conn.execute(text(
+            f"CREATE TABLE measurement (LIKE {LEGACY_TABLE} INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (time)"
+        ))
+        conn.execute(text("ALTER TABLE measurement ADD PRIMARY KEY (id, time)"))
+        conn.execute(text(
+            "ALTER TABLE measurement ADD FOREIGN KEY (sensor_id) "
+            "REFERENCES sensor (id) ON DELETE SET NULL"
+        ))
+        conn.execute(text(
+            f"ALTER TABLE measurement ATTACH PARTITION {LEGACY_TABLE} "
+            f"FOR VALUES FROM (MINVALUE) TO ('{bound:%Y-%m-%d}')"
+        ))
+        # attaches the legacy table's matching index instead of rebuilding it
+        conn.execute(text(
+            "CREATE INDEX ix_measurement_sensor_time_id ON measurement (sensor_id, time, id)"
+        ))
+        ensure_partitions(conn, bound, months_ahead)
+        conn.execute(text("COMMIT"))
+    except Exception:
+        conn.execute(text("ROLLBACK"))
+        _known_months.clear()
+        raise
+
+def prune(conn, retain_months, echo=print):
+    """
+    Detaches and drops partitions whose whole range is older than
+    *retain_months* months before the current month, and invalidates every
+    cached page of the sensors that had rows in them.
+    """
+
+    cutoff = retention_cutoff(retain_months)
+    for name, upper in sorted(partition_bounds(conn), key=lambda bound: bound[1]):
+        if upper <= cutoff:
+            echo(f"Dropping {name} (before {upper:%Y-%m-%d})")
+            conn.execute(text(f"ALTER TABLE measurement DETACH PARTITION {name}"))
+            sensor_ids = conn.execute(text(
+                f"SELECT DISTINCT sensor_id FROM {name} WHERE sensor_id IS NOT NULL"
+            )).scalars().all()
+            conn.execute(text(f"DROP TABLE {name}"))
+            # complete pages are cached without expiry
+            for sensor_id in sensor_ids:
+                invalidate_pages(sensor_id, history=True)
+    _known_months.difference_update([month for month in _known_months if month < cutoff])
+
+
+def _postgres_connection():
+    if db.engine.dialect.name != "postgresql":
+        raise click.ClickException("Partitioning is only available on Postgres")
+    return db.engine.connect().execution_options(isolation_level="AUTOCOMMIT")
+
+@click.group("partitions")
+def partitions_command():
+    """Manage monthly measurement partitions (Postgres only)."""
+
+@partitions_command.command("setup")
+@with_appcontext
+def setup_command():
+    with _postgres_connection() as conn:
+        if is_partitioned(conn):
+            raise click.ClickException("measurement is already partitioned")
+        convert(conn, current_app.config["PARTITION_MONTHS_AHEAD"])
+
+@partitions_command.command("create")
+@with_appcontext
+def create_command():
+    with _postgres_connection() as conn:
+        if not is_partitioned(conn):
+            raise click.ClickException("measurement is not partitioned, run setup first")
+        now = utcnow()
+        floor = legacy_bound(conn)
+        ensure_partitions(
+            conn,
+            max(now, floor) if floor else now,
+            current_app.config["PARTITION_MONTHS_AHEAD"]
+        )
+
+@partitions_command.command("prune")
+@click.option("--retain-months", type=int, default=None)
+@with_appcontext
+def prune_command(retain_months):
+    if retain_months is None:
+        retain_months = current_app.config["MEASUREMENT_RETENTION_MONTHS"]
+    if retain_months is None:
+        raise click.ClickException("No retention set in MEASUREMENT_RETENTION_MONTHS")
+    with _postgres_connection() as conn:
+        if not is_partitioned(conn):
+            raise click.ClickException("measurement is not partitioned, run setup first")
+        prune(conn, retain_months, echo=click.echo)
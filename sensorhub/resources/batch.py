@@ -0,0 +1,243 @@
+import itertools
+from flask import Response, request, stream_with_context
+from flask_restful import Resource
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+from sqlalchemy import select
+from werkzeug.exceptions import BadRequest, UnsupportedMediaType
+from sensorhub import archive, db
+from sensorhub.constants import *
+from sensorhub.models import (
+    ArchiveSegment, Measurement, Rollup, Sensor, Stats, epoch, utcnow
+)
+from sensorhub.resources.measurement import (
+    AGGREGATES, bucket_item, parse_bucket, rollup_level
+)
+from sensorhub.serialization import dumps
+from sensorhub.utils import parse_timestamp, time_filter
+
+OPTIONAL_STRING = {"type": ["string", "null"]}
+batch_validator = Draft7Validator({
+    "type": "object",
+    "required": ["sensors"],
+    "properties": {
+        "sensors": {"type": "array", "items": {"type": "string"}},
+        "from": OPTIONAL_STRING,
+        "to": OPTIONAL_STRING,
+        "bucket": OPTIONAL_STRING,
+        "agg": {
+            "anyOf": [
+                OPTIONAL_STRING,
+                {"type": "array", "items": {"type": "string"}},
+            ]
+        },
+    },
+})
+
+
+class BatchRead(Resource):
+    """
+    Reads several sensors at once for dashboards. Takes the sensor names and
+    an optional [from, to) window, either as query arguments (sensors as a
+    comma separated list) or as a JSON object with POST, and returns for
+    each sensor its latest measurement in the window and its stats. With a
+    bucket length the document also carries a downsampled series per
+    sensor, with the aggregates listed in agg (mean by default), and from
+    is then required.
+
+    Everything comes from a couple of queries using IN over all of the
+    sensors instead of a request per sensor, and the document is streamed
+    as the series rows arrive. Names that don't exist are listed under
+    missing.
+    """
+
+    def get(self):
+        sensors = request.args.get("sensors")
+        return self._read({
+            "sensors": sensors.split(",") if sensors else [],
+            "from": request.args.get("from"),
+            "to": request.args.get("to"),
+            "bucket": request.args.get("bucket"),
+            "agg": request.args.get("agg"),
+        })
+
+    def post(self):
+        if not request.is_json:
+            raise UnsupportedMediaType
+        doc = request.get_json()
+        if not batch_validator.is_valid(doc):
+            error = best_match(batch_validator.iter_errors(doc))
+            raise BadRequest(description=error.message)
+        agg = doc.get("agg")
+        if isinstance(agg, list):
+            agg = ",".join(agg)
+        return self._read(dict(doc, agg=agg))
+
+    def _read(self, params):
+        names = list(dict.fromkeys(params["sensors"]))
+        if not names or not all(isinstance(name, str) for name in names):
+            raise BadRequest(description="List the sensors to read")
+        if len(names) > BATCH_SENSOR_LIMIT:
+            raise BadRequest(description=f"At most {BATCH_SENSOR_LIMIT} sensors per request")
+        start = parse_timestamp(params["from"]) if params.get("from") else None
+        end = parse_timestamp(params["to"]) if params.get("to") else None
+
+        body = {
+            "from": start,
+            "to": end,
+        }
+        series = None
+        if params.get("bucket"):
+            seconds = parse_bucket(params["bucket"])
+            aggs = (params.get("agg") or "mean").split(",")
+            if set(aggs) - set(AGGREGATES):
+                raise BadRequest(
+                    description="Aggregates must be some of: " + ", ".join(AGGREGATES)
+                )
+            if start is None:
+                raise BadRequest(description="A series needs a from time")
+            span = ((end or utcnow()) - start).total_seconds()
+            if span / seconds > AGGREGATE_PAGE_SIZE:
+                raise BadRequest(
+                    description=f"At most {AGGREGATE_PAGE_SIZE} buckets per series"
+                )
+            body["bucket"] = params["bucket"]
+            body["agg"] = aggs
+            series = (seconds, aggs)
+
+        sensors, archived = self._sensors(names, start, end)
+        body["missing"] = [name for name in names if name not in sensors]
+        head = dumps(body)[:-1] + b',"sensors":{'
+
+        def generate():
+            yield head
+            first = True
+            for name, doc in self._documents(sensors, archived, series, start, end):
+                yield (b"" if first else b",") + dumps(name) + b":" + dumps(doc)
+                first = False
+            yield b"}}"
+
+        return Response(stream_with_context(generate()), 200, mimetype=JSON)
+
+    def _sensors(self, names, start, end):
+        """
+        Returns a dict of the named sensors' ids and documents with their
+        latest measurement and stats, read with one query, and the set of
+        ids that have archived days.
+        """
+
+        # correlated per sensor, so each lookup is one index probe
+        latest = select(
+            Measurement.id
+        ).where(
+            Measurement.sensor_id == Sensor.id,
+            *time_filter(Measurement.time, start, end)
+        ).order_by(
+            Measurement.time.desc(), Measurement.id.desc()
+        ).limit(1).correlate(Sensor).scalar_subquery()
+        rows = db.session.execute(
+            select(
+                Sensor.id, Sensor.name, Measurement.time, Measurement.value, *Stats.row_columns()
+            ).outerjoin(
+                Stats, Stats.sensor_id == Sensor.id
+            ).outerjoin(
+                Measurement, Measurement.id == latest
+            ).where(
+                Sensor.name.in_(names)
+            )
+        ).all()
+
+        sensors = {}
+        for sensor_id, name, time, value, *stats in rows:
+            # stats columns are all None for sensors without stats
+            sensors[name] = (sensor_id, {
+                "latest": time and {"time": time, "value": value},
+                "stats": None if stats[0] is None else Stats.serialize_row(stats),
+            })
+        archived = set(db.session.scalars(
+            select(ArchiveSegment.sensor_id).where(
+                ArchiveSegment.sensor_id.in_([sensor_id for sensor_id, doc in sensors.values()])
+            ).distinct()
+        ))
+        for sensor_id, doc in sensors.values():
+            if doc["latest"] is None and sensor_id in archived:
+                # the window only covers archived days
+                columns = next(archive.read_range(sensor_id, start, end, descending=True), None)
+                if columns is not None:
+                    times, ids, values = columns
+                    doc["latest"] = {
+                        "time": times[0].item(),
+                        "value": values[0].item(),
+                    }
+        return sensors, archived
+
+    def _documents(self, sensors, archived, series, start, end):
+        """
+        Yields each sensor's name and document, with its series when one
+        was asked for. Series rows of all sensors come from one grouped
+        query, built from rollups where the bucket allows.
+        """
+
+        if series is None:
+            for name, (sensor_id, doc) in sensors.items():
+                yield name, doc
+            return
+
+        seconds, aggs = series
+        level = rollup_level(seconds, start, end)
+        if level is None:
+            sensor_column = Measurement.sensor_id
+            time_column = Measurement.time
+            columns = (
+                db.func.count(Measurement.value),
+                db.func.sum(Measurement.value),
+                db.func.min(Measurement.value),
+                db.func.max(Measurement.value),
+            )
+            conditions = []
+        else:
+            sensor_column = Rollup.sensor_id
+            time_column = Rollup.bucket
+            columns = (
+                db.func.sum(Rollup.count),
+                db.func.sum(Rollup.total),
+                db.func.min(Rollup.minimum),
+                db.func.max(Rollup.maximum),
+            )
+            conditions = [Rollup.resolution == level]
+
+        names = {sensor_id: name for name, (sensor_id, doc) in sensors.items()}
+        width = db.literal(seconds, literal_execute=True)
+        bucket = (epoch(time_column) // width * width).label("bucket")
+        query = select(
+            sensor_column, bucket, *columns
+        ).where(
+            sensor_column.in_(names), *conditions, *time_filter(time_column, start, end)
+        ).group_by(
+            sensor_column, bucket
+        ).order_by(
+            sensor_column, bucket
+        ).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+
+        def series_of(sensor_id, rows):
+            buckets = [archive.ArchivedBucket(*row[1:]) for row in rows]
+            if level is None and sensor_id in archived:
+                # rollups already include archived measurements, raw rows don't
+                merged = {row.bucket: row for row in buckets}
+                for row in archive.read_buckets(
+                    sensor_id, seconds, start, end, False, AGGREGATE_PAGE_SIZE
+                ):
+                    if row.bucket in merged:
+                        row = archive.combine_buckets(merged[row.bucket], row)
+                    merged[row.bucket] = row
+                buckets = sorted(merged.values(), key=lambda row: row.bucket)
+            return [bucket_item(row, aggs) for row in buckets]
+
+        # rows arrive grouped by sensor, each sensor is sent once complete
+        for sensor_id, rows in itertools.groupby(
+            db.session.execute(query), key=lambda row: row[0]
+        ):
+            name = names.pop(sensor_id)
+            yield name, dict(sensors[name][1], series=series_of(sensor_id, rows))
+        for sensor_id, name in names.items():
+            yield name, dict(sensors[name][1], series=series_of(sensor_id, ()))
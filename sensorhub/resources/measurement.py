@@ -1,10 +1,168 @@
+import datetime
+import hashlib
+import heapq
+import itertools
 import json
-from flask import request, Response, url_for
+import re
+from time import monotonic
+from jsonschema.exceptions import best_match
+from flask import current_app, request, Response, stream_with_context, url_for
 from flask_restful import Resource
-from sensorhub import cache
+from sqlalchemy import select, tuple_
+from werkzeug.exceptions import (
+    BadRequest, NotAcceptable, RequestEntityTooLarge, ServiceUnavailable,
+    UnsupportedMediaType
+)
+from sensorhub import archive, cache, db
 from sensorhub.constants import *
-from sensorhub.models import Measurement, Sensor
-from sensorhub.utils import page_key, require_sensor_key
+from sensorhub.ingest import (
+    first_expired, first_non_finite, ingest_measurements, measurement_rows,
+    measurement_validator
+)
+from sensorhub.instrumentation import serializing
+from sensorhub.live import format_frame, get_hub
+from sensorhub.models import EPOCH, Measurement, Rollup, Sensor, epoch
+from sensorhub.serialization import dumps
+from sensorhub.utils import (
+    decode_cursor, encode_cursor, page_key, page_versions, parse_timestamp,
+    require_sensor_key, time_filter
+)
+
+AGGREGATES = ("mean", "min", "max", "count", "sum")
+
+
+def parse_measurement_batch():
+    """
+    Reads the request body as a measurement batch. Accepts a JSON array (or a
+    single object) with application/json, or one object per line with
+    application/x-ndjson. Every item is validated before anything is written.
+    """
+
+    if request.mimetype == NDJSON:
+        try:
+            items = [
+                json.loads(line)
+                for line in request.get_data().splitlines()
+                if line.strip()
+            ]
+        except ValueError as e:
+            raise BadRequest(description=str(e))
+    elif request.mimetype == JSON:
+        items = request.get_json()
+        if isinstance(items, dict):
+            items = [items]
+        elif not isinstance(items, list):
+            raise BadRequest(description="Expected an object or an array of objects")
+    else:
+        raise UnsupportedMediaType
+
+    if len(items) > INGEST_BATCH_LIMIT:
+        raise RequestEntityTooLarge(
+            description=f"At most {INGEST_BATCH_LIMIT} measurements per request"
+        )
+
+    for i, item in enumerate(items):
+        if not measurement_validator.is_valid(item):
+            error = best_match(measurement_validator.iter_errors(item))
+            raise BadRequest(description=f"Item {i}: {error.message}")
+    non_finite = first_non_finite(items)
+    if non_finite is not None:
+        raise BadRequest(description=f"Item {non_finite}: value must be a finite number")
+    expired = first_expired(items)
+    if expired is not None:
+        raise BadRequest(description=f"Item {expired} is older than the retention period")
+    return items
+
+
+def keyset_page(query, order, seek_after, seek_before, cursor, sensor,
+                page_size=MEASUREMENT_PAGE_SIZE, combine=None):
+    """
+    Runs one page of *query* using keyset pagination driven by the after and
+    before request arguments. The cursor is turned into a WHERE condition by
+    seek_after or seek_before instead of skipping rows with OFFSET, so the
+    cost of a page does not depend on its depth. Returns the page rows in
+    ascending order and a dict of next/prev links that keep the other query
+    arguments.
+
+    *combine*, if given, is called with the fetched rows, the decoded after
+    and before cursors and the row limit, and returns the rows with those
+    from other sources merged in, in the same order.
+    """
+
+    after = request.args.get("after")
+    before = request.args.get("before")
+    after_key = decode_cursor(after) if after is not None else None
+    before_key = decode_cursor(before) if before is not None else None
+    if before is not None:
+        query = query.where(seek_before(before_key))
+        query = query.order_by(*(column.desc() for column in order))
+    else:
+        if after is not None:
+            query = query.where(seek_after(after_key))
+        query = query.order_by(*order)
+
+    # fetch one extra row to know whether there is another page
+    rows = db.session.execute(query.limit(page_size + 1)).all()
+    if combine is not None:
+        rows = combine(rows, after_key, before_key, page_size + 1)
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if before is not None:
+        rows.reverse()
+
+    args = {
+        key: value for key, value in request.args.items()
+        if key not in ("after", "before")
+    }
+    links = {"next": None, "prev": None}
+    if rows:
+        if more or before is not None:
+            links["next"] = url_for(
+                "api.measurementcollection", sensor=sensor, after=cursor(rows[-1]), **args
+            )
+        if (more and before is not None) or after is not None:
+            links["prev"] = url_for(
+                "api.measurementcollection", sensor=sensor, before=cursor(rows[0]), **args
+            )
+    return rows, links
+
+def parse_bucket(value):
+    match = re.fullmatch(r"([1-9][0-9]*)([smhd])", value)
+    if match is None:
+        raise BadRequest(description="Bucket must be a length like 30s, 5m, 1h or 1d")
+    return int(match.group(1)) * BUCKET_UNITS[match.group(2)]
+
+def bucket_item(row, aggs):
+    # row has the bucket start in epoch seconds and its count, total,
+    # minimum and maximum
+    values = {
+        "mean": row.total / row.count,
+        "min": row.minimum,
+        "max": row.maximum,
+        "count": row.count,
+        "sum": row.total,
+    }
+    item = {"time": EPOCH + datetime.timedelta(seconds=row.bucket)}
+    for name in aggs:
+        item[name] = values[name]
+    return item
+
+def rollup_level(seconds, start, end):
+    """
+    Returns the coarsest rollup resolution that *seconds* long buckets over
+    [start, end) can be built from, or None if they need raw rows.
+    """
+
+    return max(
+        (
+            res for res in ROLLUP_RESOLUTIONS.values()
+            if seconds % res == 0 and all(
+                bound is None or (bound - EPOCH).total_seconds() % res == 0
+                for bound in (start, end)
+            )
+        ),
+        default=None
+    )
 
 
 class MeasurementItem(Resource):
@@ -15,32 +173,371 @@ class MeasurementItem(Resource):
 
 class MeasurementCollection(Resource):
 
-    @cache.cached(timeout=None, make_cache_key=page_key, response_filter=lambda r: False)
     def get(self, sensor):
-        db_sensor = Sensor.query.filter_by(name=sensor).first()
-        if db_sensor is None:
-            raise NotFound
-        page = request.args.get("page", 0)
-        remaining = Measurement.query.filter_by(
-            sensor=db_sensor
-        ).order_by("time").offset(page * self.PAGE_SIZE)
-        body = {
-            "sensor": db_sensor.name,
-            "measurements": []
-        }
-        for meas in remaining.limit(self.PAGE_SIZE):
-            body["measurements"].append(
-                {
-                    "value": meas.value,
-                    "time": meas.time.isoformat()
-                }
-            )
-        response = Response(json.dumps(body), 200, mimetype=JSON)
-        if len(body["measurements"]) == self.PAGE_SIZE:
-            cache.set(page_key(), response, timeout=None)
+        history, tail = page_versions(sensor.id)
+        full_key = page_key() + f"[history_{history}]"
+        tail_key = full_key + f"[tail_{tail}]"
+        entry = next(
+            (entry for entry in cache.get_many(full_key, tail_key) if entry is not None),
+            None
+        )
+        if entry is None:
+            body = self._build_page(sensor)
+            with serializing():
+                data = dumps(body)
+            entry = (hashlib.blake2b(data, digest_size=16).hexdigest(), data)
+            # pages with more rows after them don't change when new
+            # measurements arrive, the tail page is versioned instead
+            if body["next"]:
+                cache.set(full_key, entry, timeout=current_app.config["PAGE_CACHE_TIMEOUT"])
+            else:
+                cache.set(tail_key, entry, timeout=current_app.config["PAGE_CACHE_TAIL_TIMEOUT"])
+
+        etag, data = entry
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(data, 200, mimetype=JSON)
+        response.set_etag(etag)
         return response
 
+    def _build_page(self, sensor):
+        start = request.args.get("from")
+        end = request.args.get("to")
+        start = parse_timestamp(start) if start else None
+        end = parse_timestamp(end) if end else None
+        resolution = request.args.get("resolution")
+        agg = request.args.get("agg")
+        bucket = request.args.get("bucket")
+
+        body = {"sensor": sensor.name}
+        if agg is not None or bucket is not None:
+            if agg is None or bucket is None or resolution is not None:
+                raise BadRequest(
+                    description="agg and bucket go together and exclude resolution"
+                )
+            body["agg"] = agg.split(",")
+            body["bucket"] = bucket
+            rows, links, items = self._aggregate_page(
+                sensor, body["agg"], parse_bucket(bucket), start, end
+            )
+        elif resolution is not None:
+            body["resolution"] = resolution
+            rows, links, items = self._rollup_page(sensor, resolution, start, end)
+        else:
+            rows, links, items = self._raw_page(sensor, start, end)
+
+        body["measurements"] = items
+        body.update(links)
+        return body
+
+    def _raw_page(self, sensor, start, end):
+        query = select(
+            Measurement.id, Measurement.time, Measurement.value
+        ).where(
+            Measurement.sensor_id == sensor.id,
+            *time_filter(Measurement.time, start, end)
+        )
+        key = tuple_(Measurement.time, Measurement.id)
+
+        def combine(rows, after, before, limit):
+            archived = archive.read_rows(sensor.id, start, end, after, before, limit)
+            if not archived:
+                return rows
+            return sorted(
+                itertools.chain(rows, archived),
+                key=lambda row: (row.time, row.id),
+                reverse=before is not None
+            )[:limit]
+
+        rows, links = keyset_page(
+            query,
+            order=(Measurement.time, Measurement.id),
+            seek_after=lambda cursor: key > tuple_(*cursor),
+            seek_before=lambda cursor: key < tuple_(*cursor),
+            cursor=lambda row: encode_cursor(row.time, row.id),
+            sensor=sensor,
+            combine=combine
+        )
+        # times are formatted by the encoder
+        items = [{"value": value, "time": time} for id, time, value in rows]
+        return rows, links, items
+
+    def _rollup_page(self, sensor, resolution, start, end):
+        # downsampled mode, served from the matching rollup level
+        try:
+            seconds = ROLLUP_RESOLUTIONS[resolution]
+        except KeyError:
+            raise BadRequest(
+                description="Resolution must be one of: " + ", ".join(ROLLUP_RESOLUTIONS)
+            )
+        query = select(
+            Rollup.bucket, Rollup.count, Rollup.total, Rollup.minimum, Rollup.maximum
+        ).where(
+            Rollup.sensor_id == sensor.id,
+            Rollup.resolution == seconds,
+            *time_filter(Rollup.bucket, start, end)
+        )
+        rows, links = keyset_page(
+            query,
+            order=(Rollup.bucket,),
+            seek_after=lambda cursor: Rollup.bucket > cursor[0],
+            seek_before=lambda cursor: Rollup.bucket < cursor[0],
+            cursor=lambda row: encode_cursor(row.bucket, seconds),
+            sensor=sensor
+        )
+        items = [
+            {
+                "time": bucket,
+                "count": count,
+                "mean": total / count,
+                "min": minimum,
+                "max": maximum
+            }
+            for bucket, count, total, minimum, maximum in rows
+        ]
+        return rows, links, items
+
+    def _aggregate_page(self, sensor, aggs, seconds, start, end):
+        """
+        Computes the requested aggregates per *seconds* long bucket in the
+        database with GROUP BY. When the bucket length is a multiple of a
+        rollup resolution and the time range is aligned to it, the buckets
+        are built from the rollups instead of raw rows.
+        """
+
+        unknown = set(aggs) - set(AGGREGATES)
+        if unknown:
+            raise BadRequest(
+                description="Aggregates must be some of: " + ", ".join(AGGREGATES)
+            )
+
+        level = rollup_level(seconds, start, end)
+        # every aggregate is derived from these so that buckets from the
+        # archive can be combined with those from the database
+        if level is None:
+            time_column = Measurement.time
+            columns = (
+                db.func.count(Measurement.value),
+                db.func.sum(Measurement.value),
+                db.func.min(Measurement.value),
+                db.func.max(Measurement.value),
+            )
+            conditions = [Measurement.sensor_id == sensor.id]
+        else:
+            time_column = Rollup.bucket
+            columns = (
+                db.func.sum(Rollup.count),
+                db.func.sum(Rollup.total),
+                db.func.min(Rollup.minimum),
+                db.func.max(Rollup.maximum),
+            )
+            conditions = [Rollup.sensor_id == sensor.id, Rollup.resolution == level]
+
+        # rendered inline so that the GROUP BY expression matches the
+        # selected one on servers that prepare statements
+        width = db.literal(seconds, literal_execute=True)
+        bucket = (epoch(time_column) // width * width).label("bucket")
+        query = select(
+            bucket, *columns
+        ).where(
+            *conditions, *time_filter(time_column, start, end)
+        ).group_by(bucket)
+        step = datetime.timedelta(seconds=seconds)
+
+        def combine(rows, after, before, limit):
+            rows = [archive.ArchivedBucket(*row) for row in rows]
+            if level is not None:
+                # rollups already include archived measurements
+                return rows
+            lo, hi = start, end
+            if after is not None:
+                lo = after[0] + step if lo is None else max(lo, after[0] + step)
+            if before is not None:
+                hi = before[0] if hi is None else min(hi, before[0])
+            archived = archive.read_buckets(
+                sensor.id, seconds, lo, hi, before is not None, limit
+            )
+            if not archived:
+                return rows
+            buckets = {row.bucket: row for row in rows}
+            for row in archived:
+                if row.bucket in buckets:
+                    row = archive.combine_buckets(buckets[row.bucket], row)
+                buckets[row.bucket] = row
+            return sorted(
+                buckets.values(), key=lambda row: row.bucket, reverse=before is not None
+            )[:limit]
+
+        # seek on the time column itself so the index can be used
+        rows, links = keyset_page(
+            query,
+            order=(bucket,),
+            seek_after=lambda cursor: time_column >= cursor[0] + step,
+            seek_before=lambda cursor: time_column < cursor[0],
+            cursor=lambda row: encode_cursor(
+                EPOCH + datetime.timedelta(seconds=row.bucket), seconds
+            ),
+            sensor=sensor,
+            page_size=AGGREGATE_PAGE_SIZE,
+            combine=combine
+        )
+        items = [bucket_item(row, aggs) for row in rows]
+        return rows, links, items
+
     @require_sensor_key
     def post(self, sensor):
-        return Response(501)
-        
+        items = parse_measurement_batch()
+        if current_app.config["INGEST_BUFFER"]:
+            # accepted once journaled, written with the next flush
+            from sensorhub.buffer import get_buffer
+            count = get_buffer().append(sensor.id, measurement_rows(sensor.id, items))
+            status = 202
+        else:
+            count = ingest_measurements(sensor, items)
+            status = 201
+        return Response(
+            json.dumps({"count": count}),
+            status,
+            headers={"Location": url_for("api.measurementcollection", sensor=sensor)},
+            mimetype=JSON
+        )
+
+
+class MeasurementExport(Resource):
+
+    FORMATS = {"ndjson": NDJSON, "csv": CSV}
+
+    def get(self, sensor):
+        fmt = request.args.get("format")
+        if fmt is None:
+            best = request.accept_mimetypes.best_match([NDJSON, CSV], default=NDJSON)
+            fmt = "csv" if best == CSV else "ndjson"
+        if fmt not in self.FORMATS:
+            raise NotAcceptable(description="Supported formats: ndjson, csv")
+
+        query = select(
+            Measurement.time, Measurement.id, Measurement.value
+        ).where(
+            Measurement.sensor_id == sensor.id
+        ).order_by(
+            Measurement.time, Measurement.id
+        ).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+
+        def chunks():
+            # yield_per streams with a server-side cursor where the driver
+            # supports one, so only one chunk of rows is held at a time
+            results = db.session.execute(query).partitions()
+            if not archive.segments(sensor.id):
+                yield from results
+                return
+            rows = heapq.merge(
+                itertools.chain.from_iterable(results),
+                archive.iter_rows(sensor.id),
+                key=lambda row: (row[0], row[1])
+            )
+            while chunk := list(itertools.islice(rows, EXPORT_CHUNK_SIZE)):
+                yield chunk
+
+        def generate():
+            if fmt == "csv":
+                yield "time,value\n"
+                for chunk in chunks():
+                    yield "".join(
+                        f"{time.isoformat()},{value!r}\n" for time, id, value in chunk
+                    )
+            else:
+                for chunk in chunks():
+                    yield "".join(
+                        json.dumps({"time": time.isoformat(), "value": value}) + "\n"
+                        for time, id, value in chunk
+                    )
+
+        return Response(
+            stream_with_context(generate()),
+            200,
+            mimetype=self.FORMATS[fmt],
+            headers={
+                "Content-Disposition": f"attachment; filename={sensor.name}.{fmt}"
+            }
+        )
+
+
+class MeasurementLive(Resource):
+
+    def get(self, sensor):
+        """
+        Streams measurements of *sensor* as Server-Sent Events as they are
+        ingested, one "measurements" event per batch with the cursor of its
+        latest row as the event id. A client reconnecting with Last-Event-ID
+        first gets what it missed from the database, oldest first. When that
+        is more than LIVE_BACKFILL_LIMIT rows the stream ends after the
+        first LIVE_BACKFILL_LIMIT, to continue from there. Streams end after
+        LIVE_MAX_DURATION seconds or when the client falls too far behind,
+        and are expected to reconnect. A worker that already has
+        LIVE_MAX_STREAMS open answers 503.
+        """
+
+        # subscribe before querying so that nothing falls between the two
+        subscription = get_hub().subscribe(sensor.id)
+        if subscription is None:
+            raise ServiceUnavailable(
+                description="Too many live streams, try again later",
+                retry_after=LIVE_BUSY_RETRY_AFTER
+            )
+        backfill = None
+        backfilled = set()
+        truncated = False
+        last_event = request.headers.get("Last-Event-ID")
+        if last_event:
+            try:
+                since = decode_cursor(last_event)
+            except BadRequest:
+                subscription.close()
+                raise
+            key = tuple_(Measurement.time, Measurement.id)
+            rows = db.session.execute(
+                select(Measurement.time, Measurement.id, Measurement.value).where(
+                    Measurement.sensor_id == sensor.id,
+                    key > tuple_(*since)
+                ).order_by(
+                    Measurement.time, Measurement.id
+                ).limit(LIVE_BACKFILL_LIMIT)
+            ).all()
+            if rows:
+                backfill = format_frame([
+                    {"time": time, "id": id, "value": value} for time, id, value in rows
+                ])[1]
+                backfilled = {id for time, id, value in rows}
+                truncated = len(rows) == LIVE_BACKFILL_LIMIT
+
+        def generate():
+            try:
+                yield f"retry: {LIVE_RETRY}\n\n"
+                if backfill:
+                    yield backfill
+                if truncated:
+                    return
+                deadline = monotonic() + LIVE_MAX_DURATION
+                while (remaining := deadline - monotonic()) > 0:
+                    event = subscription.get(min(LIVE_KEEPALIVE, remaining))
+                    if subscription.overflowed:
+                        return
+                    if event is None:
+                        yield ": keepalive\n\n"
+                    elif event[0][1] not in backfilled:
+                        # batches already covered by the backfill are skipped,
+                        # those of late rows are not
+                        yield event[1]
+            finally:
+                subscription.close()
+
+        # the stream holds no app context or database connection
+        response = Response(
+            generate(),
+            200,
+            mimetype=EVENT_STREAM,
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+        response.call_on_close(subscription.close)
+        return response
@@ -1,11 +1,13 @@
-import json
 from jsonschema import validate, ValidationError
-from flask import Response, request, url_for
+from flask import Response, request, stream_with_context, url_for
 from flask_restful import Resource
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import UnsupportedMediaType, NotFound, Conflict, BadRequest
-from sensorhub.models import Sensor
+from sensorhub.models import Location, Sensor
 from sensorhub import db
+from sensorhub.instrumentation import serializing
+from sensorhub.serialization import dumps
 from sensorhub.utils import require_admin
 from sensorhub.constants import *
 
@@ -14,12 +16,45 @@ class SensorCollection(Resource):
 
     @require_admin
     def get(self):
-        body = {"items": []}
-        for db_sensor in Sensor.query.all():
-            item = db_sensor.serialize(short_form=True)
-            body["items"].append(item)
+        """
+        Lists sensors in name order, SENSOR_PAGE_SIZE at a time, with a next
+        link that continues after the last name. Only the columns of the
+        short form are selected, with the location joined in, and the
+        document is streamed as the rows arrive.
+        """
 
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        query = select(
+            *Sensor.row_columns(short_form=True)
+        ).outerjoin(
+            Sensor.location
+        ).order_by(
+            Sensor.name
+        ).limit(
+            SENSOR_PAGE_SIZE + 1
+        ).execution_options(yield_per=EXPORT_CHUNK_SIZE)
+        after = request.args.get("after")
+        if after is not None:
+            query = query.where(Sensor.name > after)
+
+        def generate():
+            yield b'{"items": ['
+            count = 0
+            more = False
+            for chunk in db.session.execute(query).partitions():
+                # one row more than a page is fetched to know if there's a next one
+                if count + len(chunk) > SENSOR_PAGE_SIZE:
+                    chunk = chunk[:SENSOR_PAGE_SIZE - count]
+                    more = True
+                if chunk:
+                    yield (b"," if count else b"") + b",".join(
+                        dumps(Sensor.serialize_row(row, short_form=True)) for row in chunk
+                    )
+                    count += len(chunk)
+                    last = chunk[-1][0]
+            next_url = url_for("api.sensorcollection", after=last) if more else None
+            yield b'], "next": ' + dumps(next_url) + b"}"
+
+        return Response(stream_with_context(generate()), 200, mimetype=JSON)
 
     def post(self):
         raise NotImplementedError
@@ -27,8 +62,9 @@ class SensorCollection(Resource):
 class SensorItem(Resource):
 
     def get(self, sensor):
-        body = sensor.serialize()
-        return Response(json.dumps(body), 200, mimetype=JSON)
+        with serializing():
+            data = dumps(sensor.serialize())
+        return Response(data, 200, mimetype=JSON)
 
     def put(self, sensor):
         if not request.json:
@@ -2,23 +2,45 @@ import json
 from jsonschema import validate, ValidationError, draft7_format_checker
 from flask import Response, current_app, request, url_for
 from flask_restful import Resource
+from sqlalchemy import select
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import UnsupportedMediaType, NotFound, Conflict, BadRequest
-from sensorhub.models import Stats
-from sensorhub import db
-from sensorhub.utils import get_rabbit_connection
+from sensorhub.models import Measurement, Stats, StatsTask
+from sensorhub import archive, cache, db
+from sensorhub.instrumentation import serializing
+from sensorhub.serialization import dumps
+from sensorhub.utils import get_publisher
 from sensorhub.constants import *
 
 
+def pending_key(sensor):
+    return f"stats-task[{sensor.id}]"
+
+
 class SensorStats(Resource):
 
     def get(self, sensor):
         if sensor.stats:
-            body = sensor.stats.serialize()
-            return Response(json.dumps(body), 200, mimetype=JSON)
+            with serializing():
+                data = dumps(sensor.stats.serialize())
+            return Response(data, 200, mimetype=JSON)
         else:
-            self._send_task(sensor)
-            return Response(status=202)
+            # single flight: only the request that sets the pending marker
+            # dispatches a task, the rest are pointed at the same result
+            marker = pending_key(sensor)
+            if cache.add(marker, True, timeout=STATS_TASK_TTL):
+                try:
+                    self._send_task(sensor)
+                except Exception:
+                    cache.delete(marker)
+                    raise
+            return Response(
+                status=202,
+                headers={
+                    "Location": url_for("api.sensorstats", sensor=sensor),
+                    "Retry-After": str(STATS_RETRY_AFTER)
+                }
+            )
 
     def put(self, sensor):
         if not request.json:
@@ -34,34 +56,43 @@ class SensorStats(Resource):
             print(e)
             raise BadRequest(description=str(e))
 
-        stats = Stats()
+        # updated in place, the row usually exists since the first ingest
+        stats = sensor.stats or Stats(sensor=sensor)
         stats.deserialize(request.json)
-        sensor.stats = stats
-        db.session.add(sensor)
+        db.session.add(stats)
         db.session.commit()
+        cache.delete(pending_key(sensor))
         return Response(status=204)
 
     def delete(self, sensor):
         db.session.delete(sensor.stats)
         db.session.commit()
+        cache.delete(pending_key(sensor))
         return Response(status=204)
 
     def _send_task(self, sensor):
-        # get sensor measurements, values only
-        body = {
-            "data": [meas.value for meas in sensor.measurements],
-            "sensor": sensor.name
-        }
+        # stats are normally kept current on ingest; this only runs for
+        # sensors whose history predates them
+        if current_app.config["STATS_TASK_BACKEND"] == "db":
+            try:
+                db.session.add(StatsTask(sensor_id=sensor.id))
+                db.session.commit()
+            except IntegrityError:
+                # already queued
+                db.session.rollback()
+            return
 
-        # form a connection, open channel and declare a queue
-        connection = get_rabbit_connection()
-        channel = connection.channel()
-        channel.queue_declare(queue="stats")
+        body = {"sensor": sensor.name}
+        if current_app.config["STATS_TASK_DATA"]:
+            # only external consumers need the values, the built-in worker
+            # reads them from the database. Read the value column only
+            # instead of hydrating every Measurement.
+            body["data"] = db.session.scalars(
+                select(Measurement.value).where(Measurement.sensor_id == sensor.id)
+            ).all()
+            for times, ids, values in archive.read_range(sensor.id):
+                body["data"].extend(values.tolist())
 
-        # publish message (task) to the default exchange
-        channel.basic_publish(
-            exchange="",
-            routing_key="stats",
-            body=json.dumps(body)
-        )
-        connection.close()
+        # publish message (task) to the default exchange over this worker's
+        # long-lived connection
+        get_publisher().publish("stats", json.dumps(body))
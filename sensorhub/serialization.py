@@ -0,0 +1,37 @@
+"""
+JSON encoding of API responses. dumps() uses orjson, pinned in
+requirements.txt, or the standard library when it is not installed, and
+returns bytes either way so that the result can be cached and sent as is.
+
+Documents may carry timestamps as datetime objects. orjson formats them
+natively without calling back into Python; the standard library path
+formats them with isoformat(). Both produce the same text for the naive
+UTC times stored here, so documents are built straight from the selected
+column values without formatting each timestamp first.
+"""
+
+import datetime
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+_encoder = json.JSONEncoder(
+    separators=(",", ":"), default=_default, check_circular=False
+)
+
+def stdlib_dumps(obj):
+    return _encoder.encode(obj).encode()
+
+if orjson is not None:
+    dumps = orjson.dumps
+else:
+    dumps = stdlib_dumps
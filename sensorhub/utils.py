@@ -1,41 +1,217 @@
+import base64
+import datetime
 import json
+import os
 import secrets
 import ssl
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+from urllib.parse import urlencode
 from flask import Response, current_app, request, url_for
 import pika
-from werkzeug.exceptions import Forbidden, NotFound
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound
 from werkzeug.routing import BaseConverter
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, joinedload, object_session
 
+from sensorhub import cache, db
 from sensorhub.constants import *
 from sensorhub.models import *
 
 def page_key(*args, **kwargs):
-    start = request.args.get("start", 0)
-    return request.path + f"[start_{start}]"
+    # cursor, resolution and any other query argument all select the page
+    return request.path + "?" + urlencode(sorted(request.args.items(multi=True)))
+
+def page_versions(sensor_id):
+    """
+    Returns the sensor's (history, tail) page cache versions. Complete pages
+    are cached under the history version only, the tail page under both. A
+    version that has been evicted from the cache is replaced with a new one
+    so that pages cached under the old one can't be served again.
+    """
+
+    keys = (f"page-version[{sensor_id}][history]", f"page-version[{sensor_id}][tail]")
+    versions = cache.get_many(*keys)
+    for i, version in enumerate(versions):
+        if version is None:
+            cache.add(keys[i], secrets.token_hex(8), timeout=0)
+            versions[i] = cache.get(keys[i])
+    return tuple(versions)
+
+def invalidate_pages(sensor_id, history=False):
+    cache.set(f"page-version[{sensor_id}][tail]", secrets.token_hex(8), timeout=0)
+    if history:
+        cache.set(f"page-version[{sensor_id}][history]", secrets.token_hex(8), timeout=0)
+
+def encode_cursor(time, id):
+    token = f"{time.isoformat()},{id}".encode()
+    return base64.urlsafe_b64encode(token).decode().rstrip("=")
+
+def decode_cursor(token):
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        time, id = raw.rsplit(",", 1)
+        return datetime.datetime.fromisoformat(time), int(id)
+    except ValueError:
+        raise BadRequest(description="Invalid pagination cursor")
     
+def parse_timestamp(value):
+    """
+    Parses an ISO 8601 query argument into naive UTC, like stored times.
+    """
+
+    try:
+        time = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise BadRequest(description=f"Invalid timestamp: {value}")
+    if time.tzinfo is not None:
+        time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return time
+
+def time_filter(column, start=None, end=None):
+    # half-open [start, end) range, either end may be left out
+    conditions = []
+    if start is not None:
+        conditions.append(column >= start)
+    if end is not None:
+        conditions.append(column < end)
+    return conditions
+
 def require_admin(func):
     def wrapper(*args, **kwargs):
-        key_hash = ApiKey.key_hash(request.headers.get("Sensorhub-Api-Key", "").strip())
-        db_key = ApiKey.query.filter_by(admin=True).first()
-        if secrets.compare_digest(key_hash, db_key.key):
+        grant = get_key_grant()
+        if grant is not None and grant.admin:
             return func(*args, **kwargs)
         raise Forbidden
     return wrapper
 
 def require_sensor_key(func):
     def wrapper(self, sensor, *args, **kwargs):
-        key_hash = ApiKey.key_hash(request.headers.get("Sensorhub-Api-Key").strip())
-        db_key = ApiKey.query.filter_by(sensor=sensor).first()
-        if db_key is not None and secrets.compare_digest(key_hash, db_key.key):
-            return func(*args, **kwargs)
+        grant = get_key_grant()
+        if grant is not None and grant.sensor_id == sensor.id:
+            return func(self, sensor, *args, **kwargs)
         raise Forbidden
     return wrapper
 
+def auth_version():
+    """
+    Returns the version of API keys in the shared cache, which changes
+    whenever a key is added, changed or revoked in any process. Like page
+    versions, an evicted version is replaced with a new one.
+    """
+
+    version = cache.get("auth-version")
+    if version is None:
+        cache.add("auth-version", secrets.token_hex(8), timeout=0)
+        version = cache.get("auth-version")
+    return version
+
+def get_key_grant():
+    """
+    Resolves the request's API key into a KeyGrant, or None if the key is
+    unknown. Verified keys are remembered in auth_cache so that repeat
+    requests skip the database, along with the auth_version() they were
+    read under. A remembered grant is only used while that version is
+    current, so a key revoked in another worker or with flask revokekey
+    stops working at once on every process sharing the cache. Processes
+    that don't share it can use a revoked key for up to AUTH_CACHE_TTL
+    seconds.
+    """
+
+    key_hash = ApiKey.key_hash(request.headers.get("Sensorhub-Api-Key", "").strip())
+    version = auth_version()
+    cached = auth_cache.get(key_hash)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    db_key = db.session.get(ApiKey, key_hash)
+    if db_key is None:
+        return None
+    grant = KeyGrant(db_key.admin, db_key.sensor_id)
+    auth_cache.set(key_hash, (version, grant))
+    return grant
+
+
+class TTLCache:
+    """
+    Small in-process LRU cache whose entries also expire after *ttl* seconds.
+    Each gunicorn worker has its own instance, so the TTL bounds how long a
+    change made in another process can go unnoticed.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return None
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+KeyGrant = namedtuple("KeyGrant", ["admin", "sensor_id"])
+auth_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+@event.listens_for(ApiKey, "after_insert")
+@event.listens_for(ApiKey, "after_update")
+@event.listens_for(ApiKey, "after_delete")
+def invalidate_key_grant(mapper, connection, target):
+    auth_cache.discard(target.key)
+    object_session(target).info["api_keys_changed"] = True
+
+@event.listens_for(Session, "after_commit")
+def publish_key_changes(session):
+    # only once committed, so that no process can read the old key again and
+    # remember it under the new version
+    if session.info.pop("api_keys_changed", False):
+        cache.set("auth-version", secrets.token_hex(8), timeout=0)
+
+@event.listens_for(Session, "after_rollback")
+def discard_key_changes(session):
+    session.info.pop("api_keys_changed", None)
+
 
 class SensorConverter(BaseConverter):
-    
+    """
+    Resolves sensor names in URLs to Sensor instances. Routes can name the
+    relationships their resource needs with the load argument, e.g.
+    <sensor(load="location"):sensor>, to have them loaded in the same query.
+    """
+
+    def __init__(self, map, load=""):
+        super().__init__(map)
+        self.options = [
+            joinedload(getattr(Sensor, name)) for name in load.split(",") if name
+        ]
+
     def to_python(self, sensor_name):
-        db_sensor = Sensor.query.filter_by(name=sensor_name).first()
+        db_sensor = db.session.scalars(
+            select(Sensor).filter_by(name=sensor_name).options(*self.options)
+        ).first()
         if db_sensor is None:
             raise NotFound
         return db_sensor
@@ -71,3 +247,104 @@ def get_rabbit_connection():
         )
     return pika.BlockingConnection(conn_params)
 
+
+def get_publisher():
+    """
+    Returns this worker's RabbitPublisher, creating it on first use.
+    """
+
+    publisher = current_app.extensions.get("rabbit_publisher")
+    if publisher is None:
+        publisher = current_app.extensions["rabbit_publisher"] = RabbitPublisher(
+            get_rabbit_connection,
+            confirm=current_app.config["RABBITMQ_CONFIRM"]
+        )
+    return publisher
+
+
+class RabbitPublisher:
+    """
+    Long-lived publisher that keeps one connection and channel open per
+    worker process. The connection is opened lazily, reopened after it has
+    been lost or the process has forked, and each queue is declared once per
+    connection. With *confirm* set, publishes wait for the broker's ack and
+    raise NackError or UnroutableError if it refuses them.
+
+    A publish that fails on a lost connection is retried once on a new one
+    with the bodies that had not been published yet. Without *confirm* a
+    body is published once it has been written to the socket, so bodies
+    written just before the connection was lost can be lost with it.
+    """
+
+    RETRY_ERRORS = (
+        pika.exceptions.AMQPConnectionError,
+        pika.exceptions.ChannelClosed,
+        pika.exceptions.ChannelWrongStateError,
+    )
+
+    def __init__(self, connect, confirm=True):
+        self._connect = connect
+        self._confirm = confirm
+        self._lock = threading.Lock()
+        self._pid = None
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+
+    def publish(self, queue, body):
+        self.publish_many(queue, [body])
+
+    def publish_many(self, queue, bodies):
+        pending = deque(bodies)
+        with self._lock:
+            try:
+                self._publish(queue, pending)
+            except self.RETRY_ERRORS:
+                # most likely a connection that timed out while idle,
+                # reconnect once before giving up
+                self._disconnect()
+                self._publish(queue, pending)
+
+    def close(self):
+        with self._lock:
+            self._disconnect()
+
+    def _publish(self, queue, pending):
+        # bodies are taken off *pending* once the broker has them
+        channel = self._get_channel()
+        if queue not in self._declared:
+            channel.queue_declare(queue=queue)
+            self._declared.add(queue)
+        while pending:
+            channel.basic_publish(exchange="", routing_key=queue, body=pending[0])
+            pending.popleft()
+
+    def _disconnect(self):
+        if self._connection is not None and self._pid == os.getpid():
+            try:
+                self._connection.close()
+            except (pika.exceptions.AMQPError, OSError):
+                # already closed or lost
+                pass
+        self._reset()
+
+    def _get_channel(self):
+        if self._pid != os.getpid():
+            # connections can't be shared with a forked parent
+            self._reset()
+        if self._connection is None or self._connection.is_closed:
+            self._reset()
+            self._connection = self._connect()
+            self._pid = os.getpid()
+        if self._channel is None or self._channel.is_closed:
+            self._channel = self._connection.channel()
+            if self._confirm:
+                self._channel.confirm_delivery()
+            self._declared = set()
+        return self._channel
+
+    def _reset(self):
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+        self._pid = None
@@ -0,0 +1,190 @@
+import datetime
+import json
+import multiprocessing
+import time
+import numpy as np
+import pika
+from flask import current_app
+from sqlalchemy import delete, select
+from sensorhub import cache, create_app, db
+from sensorhub.constants import *
+from sensorhub.models import Measurement, Sensor, Stats, StatsTask, utcnow
+from sensorhub.utils import get_rabbit_connection
+
+QUEUE = "stats"
+FAILED_QUEUE = "stats.failed"
+
+
+def compute_stats(sensor_id, task_id=None):
+    """
+    Recomputes a sensor's running stats from its full history and writes
+    them directly. Values are streamed from the database in chunks and each
+    chunk is reduced with NumPy, so memory use is bounded by the chunk size.
+    Archived days are merged in from their stored aggregates. The StatsTask
+    *task_id*, if given, is deleted in the same transaction.
+    """
+
+    stats = Stats.lock(sensor_id)
+    stats.count = 0
+    stats.mean = stats.m2 = 0.0
+    stats.minimum = stats.maximum = stats.last = None
+
+    query = select(
+        Measurement.value, Measurement.time
+    ).where(
+        Measurement.sensor_id == sensor_id
+    ).execution_options(yield_per=STATS_CHUNK_SIZE)
+    with db.session.no_autoflush:
+        for chunk in db.session.execute(query).partitions():
+            values = np.fromiter(
+                (row[0] for row in chunk), dtype=np.float64, count=len(chunk)
+            )
+            mean = values.mean()
+            stats.merge(
+                len(values),
+                float(mean),
+                float(np.square(values - mean).sum()),
+                float(values.min()),
+                float(values.max()),
+                max(row[1] for row in chunk)
+            )
+        stats.merge_archived()
+    stats.generated = utcnow()
+    if task_id is not None:
+        db.session.execute(delete(StatsTask).where(StatsTask.id == task_id))
+    db.session.commit()
+    cache.delete(f"stats-task[{sensor_id}]")
+    return sensor_id
+
+def _init_process(config):
+    # each pool process gets its own app, and with it its own DB engine
+    global _app_context
+    _app_context = create_app(config).app_context()
+    _app_context.push()
+
+def _run_task(task):
+    sensor_id, task_id = task
+    try:
+        return compute_stats(sensor_id, task_id)
+    except Exception:
+        db.session.rollback()
+        current_app.logger.exception("Stats task for sensor %s failed", sensor_id)
+        return None
+
+def claim_db_tasks(limit):
+    """
+    Claims up to *limit* pending tasks in the StatsTask table for
+    STATS_TASK_LEASE seconds and returns their (sensor id, task id) pairs.
+    Rows are locked with SKIP LOCKED where supported so several workers can
+    share the table. A task is deleted by compute_stats once it succeeds; if
+    it fails or the worker dies, it is claimed again when the lease expires.
+    """
+
+    now = utcnow()
+    tasks = db.session.scalars(
+        select(StatsTask).where(
+            StatsTask.claimed_until.is_(None) | (StatsTask.claimed_until < now)
+        ).order_by(
+            StatsTask.created
+        ).limit(limit).with_for_update(skip_locked=True)
+    ).all()
+    for task in tasks:
+        task.claimed_until = now + datetime.timedelta(seconds=STATS_TASK_LEASE)
+    db.session.commit()
+    return [(task.sensor_id, task.id) for task in tasks]
+
+def resolve_queue_tasks(channel, deliveries):
+    """
+    Resolves a batch of (method, body) stats task deliveries. Returns a dict
+    of the ids of the sensors they name to their deliveries. Malformed
+    bodies are rejected without requeueing, as they would only be
+    redelivered, and tasks for sensors that don't exist are acked.
+    """
+
+    by_name = {}
+    for method, body in deliveries:
+        try:
+            name = json.loads(body)["sensor"]
+            by_name.setdefault(name, []).append((method, body))
+        except (ValueError, TypeError, KeyError) as e:
+            current_app.logger.warning("Rejected stats task message: %r", e)
+            channel.basic_reject(method.delivery_tag, requeue=False)
+    tasks = {}
+    for sensor_id, name in db.session.execute(
+        select(Sensor.id, Sensor.name).where(Sensor.name.in_(by_name))
+    ):
+        tasks[sensor_id] = by_name.pop(name)
+    for name, unknown in by_name.items():
+        for method, body in unknown:
+            channel.basic_ack(method.delivery_tag)
+    return tasks
+
+def settle_queue_tasks(channel, tasks, results):
+    """
+    Settles the deliveries of *tasks*, as returned by resolve_queue_tasks(),
+    given the results of _run_task() for each sensor in the same order.
+    Those of computed stats are acked. Failed ones are requeued the first
+    time and moved to FAILED_QUEUE when they fail again after redelivery.
+    """
+
+    for deliveries, result in zip(tasks.values(), results):
+        for method, body in deliveries:
+            if result is not None:
+                channel.basic_ack(method.delivery_tag)
+            elif not method.redelivered:
+                channel.basic_nack(method.delivery_tag, requeue=True)
+            else:
+                current_app.logger.error(
+                    "Moved a stats task that failed repeatedly to %s", FAILED_QUEUE
+                )
+                channel.basic_publish(
+                    exchange="",
+                    routing_key=FAILED_QUEUE,
+                    body=body,
+                    properties=pika.BasicProperties(delivery_mode=2)
+                )
+                channel.basic_ack(method.delivery_tag)
+
+def run_worker(source, processes, once=False, channel=None):
+    """
+    Runs the stats worker loop. Tasks are read from the StatsTask table
+    (source "db") or from the stats queue (source "queue") and computed in a
+    pool of *processes* worker processes. With *once* set, returns after the
+    source has been drained instead of polling forever.
+    """
+
+    config = dict(current_app.config)
+    batch_size = processes * 4
+    with multiprocessing.get_context("spawn").Pool(
+        processes, initializer=_init_process, initargs=(config,)
+    ) as pool:
+        if source == "db":
+            while True:
+                tasks = claim_db_tasks(batch_size)
+                if tasks:
+                    pool.map(_run_task, tasks)
+                elif once:
+                    return
+                else:
+                    time.sleep(STATS_WORKER_POLL)
+        else:
+            if channel is None:
+                channel = get_rabbit_connection().channel()
+            channel.queue_declare(queue=QUEUE)
+            channel.queue_declare(queue=FAILED_QUEUE, durable=True)
+            channel.basic_qos(prefetch_count=batch_size)
+            deliveries = []
+            for method, properties, body in channel.consume(
+                QUEUE, inactivity_timeout=STATS_WORKER_POLL
+            ):
+                if method is not None:
+                    deliveries.append((method, body))
+                if deliveries and (method is None or len(deliveries) >= batch_size):
+                    tasks = resolve_queue_tasks(channel, deliveries)
+                    db.session.commit()
+                    results = pool.map(_run_task, [(sensor_id, None) for sensor_id in tasks])
+                    settle_queue_tasks(channel, tasks, results)
+                    deliveries = []
+                elif method is None and once:
+                    channel.cancel()
+                    return
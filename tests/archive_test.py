@@ -0,0 +1,140 @@
+import json
+import os
+import pytest
+import tempfile
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from sensorhub import create_app, db
+from sensorhub.archive import encode_segment, read_segment
+from sensorhub.ingest import ingest_measurements
+from sensorhub.models import ArchiveSegment, Measurement, Sensor, Stats
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    with app.app_context():
+        sensor = Sensor(name="archived", model="testsensor")
+        db.session.add(sensor)
+        db.session.commit()
+        start = datetime(2024, 5, 1, 23)
+        # spans four days, some with values that need float64
+        items = [
+            {
+                "value": i * 0.5 if i < 80 or i >= 160 else i * 0.1,
+                "time": (start + timedelta(minutes=i * 15)).isoformat() + "Z"
+            }
+            for i in range(240)
+        ]
+        ingest_measurements(sensor, items)
+        ingest_measurements(sensor, [{"value": 1.0}])
+    return app
+
+def _walk(client, url, link="next"):
+    pages = []
+    while url:
+        body = client.get(url).json
+        pages.append(body)
+        url = body[link]
+    return pages
+
+def _snapshot(client):
+    base = "/api/sensors/archived/measurements/"
+    pages = _walk(client, base)
+    return {
+        "raw": [item for page in pages for item in page["measurements"]],
+        "backwards": [
+            page["measurements"] for page in _walk(client, pages[-1]["prev"], "prev")
+        ],
+        "agg": client.get(base + "?agg=mean,min,max,count&bucket=7m").json,
+        "rollup": client.get(base + "?agg=sum,count&bucket=1h").json,
+        "export": client.get(base + "export").data,
+        "batch": client.get(
+            "/api/batch/?sensors=archived&agg=mean,count&bucket=7m"
+            "&from=2024-05-01T23:00:00&to=2024-05-03T00:00:00"
+        ).json,
+    }
+
+
+def test_encoding():
+    times = np.array(
+        ["2024-01-01T00:00:00", "2024-01-01T00:00:00.5", "2024-01-01T23:59:59"],
+        dtype="datetime64[us]"
+    )
+    ids = np.array([70000, 3, 4])
+    exact = encode_segment(times, ids, np.array([0.5, 1.0, -2.0]))
+    inexact = encode_segment(times, ids, np.array([0.1, 1.0, -2.0]))
+    assert len(exact) < len(inexact)
+
+    with tempfile.TemporaryDirectory() as archive_dir:
+        app = create_app({"ARCHIVE_DIR": archive_dir, "CACHE_TYPE": "NullCache"})
+        with open(os.path.join(archive_dir, "segment.col"), "wb") as f:
+            f.write(inexact)
+        with app.app_context():
+            read_times, read_ids, values = read_segment("segment.col")
+    assert (read_times == times).all()
+    assert read_ids.tolist() == ids.tolist()
+    assert values.tolist() == [0.1, 1.0, -2.0]
+
+
+class TestArchive(object):
+
+    def test_archive(self, app):
+        """
+        Archives all but the most recent measurement and checks that pages,
+        aggregates, exports, batch reads and stats come out the same as
+        before.
+        """
+
+        client = app.test_client()
+        before = _snapshot(client)
+        with app.app_context():
+            stats = Stats.query.first().serialize()
+
+        result = app.test_cli_runner().invoke(args=["archive", "--days", "1"])
+        assert result.exit_code == 0
+        assert "Archived 240 measurements" in result.output
+
+        with app.app_context():
+            assert Measurement.query.count() == 1
+            assert ArchiveSegment.query.count() == 4
+            assert _snapshot(client) == before
+
+            # stats rebuilt from scratch include the archived days
+            db.session.delete(Stats.query.first())
+            db.session.commit()
+            sensor = Sensor.query.first()
+            rebuilt = Stats(sensor_id=sensor.id)
+            rebuilt.rebuild()
+            assert rebuilt.count == stats["count"]
+            assert rebuilt.mean == pytest.approx(stats["mean"])
+            assert rebuilt.m2 == pytest.approx(stats["stdev"] ** 2 * stats["count"])
+
+    def test_backfill(self, app):
+        """
+        Tests that late measurements for an archived day are read alongside
+        it and merged into its file on the next run.
+        """
+
+        client = app.test_client()
+        runner = app.test_cli_runner()
+        runner.invoke(args=["archive", "--days", "1"])
+        with app.app_context():
+            sensor = Sensor.query.first()
+            old_path = ArchiveSegment.query.order_by(ArchiveSegment.day).first().path
+            ingest_measurements(sensor, [{"value": 42.0, "time": "2024-05-01T23:05:00Z"}])
+
+        lines = client.get("/api/sensors/archived/measurements/export").data.splitlines()
+        assert json.loads(lines[1]) == {"time": "2024-05-01T23:05:00", "value": 42.0}
+
+        runner.invoke(args=["archive", "--days", "1"])
+        with app.app_context():
+            segment = ArchiveSegment.query.order_by(ArchiveSegment.day).first()
+            assert segment.count == 5
+            assert segment.maximum == 42.0
+            assert segment.path != old_path
+            assert not os.path.exists(os.path.join(app.config["ARCHIVE_DIR"], old_path))
+            assert Measurement.query.count() == 1
+        assert client.get("/api/sensors/archived/measurements/export").data.splitlines() == lines
@@ -0,0 +1,179 @@
+import datetime
+import fcntl
+import glob
+import json
+import os
+import pytest
+
+from sqlalchemy import func, select
+
+from sensorhub import db
+from sensorhub.buffer import IngestBuffer, get_buffer
+from sensorhub.models import ApiKey, Measurement, Rollup, Sensor, Stats
+
+SENSOR_KEY = "buffer-sensor-key"
+RESOURCE_URL = "/api/sensors/buffered/measurements/"
+HEADERS = {"Sensorhub-Api-Key": SENSOR_KEY}
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app({
+        "INGEST_BUFFER": True,
+        "INGEST_BUFFER_SIZE": 100,
+        # flushes only when full or asked to
+        "INGEST_BUFFER_AGE": 3600,
+    })
+    with app.app_context():
+        sensor = Sensor(name="buffered", model="testsensor")
+        db.session.add(sensor)
+        db.session.add(ApiKey(key=ApiKey.key_hash(SENSOR_KEY), sensor=sensor))
+        db.session.commit()
+    return app
+
+def _batch(start, count):
+    return [
+        {"value": float(i), "time": "2025-01-01T00:{:02}:{:02}Z".format(i // 60, i % 60)}
+        for i in range(start, start + count)
+    ]
+
+def _count(app):
+    with app.app_context():
+        return db.session.scalar(select(func.count(Measurement.id)))
+
+def test_enqueue_and_flush(app):
+    """
+    Posted batches are acknowledged with 202 once journaled, are written
+    with their stats and rollups on flush, and the journal is removed.
+    """
+
+    client = app.test_client()
+    for start in (0, 10, 20):
+        resp = client.post(RESOURCE_URL, json=_batch(start, 10), headers=HEADERS)
+        assert resp.status_code == 202
+        assert json.loads(resp.data) == {"count": 10}
+        assert resp.headers["Location"].endswith(RESOURCE_URL)
+
+    directory = app.config["INGEST_BUFFER_DIR"]
+    journals = glob.glob(os.path.join(directory, "journal-*.ndjson"))
+    assert len(journals) == 1
+    with open(journals[0]) as f:
+        assert len(f.readlines()) == 3
+    assert _count(app) == 0
+
+    with app.app_context():
+        assert get_buffer().flush() == 30
+        stats = db.session.scalars(select(Stats)).one()
+        assert stats.count == 30
+        assert stats.mean == pytest.approx(14.5)
+        rollups = db.session.scalars(select(Rollup).filter_by(resolution=60)).all()
+        assert sum(rollup.count for rollup in rollups) == 30
+    assert _count(app) == 30
+    assert glob.glob(os.path.join(directory, "journal-*.ndjson")) == []
+
+def test_size_flush(app):
+    """
+    The background thread flushes once INGEST_BUFFER_SIZE rows are pending.
+    """
+
+    client = app.test_client()
+    resp = client.post(RESOURCE_URL, json=_batch(0, 100), headers=HEADERS)
+    assert resp.status_code == 202
+    with app.app_context():
+        buffer = get_buffer()
+    # the flush holds its lock while writing, wait for it to finish
+    for _ in range(100):
+        with buffer._flush_lock:
+            if _count(app) == 100:
+                break
+        buffer._wakeup.wait(0.05)
+    assert _count(app) == 100
+
+def test_close(app):
+    """
+    Closing the buffer writes out what is pending.
+    """
+
+    client = app.test_client()
+    client.post(RESOURCE_URL, json=_batch(0, 5), headers=HEADERS)
+    app.extensions["ingest_buffer"].close()
+    assert _count(app) == 5
+    with pytest.raises(RuntimeError):
+        app.extensions["ingest_buffer"].append(1, [])
+
+def test_replay(app):
+    """
+    Journals that no buffer holds a lock on are replayed, ignoring a torn
+    last line, and locked ones are left alone whatever their pid.
+    """
+
+    directory = app.config["INGEST_BUFFER_DIR"]
+    # named after this process, as a restarted worker could reuse the pid
+    with open(os.path.join(directory, f"journal-{os.getpid()}-0000.ndjson"), "w") as f:
+        f.write(json.dumps({
+            "sensor": 1, "rows": [[1.5, "2025-01-01T00:00:00"], [2.5, "2025-01-01T00:00:01"]]
+        }) + "\n")
+        f.write('{"sensor": 1, "rows": [[3.5, "2025-')
+    live = os.path.join(directory, "journal-1-0000.ndjson")
+    with open(live, "w") as held:
+        held.write(json.dumps({"sensor": 1, "rows": [[9.0, "2025-01-01T00:00:00"]]}) + "\n")
+        held.flush()
+        fcntl.flock(held, fcntl.LOCK_EX)
+
+        buffer = IngestBuffer(app, directory, 100, 3600)
+        try:
+            assert buffer.flush() == 2
+        finally:
+            buffer.close()
+    with app.app_context():
+        values = db.session.scalars(select(Measurement.value).order_by(Measurement.time)).all()
+    assert values == [1.5, 2.5]
+    assert glob.glob(os.path.join(directory, "journal-*.ndjson")) == [live]
+
+def test_post_commit_failure(app, monkeypatch):
+    """
+    A failure after the rows are committed is logged and does not put the
+    batches back, so they are not written twice.
+    """
+
+    def fail(*args, **kwargs):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr("sensorhub.ingest.invalidate_pages", fail)
+    client = app.test_client()
+    client.post(RESOURCE_URL, json=_batch(0, 10), headers=HEADERS)
+    with app.app_context():
+        buffer = get_buffer()
+        assert buffer.flush() == 10
+        assert buffer.flush() == 0
+    assert _count(app) == 10
+    assert glob.glob(os.path.join(app.config["INGEST_BUFFER_DIR"], "journal-*.ndjson")) == []
+
+def test_poison_batch(app):
+    """
+    A batch that fails on its own is set aside after INGEST_BUFFER_MAX_ATTEMPTS
+    flushes and the batches around it are written.
+    """
+
+    directory = app.config["INGEST_BUFFER_DIR"]
+    client = app.test_client()
+    client.post(RESOURCE_URL, json=_batch(0, 5), headers=HEADERS)
+    with app.app_context():
+        buffer = get_buffer()
+        # NaN is stored as NULL, which the value column doesn't allow
+        buffer.append(1, [{
+            "sensor_id": 1, "value": float("nan"), "time": datetime.datetime(2025, 1, 1)
+        }])
+    client.post(RESOURCE_URL, json=_batch(5, 5), headers=HEADERS)
+
+    with app.app_context():
+        for attempt in range(app.config["INGEST_BUFFER_MAX_ATTEMPTS"]):
+            with pytest.raises(Exception):
+                buffer.flush()
+        assert buffer.flush() == 10
+    assert _count(app) == 10
+    rejected = glob.glob(os.path.join(directory, "rejected-*.ndjson"))
+    assert len(rejected) == 1
+    with open(rejected[0]) as f:
+        assert len(f.readlines()) == 1
+    assert glob.glob(os.path.join(directory, "journal-*.ndjson")) == []
@@ -0,0 +1,126 @@
+import glob
+import multiprocessing
+import os
+import pytest
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+from sensorhub.caching import LRUCache, SharedMemoryCache
+
+
+@pytest.fixture(params=["lru", "shared"])
+def backend(request):
+    if request.param == "lru":
+        yield LRUCache(threshold=10)
+        return
+    db_fd, db_fname = tempfile.mkstemp()
+    yield SharedMemoryCache(db_fname, threshold=10)
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def _add_in_child(path, queue):
+    queue.put(SharedMemoryCache(path).add("marker", os.getpid(), timeout=60))
+
+
+class TestBackends(object):
+    """
+    Tests the behaviour both cache backends share with Flask-Caching's
+    built-in ones.
+    """
+
+    def test_get_set(self, backend):
+        assert backend.get("missing") is None
+        backend.set("page", ("etag", b"data"))
+        assert backend.get("page") == ("etag", b"data")
+        assert backend.get_many("missing", "page") == [None, ("etag", b"data")]
+        assert backend.has("page")
+        assert backend.delete("page")
+        assert backend.get("page") is None
+
+    def test_add(self, backend):
+        assert backend.add("marker", 1, timeout=60)
+        assert not backend.add("marker", 2, timeout=60)
+        assert backend.get("marker") == 1
+
+    def test_add_threads(self, backend):
+        # one winner per key, however the threads interleave
+        barrier = threading.Barrier(8)
+        results = []
+        def add(key):
+            barrier.wait()
+            results.append(backend.add(key, threading.get_ident(), timeout=60))
+
+        for i in range(20):
+            threads = [
+                threading.Thread(target=add, args=(f"marker-{i}",)) for j in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert results.count(True) == 20
+
+    def test_expiry(self, backend):
+        backend.set("short", 1, timeout=1)
+        backend.set("forever", 1, timeout=0)
+        time.sleep(1.1)
+        assert backend.get("short") is None
+        assert backend.get("forever") == 1
+        assert backend.add("short", 2)
+
+    def test_threshold(self, backend):
+        for i in range(200):
+            backend.set(f"key-{i}", i)
+        assert backend.get("key-199") == 199
+        assert backend.get("key-0") is None
+
+
+class TestSharedMemoryCache(object):
+
+    def test_shared(self):
+        """
+        Checks that entries are visible to other processes and that only one
+        process wins add().
+        """
+
+        db_fd, db_fname = tempfile.mkstemp()
+        try:
+            cache = SharedMemoryCache(db_fname)
+            ctx = multiprocessing.get_context("spawn")
+            queue = ctx.Queue()
+            procs = [ctx.Process(target=_add_in_child, args=(db_fname, queue)) for i in range(4)]
+            for proc in procs:
+                proc.start()
+            results = [queue.get(timeout=30) for proc in procs]
+            for proc in procs:
+                proc.join()
+            assert results.count(True) == 1
+            assert cache.get("marker") in [proc.pid for proc in procs]
+        finally:
+            os.close(db_fd)
+            os.unlink(db_fname)
+
+    def test_default_path(self):
+        """
+        Checks that instances with different databases or instance folders
+        don't share the default cache file.
+        """
+
+        paths = set()
+        with tempfile.TemporaryDirectory() as workdir:
+            for instance, uri in [
+                ("a", "sqlite:///a.db"),
+                ("a", "postgresql://db/b"),
+                ("b", "sqlite:///a.db"),
+            ]:
+                # used for the cache file only when there is no /dev/shm
+                app = SimpleNamespace(instance_path=workdir + "/" + instance)
+                os.makedirs(app.instance_path, exist_ok=True)
+                config = {"SQLALCHEMY_DATABASE_URI": uri, "CACHE_THRESHOLD": 10}
+                cache = SharedMemoryCache.factory(app, config, (), {})
+                paths.add(cache._path)
+                for path in glob.glob(cache._path + "*"):
+                    os.unlink(path)
+        assert len(paths) == 3
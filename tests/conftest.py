@@ -0,0 +1,38 @@
+import pytest
+
+from sensorhub import create_app, db
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """
+    Returns a function that creates an app with *config* over the test
+    defaults: a temporary SQLite database and archive, ingest buffer and
+    live socket directories under tmp_path. The tables are created unless
+    *create_tables* is False. Ingest buffers and live hubs started by the
+    apps are closed when the test is done.
+    """
+
+    apps = []
+
+    def make(config=None, create_tables=True):
+        app = create_app(dict({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + str(tmp_path / "test.db"),
+            "CACHE_TYPE": "NullCache",
+            "ARCHIVE_DIR": str(tmp_path / "archive"),
+            "INGEST_BUFFER_DIR": str(tmp_path / "ingest-buffer"),
+            "LIVE_SOCKET_DIR": str(tmp_path / "live"),
+            "TESTING": True
+        }, **(config or {})))
+        if create_tables:
+            with app.app_context():
+                db.create_all()
+        apps.append(app)
+        return app
+
+    yield make
+    for app in apps:
+        for name in ("ingest_buffer", "live_hub"):
+            extension = app.extensions.get(name)
+            if extension is not None:
+                extension.close()
@@ -0,0 +1,60 @@
+import pytest
+
+from sensorhub import db
+from sensorhub.models import Deployment, Location, Measurement, Rollup, Sensor, Stats
+
+
+@pytest.fixture
+def app(make_app):
+    return make_app({"CACHE_TYPE": "SimpleCache"})
+
+
+def test_testgen(app):
+    """
+    Runs testgen with small batches and checks that the stats and rollups
+    it computes on the fly match the measurements it wrote.
+    """
+
+    runner = app.test_cli_runner()
+    result = runner.invoke(args=[
+        "testgen", "--sensors", "3", "--locations", "2", "--deployments", "2",
+        "--measurements", "2500", "--span", "2d", "--batch-size", "1000", "--seed", "1"
+    ])
+    assert result.exit_code == 0, result.output
+    assert "Wrote 7500 measurements" in result.output
+
+    with app.app_context():
+        assert Location.query.count() == 2
+        assert Deployment.query.count() == 2
+        sensors = Sensor.query.order_by(Sensor.id).all()
+        assert [sensor.name for sensor in sensors] == [
+            "test-sensor-1", "test-sensor-2", "test-sensor-3"
+        ]
+        assert sensors[2].location is None
+        assert all(len(sensor.deployments) == 1 for sensor in sensors)
+
+        for sensor in sensors:
+            values = db.session.scalars(
+                db.select(Measurement.value).filter_by(sensor_id=sensor.id)
+            ).all()
+            assert len(values) == 2500
+            stats = sensor.stats
+            assert stats.count == 2500
+            assert stats.mean == pytest.approx(sum(values) / len(values))
+            assert stats.maximum == max(values)
+            expected = Stats(sensor_id=sensor.id)
+            expected.rebuild()
+            assert stats.m2 == pytest.approx(expected.m2)
+            assert stats.last == expected.last
+            for resolution in (60, 3600, 86400):
+                count, total = db.session.execute(
+                    db.select(db.func.sum(Rollup.count), db.func.sum(Rollup.total)).filter_by(
+                        sensor_id=sensor.id, resolution=resolution
+                    )
+                ).one()
+                assert count == 2500
+                assert total == pytest.approx(sum(values))
+
+    result = runner.invoke(args=["testgen"])
+    assert result.exit_code != 0
+    assert "already exist" in result.output
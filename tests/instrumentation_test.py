@@ -0,0 +1,97 @@
+import re
+import pytest
+
+from sensorhub import create_app, db
+from sensorhub.instrumentation import current_metrics, serializing
+from sensorhub.models import ApiKey, Location, Sensor
+from sensorhub.utils import auth_cache
+
+ADMIN_KEY = "instrumentationkey"
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app({"CACHE_TYPE": "SimpleCache", "INSTRUMENTATION": True})
+    auth_cache.clear()
+    with app.app_context():
+        for i in range(3):
+            db.session.add(Sensor(
+                name=f"sensor-{i}",
+                model="testsensor",
+                location=Location(name=f"location-{i}")
+            ))
+        db.session.add(ApiKey(key=ApiKey.key_hash(ADMIN_KEY), admin=True))
+        db.session.commit()
+    return app
+
+def _timings(response):
+    timings = {}
+    for part in re.findall(r'[^,"]+(?:"[^"]*")?', response.headers["Server-Timing"]):
+        name, *params = part.strip().split(";")
+        timings[name] = dict(param.split("=", 1) for param in params)
+    return timings
+
+
+class TestInstrumentation(object):
+
+    def test_server_timing(self, app):
+        """
+        Checks that queries and cache lookups show up in the Server-Timing
+        header.
+        """
+
+        client = app.test_client()
+        resp = client.get("/api/sensors/sensor-1/")
+        assert resp.status_code == 200
+        timings = _timings(resp)
+        assert timings["db"]["desc"] == '"1 queries"'
+        assert float(timings["serialize"]["dur"]) >= 0
+
+        resp = client.get("/api/sensors/", headers={"Sensorhub-Api-Key": ADMIN_KEY})
+        resp.close()
+        assert _timings(resp)["cache-auth"]["desc"] == '"0 hit, 1 miss"'
+
+        client.get("/api/sensors/sensor-1/measurements/")
+        resp = client.get("/api/sensors/sensor-1/measurements/")
+        timings = _timings(resp)
+        assert timings["cache-shared"]["desc"] == '"2 hit, 0 miss"'
+
+    def test_lazy_queries(self, app):
+        with app.test_request_context("/api/sensors/"):
+            sensor = Sensor.query.first()
+            with serializing():
+                sensor.serialize()
+            metrics = current_metrics()
+            assert metrics.queries == 2
+            assert metrics.lazy_queries == 1
+
+    def test_metrics(self, app):
+        client = app.test_client()
+        resp = client.get("/api/sensors/", headers={"Sensorhub-Api-Key": ADMIN_KEY})
+        assert len(resp.json["items"]) == 3
+        resp.close()
+        client.get("/api/sensors/").close()
+        resp = client.get("/api/metrics")
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        text = resp.get_data(as_text=True)
+        assert 'sensorhub_requests_total{route="/api/sensors/",method="GET",status="200"} 1' in text
+        assert 'sensorhub_requests_total{route="/api/sensors/",method="GET",status="403"} 1' in text
+        # the streamed listing is counted, both requests look up the key
+        assert 'sensorhub_db_queries_total{route="/api/sensors/",method="GET"} 3' in text
+        assert (
+            'sensorhub_request_duration_seconds_count{route="/api/sensors/",method="GET"} 2'
+            in text
+        )
+
+    def test_disabled(self, app):
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": app.config["SQLALCHEMY_DATABASE_URI"],
+            "CACHE_TYPE": "SimpleCache",
+            "TESTING": True
+        })
+        client = app.test_client()
+        assert client.get("/api/metrics").status_code == 404
+        resp = client.get("/api/sensors/", headers={"Sensorhub-Api-Key": ADMIN_KEY})
+        assert "Server-Timing" not in resp.headers
+        resp.close()
@@ -0,0 +1,193 @@
+import json
+import os
+import pytest
+import socket
+from datetime import datetime
+from sqlalchemy import event
+
+from sensorhub import db
+from sensorhub.ingest import ingest_measurements
+from sensorhub.live import LiveHub
+from sensorhub.models import ApiKey, Sensor
+from sensorhub.utils import encode_cursor
+
+SENSOR_KEY = "live-sensor-key"
+RESOURCE_URL = "/api/sensors/live-sensor/measurements/live"
+POST_URL = "/api/sensors/live-sensor/measurements/"
+
+
+@pytest.fixture
+def app(make_app):
+    app = make_app()
+    with app.app_context():
+        sensor = Sensor(name="live-sensor", model="testsensor")
+        db.session.add(sensor)
+        db.session.add(ApiKey(key=ApiKey.key_hash(SENSOR_KEY), sensor=sensor))
+        db.session.commit()
+    return app
+
+def _events(chunk):
+    # parses the SSE events of one chunk, skipping comments and retry
+    events = []
+    for block in chunk.decode().strip().split("\n\n"):
+        fields = dict(
+            line.split(": ", 1) for line in block.split("\n") if not line.startswith(":")
+        )
+        if "data" in fields:
+            events.append((fields["id"], json.loads(fields["data"])))
+    return events
+
+def _post(client, values, start=0):
+    batch = [
+        {"value": value, "time": "2025-01-01T00:00:{:02}Z".format(start + i)}
+        for i, value in enumerate(values)
+    ]
+    resp = client.post(POST_URL, json=batch, headers={"Sensorhub-Api-Key": SENSOR_KEY})
+    assert resp.status_code == 201
+
+def test_fan_out(app, monkeypatch):
+    """
+    Every open stream gets each ingested batch as one event, with keepalive
+    comments in between. The batch is still written with one insert.
+    """
+
+    monkeypatch.setattr("sensorhub.resources.measurement.LIVE_KEEPALIVE", 0.01)
+    client = app.test_client()
+    streams = []
+    for i in range(3):
+        resp = client.get(RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/event-stream"
+        stream = iter(resp.response)
+        assert next(stream).startswith(b"retry: ")
+        streams.append((resp, stream))
+
+    inserts = []
+    def count(conn, cursor, statement, *args):
+        if statement.startswith("INSERT INTO measurement"):
+            inserts.append(statement)
+
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            _post(client, [1.0, 2.0])
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+    # still one executemany insert for the batch
+    assert len(inserts) == 1
+    last_event = encode_cursor(datetime(2025, 1, 1, 0, 0, 1), 2)
+    for resp, stream in streams:
+        assert _events(next(stream)) == [(last_event, [
+            {"value": 1.0, "time": "2025-01-01T00:00:00"},
+            {"value": 2.0, "time": "2025-01-01T00:00:01"},
+        ])]
+        assert next(stream) == b": keepalive\n\n"
+        resp.close()
+    assert app.extensions["live_hub"]._subscribers == {}
+
+def test_last_event_id(app, monkeypatch):
+    """
+    A reconnecting stream first gets the measurements after its last event,
+    oldest first, and batches it has already seen through the backfill are
+    skipped. Late batches, older than the last event, are not.
+    """
+
+    client = app.test_client()
+    _post(client, [1.0, 2.0, 3.0])
+    last_event = encode_cursor(datetime(2025, 1, 1), 1)
+    resp = client.get(RESOURCE_URL, headers={"Last-Event-ID": last_event})
+    stream = iter(resp.response)
+    next(stream)
+    assert _events(next(stream)) == [(encode_cursor(datetime(2025, 1, 1, 0, 0, 2), 3), [
+        {"value": 2.0, "time": "2025-01-01T00:00:01"},
+        {"value": 3.0, "time": "2025-01-01T00:00:02"},
+    ])]
+
+    with app.app_context():
+        hub = app.extensions["live_hub"]
+        # a batch the backfill already covered, then a new one and a late one
+        hub.dispatch(1, (datetime(2025, 1, 1, 0, 0, 2), 3), "old\n\n")
+        _post(client, [4.0], start=3)
+        _post(client, [0.5], start=0)
+    assert _events(next(stream))[0][0] == encode_cursor(datetime(2025, 1, 1, 0, 0, 3), 4)
+    assert _events(next(stream))[0][0] == encode_cursor(datetime(2025, 1, 1), 5)
+    resp.close()
+
+    # more than the limit: the oldest rows, then the stream ends
+    monkeypatch.setattr("sensorhub.resources.measurement.LIVE_BACKFILL_LIMIT", 2)
+    resp = client.get(RESOURCE_URL, headers={"Last-Event-ID": last_event})
+    stream = iter(resp.response)
+    next(stream)
+    assert _events(next(stream)) == [(encode_cursor(datetime(2025, 1, 1, 0, 0, 1), 2), [
+        {"value": 0.5, "time": "2025-01-01T00:00:00"},
+        {"value": 2.0, "time": "2025-01-01T00:00:01"},
+    ])]
+    with pytest.raises(StopIteration):
+        next(stream)
+    resp.close()
+
+    assert client.get(RESOURCE_URL, headers={"Last-Event-ID": "x"}).status_code == 400
+    assert app.extensions["live_hub"]._subscribers == {}
+
+def test_overflow(app, monkeypatch):
+    """
+    A stream that falls too far behind is ended so that it reconnects,
+    without getting the events that were still queued.
+    """
+
+    monkeypatch.setattr("sensorhub.live.LIVE_QUEUE_SIZE", 2)
+    client = app.test_client()
+    resp = client.get(RESOURCE_URL)
+    stream = iter(resp.response)
+    next(stream)
+    for i in range(3):
+        _post(client, [float(i)], start=i)
+    with pytest.raises(StopIteration):
+        next(stream)
+    resp.close()
+
+def test_workers(app):
+    """
+    Batches written in one worker reach subscribers in another through the
+    shared socket directory, and sockets left by dead workers are removed.
+    """
+
+    directory = app.config["LIVE_SOCKET_DIR"]
+    other = LiveHub(directory, name="other-worker")
+    subscription = other.subscribe(1)
+    # bound by a worker that exited without cleaning up
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(os.path.join(directory, "dead-worker.sock"))
+    stale.close()
+
+    with app.app_context():
+        sensor = db.session.get(Sensor, 1)
+        ingest_measurements(sensor, [{"value": 5.0, "time": "2025-01-01T00:00:00Z"}])
+    event = subscription.get(5)
+    assert event[0] == (datetime(2025, 1, 1), 1)
+    assert _events(event[1].encode()) == [
+        (encode_cursor(datetime(2025, 1, 1), 1), [{"value": 5.0, "time": "2025-01-01T00:00:00"}])
+    ]
+    assert sorted(os.listdir(directory)) == ["other-worker.sock"]
+    other.close()
+
+def test_max_streams(app):
+    """
+    A worker with LIVE_MAX_STREAMS streams open answers 503 with
+    Retry-After, and takes new streams again once one is closed.
+    """
+
+    app.config["LIVE_MAX_STREAMS"] = 2
+    client = app.test_client()
+    streams = [client.get(RESOURCE_URL) for i in range(2)]
+    assert [resp.status_code for resp in streams] == [200, 200]
+    resp = client.get(RESOURCE_URL)
+    assert resp.status_code == 503
+    assert int(resp.headers["Retry-After"]) > 0
+
+    streams[0].close()
+    resp = client.get(RESOURCE_URL)
+    assert resp.status_code == 200
+    resp.close()
+    streams[1].close()
+    assert app.extensions["live_hub"]._streams == 0
@@ -0,0 +1,79 @@
+import pytest
+from sqlalchemy import inspect, text
+
+from sensorhub import db
+from sensorhub.migrations import HEAD, current_version
+
+
+@pytest.fixture
+def app(make_app):
+    # the tests build the schema they start from themselves
+    return make_app({"CACHE_TYPE": "SimpleCache"}, create_tables=False)
+
+def _create_old_schema():
+    # the schema as created by init-db before any migrations existed
+    db.create_all()
+    with db.engine.begin() as conn:
+        for table in ("rollup", "stats_task", "archive_segment", "schema_version"):
+            conn.execute(text(f"DROP TABLE {table}"))
+        for index in ("ix_measurement_sensor_time_id", "ix_deployments_sensor_id",
+                      "ix_api_key_sensor_id"):
+            conn.execute(text(f"DROP INDEX {index}"))
+        for column in ("count", "m2", "minimum", "maximum", "last"):
+            conn.execute(text(f'ALTER TABLE stats DROP COLUMN "{column}"'))
+
+
+class TestMigrations(object):
+
+    def test_upgrade(self, app):
+        """
+        Tests upgrading an old database. Checks that status reports pending
+        migrations, that upgrade brings the schema in line with the models,
+        that it can be run again safely and that ingest works afterwards.
+        """
+
+        runner = app.test_cli_runner()
+        with app.app_context():
+            _create_old_schema()
+
+        result = runner.invoke(args=["migrate", "status"])
+        assert "[ ] 1:" in result.output
+
+        result = runner.invoke(args=["migrate", "upgrade", "--target", "2"])
+        assert result.exit_code == 0
+        assert "Applying 2" in result.output
+        result = runner.invoke(args=["migrate", "upgrade"])
+        assert "Applying 1" not in result.output
+        assert "Applying 5" in result.output
+        result = runner.invoke(args=["migrate", "upgrade"])
+        assert result.output == ""
+
+        with app.app_context():
+            inspector = inspect(db.engine)
+            assert "ix_measurement_sensor_time_id" in {
+                index["name"] for index in inspector.get_indexes("measurement")
+            }
+            assert "m2" in {column["name"] for column in inspector.get_columns("stats")}
+            assert inspector.has_table("rollup")
+            with db.engine.connect() as conn:
+                assert current_version(conn) == HEAD
+
+            from sensorhub.ingest import ingest_measurements
+            from sensorhub.models import Sensor, Stats
+            sensor = Sensor(name="migrated", model="testsensor")
+            db.session.add(sensor)
+            db.session.commit()
+            ingest_measurements(sensor, [{"value": 1.0}, {"value": 3.0}])
+            assert Stats.query.first().count == 2
+
+    def test_init_db(self, app):
+        """
+        Tests that a freshly created database counts as fully migrated.
+        """
+
+        runner = app.test_cli_runner()
+        runner.invoke(args=["init-db"])
+        result = runner.invoke(args=["migrate", "upgrade"])
+        assert result.output == ""
+        result = runner.invoke(args=["migrate", "status"])
+        assert "[ ]" not in result.output
@@ -0,0 +1,73 @@
+import os
+import pytest
+import tempfile
+from datetime import datetime
+
+from sensorhub import create_app, db
+from sensorhub.ingest import first_expired, ingest_measurements
+from sensorhub.models import Measurement, Sensor, utcnow
+from sensorhub.partitions import add_months, month_start, partition_name, retention_cutoff
+
+
+def test_month_arithmetic():
+    assert month_start(datetime(2025, 3, 31, 23, 59)) == datetime(2025, 3, 1)
+    assert add_months(datetime(2025, 11, 1), 2) == datetime(2026, 1, 1)
+    assert add_months(datetime(2025, 1, 1), -13) == datetime(2023, 12, 1)
+    assert partition_name(datetime(2025, 2, 1)) == "measurement_p202502"
+
+def test_sqlite():
+    """
+    Checks that partitioning settings leave SQLite deployments on the single
+    table and that the commands refuse to run there.
+    """
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "CACHE_TYPE": "SimpleCache",
+        "MEASUREMENT_PARTITIONING": True,
+        "TESTING": True
+    })
+    try:
+        with app.app_context():
+            db.create_all()
+            sensor = Sensor(name="plain", model="testsensor")
+            db.session.add(sensor)
+            db.session.commit()
+            ingest_measurements(sensor, [{"value": 1.0, "time": "2025-01-01T00:00:00Z"}])
+            assert Measurement.query.count() == 1
+
+        runner = app.test_cli_runner()
+        for command in ("setup", "create", "prune"):
+            result = runner.invoke(args=["partitions", command])
+            assert result.exit_code != 0
+            assert "only available on Postgres" in result.output or "retention" in result.output
+    finally:
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+def test_retention_cutoff():
+    """
+    Checks that measurements older than MEASUREMENT_RETENTION_MONTHS are
+    found before they are written, and that nothing is without a retention.
+    """
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite://",
+        "CACHE_TYPE": "SimpleCache",
+        "MEASUREMENT_RETENTION_MONTHS": 2,
+        "TESTING": True
+    })
+    now = utcnow()
+    items = [
+        {"value": 1.0},
+        {"value": 2.0, "time": f"{now:%Y-%m}-01T00:00:00Z"},
+        {"value": 3.0, "time": f"{add_months(month_start(now), -3):%Y-%m-%d}T00:00:00Z"},
+    ]
+    with app.app_context():
+        assert retention_cutoff() == add_months(month_start(now), -2)
+        assert first_expired(items) == 2
+        assert first_expired(items[:2]) is None
+        app.config["MEASUREMENT_RETENTION_MONTHS"] = None
+        assert retention_cutoff() is None
+        assert first_expired(items) is None
@@ -1,5 +1,7 @@
 import json
 import os
+import pika
+import statistics
 import pytest
 import tempfile
 import time
@@ -11,24 +13,146 @@ from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError, StatementError
 from werkzeug.datastructures import Headers
 
-from sensorhub import create_app, db
-from sensorhub.models import Location, Sensor, Deployment, Measurement, ApiKey
+from sensorhub import cache, create_app, db
+from sensorhub.models import Location, Sensor, Deployment, Measurement, ApiKey, Stats, StatsTask
+from sensorhub.utils import RabbitPublisher, auth_cache
+from sensorhub.consumer import run_consumer
+from sensorhub.ingest import ingest_measurements
+from sensorhub.worker import _run_task, claim_db_tasks, run_worker, settle_queue_tasks
 
 TEST_KEY = "verysafetestkey"
+SENSOR_KEY = "verysafesensorkey"
 
 # https://stackoverflow.com/questions/16416001/set-http-headers-for-all-requests-in-a-flask-test
 class AuthHeaderClient(FlaskClient):
 
     def open(self, *args, **kwargs):
-        api_key_headers = Headers({
-            'sensorhub-api-key': TEST_KEY
-        })
-        headers = kwargs.pop('headers', Headers())
-        headers.extend(api_key_headers)
+        headers = Headers(kwargs.pop('headers', None))
+        headers.setdefault('sensorhub-api-key', TEST_KEY)
         kwargs['headers'] = headers
         return super().open(*args, **kwargs)
     
 
+class FakeChannel(object):
+    """
+    Stand-in for a pika BlockingChannel that stores published messages in
+    its FakeBroker.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.is_closed = False
+
+    def confirm_delivery(self):
+        pass
+
+    def queue_declare(self, queue, **kwargs):
+        self.broker.declares += 1
+        self.broker.queues.setdefault(queue, [])
+
+    def basic_publish(self, exchange, routing_key, body, **kwargs):
+        if self.connection.lost:
+            raise pika.exceptions.StreamLostError("connection lost")
+        self.broker.queues[routing_key].append(body)
+
+    def basic_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    def consume(self, queue, inactivity_timeout=None, **kwargs):
+        # yields queued messages, then an inactivity marker once the queue
+        # is empty, like BlockingChannel.consume
+        self.queue = queue
+        self.unacked = []
+        tag = 0
+        while True:
+            queue_list = self.broker.queues.setdefault(queue, [])
+            if queue_list:
+                tag += 1
+                body = queue_list.pop(0)
+                self.unacked.append((tag, body))
+                yield FakeMethod(tag, body in self.broker.redelivered), None, body
+            else:
+                yield None, None, None
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        acked = [
+            d for d in self.unacked
+            if d[0] == delivery_tag or (multiple and d[0] < delivery_tag)
+        ]
+        self.broker.acked.extend(body for tag, body in acked)
+        self.unacked = [d for d in self.unacked if d not in acked]
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.basic_nack(delivery_tag, requeue=requeue)
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        nacked = [
+            d for d in self.unacked
+            if d[0] == delivery_tag or (multiple and d[0] < delivery_tag)
+        ]
+        self.unacked = [d for d in self.unacked if d not in nacked]
+        if requeue:
+            self.broker.queues[self.queue].extend(body for tag, body in nacked)
+            self.broker.redelivered.update(body for tag, body in nacked)
+        else:
+            self.broker.rejected.extend(body for tag, body in nacked)
+
+    def cancel(self):
+        # unacked messages go back to the queue
+        for tag, body in self.unacked:
+            self.broker.queues.setdefault(self.queue, []).append(body)
+            self.broker.redelivered.add(body)
+        return 0
+
+
+class FakeMethod(object):
+
+    def __init__(self, delivery_tag, redelivered=False):
+        self.delivery_tag = delivery_tag
+        self.redelivered = redelivered
+
+
+class FakeConnection(object):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.is_closed = False
+        self.lost = False
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def close(self):
+        self.is_closed = True
+
+
+class FakeBroker(object):
+    """
+    Minimal in-process stand-in for RabbitMQ. Use connect() in place of
+    get_rabbit_connection().
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.connections = []
+        self.declares = 0
+        self.acked = []
+        self.rejected = []
+        # bodies that have been requeued at least once
+        self.redelivered = set()
+
+    def connect(self):
+        connection = FakeConnection(self)
+        self.connections.append(connection)
+        return connection
+
+    def drop(self):
+        # simulates a connection lost without the client noticing
+        for connection in self.connections:
+            connection.lost = True
+
+
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor = dbapi_connection.cursor()
@@ -42,10 +166,12 @@ def client():
     db_fd, db_fname = tempfile.mkstemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "CACHE_TYPE": "SimpleCache",
         "TESTING": True
     }
     
     app = create_app(config)
+    auth_cache.clear()
     
     with app.app_context():
         db.create_all()
@@ -64,6 +190,8 @@ def _populate_db():
             model="testsensor"
         )
         db.session.add(s)
+        if i == 2:
+            db.session.add(ApiKey(key=ApiKey.key_hash(SENSOR_KEY), sensor=s))
         
     db_key = ApiKey(
         key=ApiKey.key_hash(TEST_KEY),
@@ -103,6 +231,85 @@ class TestSensorCollection(object):
             assert "name" in item
             assert "model" in item
 
+    def test_get_paged(self, client, monkeypatch):
+        """
+        Tests walking the sensor collection one page at a time. Checks that
+        every sensor is listed once in name order with its location, and
+        that the listing takes a constant number of queries per page.
+        """
+
+        monkeypatch.setattr("sensorhub.resources.sensor.SENSOR_PAGE_SIZE", 2)
+        with client.application.app_context():
+            for i in range(4):
+                db.session.add(Sensor(
+                    name=f"located-sensor-{i}",
+                    model="testsensor",
+                    location=Location(name=f"location-{i}")
+                ))
+            db.session.commit()
+            engine = db.engine
+
+        queries = []
+        listener = lambda *args: queries.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            names = []
+            url = self.RESOURCE_URL
+            while url:
+                resp = client.get(url)
+                assert resp.status_code == 200
+                body = json.loads(resp.data)
+                assert len(body["items"]) <= 2
+                for item in body["items"]:
+                    names.append(item["name"])
+                    if item["name"].startswith("located"):
+                        assert item["location"] == {"name": "location-" + item["name"][-1]}
+                    else:
+                        assert item["location"] is None
+                url = body["next"]
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        assert names == sorted(
+            [f"located-sensor-{i}" for i in range(4)]
+            + [f"test-sensor-{i}" for i in range(1, 4)]
+        )
+        # four pages, one key lookup and then one query each
+        assert len(queries) == 5
+
+    def test_get_auth(self, client):
+        """
+        Tests admin key handling. Checks that every admin key is accepted,
+        that sensor keys and unknown keys are refused, and that a revoked key
+        stops working immediately even after it has been cached, also in
+        other processes that still remember it.
+        """
+
+        other_key = "anotheradminkey"
+        with client.application.app_context():
+            db.session.add(ApiKey(key=ApiKey.key_hash(other_key), admin=True))
+            db.session.commit()
+
+        for key in (TEST_KEY, other_key, other_key):
+            resp = client.get(self.RESOURCE_URL, headers={"Sensorhub-Api-Key": key})
+            assert resp.status_code == 200
+            # the listing is streamed
+            resp.close()
+        for key in (SENSOR_KEY, "notakey", ""):
+            resp = client.get(self.RESOURCE_URL, headers={"Sensorhub-Api-Key": key})
+            assert resp.status_code == 403
+
+        # as remembered by a worker other than the one revoking it
+        remembered = auth_cache.get(ApiKey.key_hash(other_key))
+        runner = client.application.test_cli_runner()
+        result = runner.invoke(args=["revokekey", other_key])
+        assert result.exit_code == 0
+        auth_cache.set(ApiKey.key_hash(other_key), remembered)
+        resp = client.get(self.RESOURCE_URL, headers={"Sensorhub-Api-Key": other_key})
+        assert resp.status_code == 403
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        resp.close()
+
     def test_post(self, client):
         """
         Tests the POST method. Checks all of the possible error codes, and
@@ -158,6 +365,35 @@ class TestSensorItem(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_one_query(self, client):
+        """
+        Tests sensor resolution. Checks that a GET costs a single query with
+        the location loaded alongside the sensor, and that a rename done
+        outside the API is noticed.
+        """
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        with client.application.app_context():
+            event.listen(db.engine, "before_cursor_execute", count)
+            try:
+                resp = client.get(self.RESOURCE_URL)
+            finally:
+                event.remove(db.engine, "before_cursor_execute", count)
+        assert resp.status_code == 200
+        assert len(statements) == 1
+
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="test-sensor-1").first()
+            sensor.name = "extra-sensor-1"
+            db.session.commit()
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 404
+        resp = client.get(self.MODIFIED_URL)
+        assert resp.status_code == 200
+
     def test_put(self, client):
         """
         Tests the PUT method. Checks all of the possible erroe codes, and also
@@ -211,3 +447,821 @@ class TestSensorItem(object):
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_delete_ingested(self, client):
+        """
+        Tests that a sensor that has had measurements, and so has a stats
+        row, can be deleted along with its stats.
+        """
+
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="test-sensor-1").first()
+            ingest_measurements(sensor, [{"value": 1.0, "time": "2025-01-01T00:00:00Z"}])
+            sensor_id = sensor.id
+        resp = client.delete(self.RESOURCE_URL)
+        assert resp.status_code == 204
+        with client.application.app_context():
+            assert Stats.query.filter_by(sensor_id=sensor_id).count() == 0
+
+
+
+class TestMeasurementCollection(object):
+
+    RESOURCE_URL = "/api/sensors/test-sensor-2/measurements/"
+    INVALID_URL = "/api/sensors/non-sensor-x/measurements/"
+    SENSOR_HEADERS = {"Sensorhub-Api-Key": SENSOR_KEY}
+
+    def _post_batch(self, client, count=120):
+        batch = [
+            {"value": float(i), "time": "2025-01-01T{:02}:{:02}:00Z".format(i // 60, i % 60)}
+            for i in range(count)
+        ]
+        resp = client.post(self.RESOURCE_URL, json=batch, headers=self.SENSOR_HEADERS)
+        assert resp.status_code == 201
+        return batch
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Walks the whole collection forwards through the
+        next links and back through the prev links, checking that every
+        measurement is seen exactly once and in time order. Also checks that
+        a garbled cursor results in 400 and an unknown sensor in 404.
+        """
+
+        batch = self._post_batch(client)
+
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+        resp = client.get(self.RESOURCE_URL + "?after=not-a-cursor")
+        assert resp.status_code == 400
+
+        values = []
+        url = self.RESOURCE_URL
+        pages = []
+        while url:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            assert body["sensor"] == "test-sensor-2"
+            assert len(body["measurements"]) <= 50
+            values.extend(m["value"] for m in body["measurements"])
+            pages.append(body)
+            url = body["next"]
+        assert values == [item["value"] for item in batch]
+        assert len(pages) == 3
+        assert pages[0]["prev"] is None
+
+        values = []
+        url = pages[-1]["prev"]
+        while url:
+            body = json.loads(client.get(url).data)
+            values = [m["value"] for m in body["measurements"]] + values
+            url = body["prev"]
+        assert values == [item["value"] for item in batch[:100]]
+
+    def test_post(self, client):
+        """
+        Tests the POST method with JSON array, single object and NDJSON
+        bodies. Checks that the whole batch is rejected if any item is
+        invalid, that other sensors' keys are refused and that written rows
+        end up in the database.
+        """
+
+        batch = [
+            {"value": 10.0 + i, "time": "2025-01-01T00:00:{:02}Z".format(i)}
+            for i in range(20)
+        ]
+
+        # test with wrong content type
+        resp = client.post(self.RESOURCE_URL, data="x", headers=self.SENSOR_HEADERS)
+        assert resp.status_code == 415
+
+        # test without the sensor's own key
+        resp = client.post(self.RESOURCE_URL, json=batch)
+        assert resp.status_code == 403
+
+        resp = client.post(self.INVALID_URL, json=batch, headers=self.SENSOR_HEADERS)
+        assert resp.status_code == 404
+
+        # one invalid item rejects the whole batch
+        invalid = batch + [{"value": "high"}]
+        resp = client.post(self.RESOURCE_URL, json=invalid, headers=self.SENSOR_HEADERS)
+        assert resp.status_code == 400
+        assert "Item 20" in json.loads(resp.data)["message"]
+
+        # parsed as floats, but can't be stored or folded into the stats
+        for value in ("NaN", "Infinity", "-Infinity"):
+            resp = client.post(
+                self.RESOURCE_URL,
+                data=f'[{{"value": 1.0}}, {{"value": {value}}}]',
+                content_type="application/json",
+                headers=self.SENSOR_HEADERS
+            )
+            assert resp.status_code == 400
+            assert "Item 1" in json.loads(resp.data)["message"]
+
+        resp = client.post(self.RESOURCE_URL, json=batch, headers=self.SENSOR_HEADERS)
+        assert resp.status_code == 201
+        assert resp.headers["Location"].endswith(self.RESOURCE_URL)
+        assert json.loads(resp.data)["count"] == 20
+
+        resp = client.post(self.RESOURCE_URL, json={"value": 1.5}, headers=self.SENSOR_HEADERS)
+        assert resp.status_code == 201
+
+        ndjson = "\n".join(json.dumps(item) for item in batch[:5]) + "\n"
+        resp = client.post(
+            self.RESOURCE_URL,
+            data=ndjson,
+            content_type="application/x-ndjson",
+            headers=self.SENSOR_HEADERS
+        )
+        assert resp.status_code == 201
+        assert json.loads(resp.data)["count"] == 5
+
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="test-sensor-2").first()
+            assert Measurement.query.filter_by(sensor=sensor).count() == 26
+
+    def test_get_cached(self, client):
+        """
+        Tests the page cache. Checks conditional requests, that complete pages
+        survive ingest of newer measurements while the tail page is
+        refreshed, and that ingesting older measurements refreshes all pages.
+        Values are changed behind the API's back to tell cached pages apart.
+        """
+
+        self._post_batch(client)
+        first = client.get(self.RESOURCE_URL)
+        etag = first.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        tail_url = json.loads(client.get(json.loads(first.data)["next"]).data)["next"]
+        tail = json.loads(client.get(tail_url).data)
+        assert len(tail["measurements"]) == 20
+
+        with client.application.app_context():
+            db.session.execute(db.update(Measurement).values(value=-1.0))
+            db.session.commit()
+        assert client.get(self.RESOURCE_URL).data == first.data
+        assert json.loads(client.get(tail_url).data) == tail
+
+        resp = client.post(
+            self.RESOURCE_URL,
+            json={"value": 1000.0, "time": "2025-01-02T00:00:00Z"},
+            headers=self.SENSOR_HEADERS
+        )
+        assert resp.status_code == 201
+        assert client.get(self.RESOURCE_URL).data == first.data
+        tail = json.loads(client.get(tail_url).data)
+        assert len(tail["measurements"]) == 21
+        assert tail["measurements"][0]["value"] == -1.0
+        assert tail["measurements"][-1]["value"] == 1000.0
+
+        resp = client.post(
+            self.RESOURCE_URL,
+            json={"value": 1000.0, "time": "2024-12-31T00:00:00Z"},
+            headers=self.SENSOR_HEADERS
+        )
+        assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["measurements"][1]["value"] == -1.0
+
+    def test_get_resolution(self, client):
+        """
+        Tests the downsampled GET mode. Checks that rollups are kept current
+        across batches that land in the same bucket, that rollup pages link
+        onwards with the resolution preserved and that unknown resolutions
+        result in 400.
+        """
+
+        batch = self._post_batch(client)
+        resp = client.post(
+            self.RESOURCE_URL,
+            json=[{"value": 500.0, "time": "2025-01-01T00:00:30Z"}],
+            headers=self.SENSOR_HEADERS
+        )
+        assert resp.status_code == 201
+
+        resp = client.get(self.RESOURCE_URL + "?resolution=1w")
+        assert resp.status_code == 400
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?resolution=1h").data)
+        assert body["resolution"] == "1h"
+        assert body["next"] is None
+        hours = body["measurements"]
+        assert [h["time"] for h in hours] == ["2025-01-01T00:00:00", "2025-01-01T01:00:00"]
+        assert hours[0]["count"] == 61
+        assert hours[0]["max"] == 500.0
+        assert hours[0]["mean"] == pytest.approx((sum(range(60)) + 500.0) / 61)
+        assert hours[1] == {
+            "time": "2025-01-01T01:00:00", "count": 60, "mean": 89.5, "min": 60.0, "max": 119.0
+        }
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?resolution=1m").data)
+        assert len(body["measurements"]) == 50
+        assert body["measurements"][0]["count"] == 2
+        assert "resolution=1m" in body["next"]
+        body = json.loads(client.get(body["next"]).data)
+        assert body["measurements"][0]["time"] == "2025-01-01T00:50:00"
+
+    def test_get_range(self, client):
+        """
+        Tests the from/to filters in raw and downsampled modes, and that the
+        links of a filtered page keep the filter.
+        """
+
+        self._post_batch(client)
+        resp = client.get(self.RESOURCE_URL + "?from=yesterday")
+        assert resp.status_code == 400
+
+        url = self.RESOURCE_URL + "?from=2025-01-01T00:30:00Z&to=2025-01-01T01:40:00%2B00:00"
+        values = []
+        while url:
+            body = json.loads(client.get(url).data)
+            values.extend(m["value"] for m in body["measurements"])
+            url = body["next"]
+        assert values == [float(i) for i in range(30, 100)]
+
+        body = json.loads(client.get(
+            self.RESOURCE_URL + "?resolution=1h&from=2025-01-01T01:00:00"
+        ).data)
+        assert [h["time"] for h in body["measurements"]] == ["2025-01-01T01:00:00"]
+
+    def test_get_aggregate(self, client, monkeypatch):
+        """
+        Tests aggregate queries. Checks the bucketed results against values
+        computed here, that buckets built from rollups and from raw rows
+        agree, that aggregate pages link onwards and that invalid arguments
+        result in 400.
+        """
+
+        self._post_batch(client)
+        for query in ("?agg=mean", "?bucket=5m", "?agg=median&bucket=5m",
+                      "?agg=mean&bucket=5x", "?agg=mean&bucket=1h&resolution=1h"):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?agg=mean,max,count&bucket=30m").data)
+        assert body["agg"] == ["mean", "max", "count"]
+        assert body["measurements"] == [
+            {"time": "2025-01-01T00:00:00", "mean": 14.5, "max": 29.0, "count": 30},
+            {"time": "2025-01-01T00:30:00", "mean": 44.5, "max": 59.0, "count": 30},
+            {"time": "2025-01-01T01:00:00", "mean": 74.5, "max": 89.0, "count": 30},
+            {"time": "2025-01-01T01:30:00", "mean": 104.5, "max": 119.0, "count": 30},
+        ]
+
+        # 90 second buckets can't be built from rollups
+        body = json.loads(client.get(self.RESOURCE_URL + "?agg=min,sum&bucket=90s").data)
+        assert len(body["measurements"]) == 80
+        assert body["measurements"][1] == {"time": "2025-01-01T00:01:30", "min": 2.0, "sum": 2.0}
+
+        # unaligned start forces raw rows, aligned one uses rollups
+        raw = json.loads(client.get(
+            self.RESOURCE_URL + "?agg=mean,min,max,count,sum&bucket=10m&from=2025-01-01T00:00:01"
+        ).data)
+        rolled = json.loads(client.get(
+            self.RESOURCE_URL + "?agg=mean,min,max,count,sum&bucket=10m&from=2025-01-01T00:10:00"
+        ).data)
+        assert raw["measurements"][1:] == rolled["measurements"]
+
+        monkeypatch.setattr("sensorhub.resources.measurement.AGGREGATE_PAGE_SIZE", 5)
+        times = []
+        url = self.RESOURCE_URL + "?agg=count&bucket=10m"
+        while url:
+            body = json.loads(client.get(url).data)
+            assert all(m["count"] == 10 for m in body["measurements"])
+            times.extend(m["time"] for m in body["measurements"])
+            url = body["next"]
+        assert len(times) == 12
+        assert times == sorted(times)
+
+    def test_consumer(self, client):
+        """
+        Tests ingestion from the measurements queue. Messages are written in
+        batches of the prefetch size and acked after the commit, and
+        malformed messages or ones for unknown sensors are rejected without
+        stopping the rest.
+        """
+
+        broker = FakeBroker()
+        queue = broker.queues["measurements"] = []
+        for i in range(10):
+            queue.append(json.dumps({
+                "sensor": "test-sensor-2",
+                "measurements": [
+                    {"value": float(i * 3 + j), "time": "2025-01-01T00:{:02}:{:02}Z".format(i, j)}
+                    for j in range(3)
+                ]
+            }))
+        queue.append(json.dumps({"sensor": "test-sensor-3", "value": 7.0}))
+        queue.append(json.dumps({"sensor": "non-sensor-x", "value": 1.0}))
+        queue.append(json.dumps({"sensor": "test-sensor-3", "value": "high"}))
+        queue.append(json.dumps({"sensor": "test-sensor-3", "value": float("nan")}))
+        queue.append("not json")
+
+        channel = broker.connect().channel()
+        with client.application.app_context():
+            assert run_consumer(prefetch=4, once=True, channel=channel) == 31
+        assert channel.prefetch_count == 4
+        assert broker.queues["measurements"] == []
+        assert len(broker.acked) == 11
+        assert len(broker.rejected) == 4
+
+        body = json.loads(client.get(self.RESOURCE_URL + "?agg=count,max&bucket=1h").data)
+        assert body["measurements"] == [{"time": "2025-01-01T00:00:00", "count": 30, "max": 29.0}]
+        body = json.loads(client.get("/api/sensors/test-sensor-2/stats/").data)
+        assert body["count"] == 30
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="test-sensor-3").first()
+            assert Measurement.query.filter_by(sensor=sensor).count() == 1
+
+    def test_consumer_failures(self, client, monkeypatch):
+        """
+        Tests that a batch is acked once committed even if invalidating the
+        cache fails afterwards, and that a message that can't be written is
+        requeued once, then moved to the failed queue while the rest of its
+        batch is written.
+        """
+
+        def fail(*args, **kwargs):
+            raise RuntimeError("database is locked")
+
+        broker = FakeBroker()
+        queue = broker.queues["measurements"] = []
+        queue.append(json.dumps({"sensor": "test-sensor-3", "value": 1.0}))
+        channel = broker.connect().channel()
+        with client.application.app_context():
+            with monkeypatch.context() as patch:
+                patch.setattr("sensorhub.ingest.invalidate_pages", fail)
+                assert run_consumer(prefetch=2, once=True, channel=channel) == 1
+        assert len(broker.acked) == 1
+        assert broker.queues["measurements"] == []
+
+        # NaN passes validation but is stored as NULL, which isn't allowed
+        poison = '{"sensor": "test-sensor-3", "value": NaN}'
+        queue.extend([json.dumps({"sensor": "test-sensor-3", "value": 2.0}), poison])
+        with client.application.app_context():
+            with pytest.raises(Exception):
+                run_consumer(prefetch=2, once=True, channel=channel)
+            assert len(queue) == 2
+            assert run_consumer(prefetch=2, once=True, channel=channel) == 1
+            sensor = Sensor.query.filter_by(name="test-sensor-3").first()
+            assert Measurement.query.filter_by(sensor=sensor).count() == 2
+        assert broker.queues["measurements.failed"] == [poison]
+        assert len(broker.acked) == 3
+
+
+class TestMeasurementExport(object):
+
+    RESOURCE_URL = "/api/sensors/test-sensor-2/measurements/export"
+    COLLECTION_URL = "/api/sensors/test-sensor-2/measurements/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method in both formats. Checks that the full history is
+        streamed in time order, that the Accept header picks the format when
+        no format parameter is given and that unknown formats get 406.
+        """
+
+        batch = [
+            {"value": i / 4, "time": "2025-01-01T00:{:02}:{:02}Z".format(i // 60, i % 60)}
+            for i in range(300)
+        ]
+        resp = client.post(
+            self.COLLECTION_URL,
+            json=batch,
+            headers={"Sensorhub-Api-Key": SENSOR_KEY}
+        )
+        assert resp.status_code == 201
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        rows = [json.loads(line) for line in resp.data.decode().splitlines()]
+        assert [row["value"] for row in rows] == [item["value"] for item in batch]
+        assert rows[0]["time"] == "2025-01-01T00:00:00"
+
+        resp = client.get(self.RESOURCE_URL, headers={"Accept": "text/csv"})
+        assert resp.mimetype == "text/csv"
+        lines = resp.data.decode().splitlines()
+        assert lines[0] == "time,value"
+        assert len(lines) == 301
+        assert lines[2] == "2025-01-01T00:00:01,0.25"
+
+        resp = client.get(self.RESOURCE_URL + "?format=xml")
+        assert resp.status_code == 406
+
+
+class TestSensorStats(object):
+
+    RESOURCE_URL = "/api/sensors/test-sensor-2/stats/"
+    COLLECTION_URL = "/api/sensors/test-sensor-2/measurements/"
+
+    def _post(self, client, values):
+        resp = client.post(
+            self.COLLECTION_URL,
+            json=[
+                {"value": value, "time": "2025-01-01T00:00:{:02}Z".format(i)}
+                for i, value in enumerate(values)
+            ],
+            headers={"Sensorhub-Api-Key": SENSOR_KEY}
+        )
+        assert resp.status_code == 201
+
+    def test_get(self, client):
+        """
+        Tests that ingesting measurements keeps the running stats current so
+        that GET answers directly, and that the incremental aggregates match
+        the ones computed over the full data set.
+        """
+
+        first = [1.5, 2.5, 10.0, -4.0]
+        second = [3.0, 7.25, 0.5]
+        self._post(client, first)
+        self._post(client, second)
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        values = first + second
+        assert body["count"] == len(values)
+        assert body["mean"] == pytest.approx(statistics.fmean(values))
+        assert body["stdev"] == pytest.approx(statistics.pstdev(values))
+        assert body["min"] == -4.0
+        assert body["max"] == 10.0
+        assert body["last"] == "2025-01-01T00:00:03"
+
+    def _add_legacy_measurements(self, client, values):
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="test-sensor-2").first()
+            for value in values:
+                db.session.add(Measurement(sensor=sensor, value=value, time=datetime.now()))
+            db.session.commit()
+
+    def test_get_missing(self, client, monkeypatch):
+        """
+        Tests GET for a sensor whose history predates running stats. Checks
+        that concurrent misses dispatch a single task and get 202 pointing
+        back at the stats, that delivering or deleting the stats allows a new
+        task, and that the publisher reuses its connection until it is lost.
+        """
+
+        broker = FakeBroker()
+        monkeypatch.setattr("sensorhub.utils.get_rabbit_connection", broker.connect)
+        self._add_legacy_measurements(client, range(5))
+
+        for i in range(3):
+            resp = client.get(self.RESOURCE_URL)
+            assert resp.status_code == 202
+            assert resp.headers["Location"].endswith(self.RESOURCE_URL)
+            assert int(resp.headers["Retry-After"]) > 0
+        assert len(broker.queues["stats"]) == 1
+        task = json.loads(broker.queues["stats"][0])
+        assert task == {"data": [0.0, 1.0, 2.0, 3.0, 4.0], "sensor": "test-sensor-2"}
+
+        resp = client.put(
+            self.RESOURCE_URL,
+            json={"generated": "2025-01-01T00:00:00", "mean": 2.0}
+        )
+        assert resp.status_code == 204
+        resp = client.delete(self.RESOURCE_URL)
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 202
+        assert len(broker.queues["stats"]) == 2
+        assert len(broker.connections) == 1
+        assert broker.declares == 1
+
+        broker.drop()
+        with client.application.app_context():
+            cache.clear()
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 202
+        assert len(broker.connections) == 2
+        assert len(broker.queues["stats"]) == 3
+
+    def test_publisher_retry(self, monkeypatch):
+        """
+        Tests that a publish losing its connection part way closes it and
+        sends only the bodies the broker didn't get on a new one.
+        """
+
+        class FlakyChannel(FakeChannel):
+            def basic_publish(self, exchange, routing_key, body, **kwargs):
+                super().basic_publish(exchange, routing_key, body, **kwargs)
+                if len(self.broker.queues[routing_key]) == 2:
+                    self.connection.lost = True
+
+        monkeypatch.setattr(FakeConnection, "channel", lambda self: FlakyChannel(self))
+        broker = FakeBroker()
+        publisher = RabbitPublisher(broker.connect)
+        publisher.publish_many("stats", ["a", "b", "c", "d"])
+        assert broker.queues["stats"] == ["a", "b", "c", "d"]
+        assert len(broker.connections) == 2
+        assert broker.connections[0].is_closed
+        publisher.close()
+        assert broker.connections[1].is_closed
+
+    def test_worker_db(self, client):
+        """
+        Tests the built-in stats worker with the database task table. A stats
+        miss queues one task row, and the worker computes the stats and
+        writes them directly.
+        """
+
+        client.application.config["STATS_TASK_BACKEND"] = "db"
+        values = [float(i) for i in range(1000)]
+        self._add_legacy_measurements(client, values)
+
+        assert client.get(self.RESOURCE_URL).status_code == 202
+        with client.application.app_context():
+            cache.clear()
+        assert client.get(self.RESOURCE_URL).status_code == 202
+        with client.application.app_context():
+            assert StatsTask.query.count() == 1
+            run_worker("db", 1, once=True)
+            assert StatsTask.query.count() == 0
+
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["count"] == 1000
+        assert body["mean"] == pytest.approx(statistics.fmean(values))
+        assert body["stdev"] == pytest.approx(statistics.pstdev(values))
+        assert body["max"] == 999.0
+
+    def test_worker_db_failure(self, client, monkeypatch):
+        """
+        Tests that a claimed task is kept until its stats are written, and
+        is claimed again once its lease expires if computing them failed.
+        """
+
+        def fail(*args):
+            raise RuntimeError("stats failed")
+
+        client.application.config["STATS_TASK_BACKEND"] = "db"
+        self._add_legacy_measurements(client, [1.0, 3.0])
+        assert client.get(self.RESOURCE_URL).status_code == 202
+        with client.application.app_context():
+            tasks = claim_db_tasks(10)
+            assert len(tasks) == 1
+            assert claim_db_tasks(10) == []
+            with monkeypatch.context() as patch:
+                patch.setattr("sensorhub.worker.compute_stats", fail)
+                assert _run_task(tasks[0]) is None
+            assert StatsTask.query.count() == 1
+
+            task = StatsTask.query.one()
+            task.claimed_until = datetime(2000, 1, 1)
+            db.session.commit()
+            tasks = claim_db_tasks(10)
+            assert _run_task(tasks[0]) == tasks[0][0]
+            assert StatsTask.query.count() == 0
+
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["count"] == 2
+
+    def test_worker_queue(self, client, monkeypatch):
+        """
+        Tests the built-in stats worker reading the stats queue. Messages
+        only name the sensor when STATS_TASK_DATA is off, and are acked after
+        the stats have been written. Tasks for unknown sensors are acked.
+        """
+
+        broker = FakeBroker()
+        monkeypatch.setattr("sensorhub.utils.get_rabbit_connection", broker.connect)
+        client.application.config["STATS_TASK_DATA"] = False
+        self._add_legacy_measurements(client, [2.0, 4.0, 9.0])
+
+        assert client.get(self.RESOURCE_URL).status_code == 202
+        assert broker.queues["stats"] == [json.dumps({"sensor": "test-sensor-2"})]
+        broker.queues["stats"].extend([
+            "not json",
+            json.dumps({"name": "test-sensor-2"}),
+            json.dumps({"sensor": "non-sensor-x"}),
+        ])
+        with client.application.app_context():
+            run_worker("queue", 1, once=True, channel=broker.connect().channel())
+        assert broker.queues["stats"] == []
+        assert len(broker.acked) == 2
+        assert len(broker.rejected) == 2
+
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["count"] == 3
+        assert body["mean"] == 5.0
+
+    def test_worker_queue_failure(self, client):
+        """
+        Tests settling stats tasks from the queue. Computed ones are acked,
+        a failed one is requeued the first time and moved to the failed
+        queue once it fails again after redelivery.
+        """
+
+        broker = FakeBroker()
+        broker.queues["stats"] = []
+        broker.queues["stats.failed"] = []
+        channel = broker.connect().channel()
+        channel.queue = "stats"
+        channel.unacked = [(1, "a"), (2, "b"), (3, "c")]
+        tasks = {
+            1: [(FakeMethod(1), "a")],
+            2: [(FakeMethod(2), "b")],
+            3: [(FakeMethod(3, redelivered=True), "c")],
+        }
+        with client.application.app_context():
+            settle_queue_tasks(channel, tasks, [1, None, None])
+        assert broker.acked == ["a", "c"]
+        assert broker.queues["stats"] == ["b"]
+        assert broker.queues["stats.failed"] == ["c"]
+
+    def test_put(self, client):
+        """
+        Tests the PUT method used by external workers. Stats delivered this
+        way only carry the mean, and are rebuilt from the full history on the
+        next ingest.
+        """
+
+        resp = client.put(self.RESOURCE_URL, json={"mean": 1.0})
+        assert resp.status_code == 400
+
+        resp = client.put(
+            self.RESOURCE_URL,
+            json={"generated": "2025-01-01T00:00:00", "mean": 1.0}
+        )
+        assert resp.status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body == {"generated": "2025-01-01T00:00:00", "mean": 1.0}
+
+        self._post(client, [2.0, 4.0])
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["count"] == 2
+        assert body["mean"] == 3.0
+
+    def test_put_after_ingest(self, client):
+        """
+        Tests that a PUT replaces the stats row made by the first ingest in
+        place, and that the next ingest rebuilds the aggregates.
+        """
+
+        self._post(client, [2.0, 4.0])
+        resp = client.put(
+            self.RESOURCE_URL,
+            json={"generated": "2025-01-01T00:00:00", "mean": 1.0}
+        )
+        assert resp.status_code == 204
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body == {"generated": "2025-01-01T00:00:00", "mean": 1.0}
+        with client.application.app_context():
+            assert Stats.query.count() == 1
+
+        self._post(client, [6.0])
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["count"] == 3
+        assert body["mean"] == 4.0
+
+    def test_rebuild_precision(self, client):
+        """
+        Tests that stats seeded from the history keep their precision for
+        values far from zero.
+        """
+
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="test-sensor-2").first()
+            ingest_measurements(sensor, [
+                {
+                    "value": 1e8 + i * 0.001,
+                    "time": "2025-01-01T00:{:02}:{:02}Z".format(i // 60, i % 60)
+                }
+                for i in range(1000)
+            ])
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["count"] == 1000
+        assert body["stdev"] == pytest.approx(0.2887, abs=1e-3)
+
+    def test_lock(self, client):
+        """
+        Tests that Stats.lock creates the row only when there is none, so
+        that a first batch racing another one merges into the row it made
+        instead of failing on the unique sensor_id.
+        """
+
+        with client.application.app_context():
+            sensor = Sensor.query.filter_by(name="test-sensor-2").first()
+            stats = Stats.lock(sensor.id)
+            assert stats.count is None
+            db.session.commit()
+            assert Stats.lock(sensor.id).id == stats.id
+            db.session.commit()
+            assert Stats.query.filter_by(sensor_id=sensor.id).count() == 1
+
+        self._post(client, [2.0, 4.0])
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        assert body["count"] == 2
+        assert body["mean"] == 3.0
+
+
+class TestBatchRead(object):
+
+    RESOURCE_URL = "/api/batch/"
+
+    def _populate(self, client):
+        with client.application.app_context():
+            for number in (1, 2):
+                sensor = Sensor.query.filter_by(name=f"test-sensor-{number}").first()
+                ingest_measurements(sensor, [
+                    {
+                        "value": float(i * number),
+                        "time": "2025-01-01T{:02}:{:02}:00Z".format(i // 60, i % 60)
+                    }
+                    for i in range(120)
+                ])
+
+    def test_get(self, client):
+        """
+        Tests reading latest values and stats of several sensors at once,
+        with and without a time window. Unknown names are listed as missing
+        and sensors without measurements have nulls.
+        """
+
+        self._populate(client)
+        resp = client.get(
+            self.RESOURCE_URL + "?sensors=test-sensor-1,test-sensor-2,test-sensor-3,nope"
+        )
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["missing"] == ["nope"]
+        assert set(body["sensors"]) == {"test-sensor-1", "test-sensor-2", "test-sensor-3"}
+        assert body["sensors"]["test-sensor-2"]["latest"] == {
+            "time": "2025-01-01T01:59:00", "value": 238.0
+        }
+        stats = json.loads(client.get("/api/sensors/test-sensor-2/stats/").data)
+        assert body["sensors"]["test-sensor-2"]["stats"] == stats
+        assert body["sensors"]["test-sensor-3"] == {"latest": None, "stats": None}
+        assert "series" not in body["sensors"]["test-sensor-1"]
+
+        body = json.loads(client.get(
+            self.RESOURCE_URL + "?sensors=test-sensor-1&from=2025-01-01T00:00:00&to=2025-01-01T00:30:00"
+        ).data)
+        assert body["sensors"]["test-sensor-1"]["latest"] == {
+            "time": "2025-01-01T00:29:00", "value": 29.0
+        }
+
+        for query in ("", "?sensors=", "?sensors=test-sensor-1&bucket=1h",
+                      "?sensors=test-sensor-1&bucket=1s&from=2025-01-01T00:00:00",
+                      "?sensors=test-sensor-1&bucket=1h&from=2025-01-01T00:00:00&agg=median"):
+            assert client.get(self.RESOURCE_URL + query).status_code == 400
+
+    def test_post_invalid(self, client):
+        """
+        Tests that POST bodies with fields of the wrong type are refused with
+        400 before any of them is used.
+        """
+
+        resp = client.post(self.RESOURCE_URL, data="x", content_type="text/plain")
+        assert resp.status_code == 415
+        for doc in ([], {}, {"sensors": "test-sensor-1"},
+                    {"sensors": ["test-sensor-1", 2]},
+                    {"sensors": ["test-sensor-1"], "from": 5},
+                    {"sensors": ["test-sensor-1"], "to": ["2025-01-01"]},
+                    {"sensors": ["test-sensor-1"], "bucket": 60},
+                    {"sensors": ["test-sensor-1"], "agg": {"mean": True}},
+                    {"sensors": ["test-sensor-1"], "agg": ["mean", 1]}):
+            assert client.post(self.RESOURCE_URL, json=doc).status_code == 400
+
+    def test_series(self, client):
+        """
+        Tests downsampled series, both from rollups and from raw rows. Each
+        matches what the sensor's own aggregate query returns, and the whole
+        document takes a fixed number of queries however many sensors are
+        read.
+        """
+
+        self._populate(client)
+        window = "&from=2025-01-01T00:00:00&to=2025-01-01T02:00:00"
+        queries = []
+        with client.application.app_context():
+            listener = lambda *args: queries.append(args[2])
+            event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            for bucket in ("1h", "90s"):
+                del queries[:]
+                resp = client.post(self.RESOURCE_URL, json={
+                    "sensors": ["test-sensor-1", "test-sensor-2", "test-sensor-3"],
+                    "from": "2025-01-01T00:00:00",
+                    "to": "2025-01-01T02:00:00",
+                    "bucket": bucket,
+                    "agg": ["mean", "max", "count"],
+                })
+                body = json.loads(resp.data)
+                assert len(queries) == 3
+                for number in (1, 2):
+                    single = json.loads(client.get(
+                        f"/api/sensors/test-sensor-{number}/measurements/"
+                        f"?agg=mean,max,count&bucket={bucket}" + window
+                    ).data)
+                    series = body["sensors"][f"test-sensor-{number}"]["series"]
+                    assert series == single["measurements"]
+                assert body["sensors"]["test-sensor-3"]["series"] == []
+        finally:
+            with client.application.app_context():
+                event.remove(db.engine, "before_cursor_execute", listener)
@@ -0,0 +1,87 @@
+import datetime
+import json
+import pytest
+
+from sensorhub.models import Location, Sensor, Stats
+from sensorhub.serialization import dumps, orjson, stdlib_dumps
+
+DOC = {
+    "sensor": "sensor-1",
+    "measurements": [
+        {"value": 1.5, "time": datetime.datetime(2024, 1, 1)},
+        {"value": -0.25, "time": datetime.datetime(2024, 1, 1, 12, 30, 5, 120000)},
+    ],
+    "next": None,
+}
+
+
+class TestEncoders(object):
+    """
+    Tests that both encoders format documents, and the timestamps in them,
+    like isoformat() would.
+    """
+
+    @pytest.mark.parametrize("encode", [
+        stdlib_dumps,
+        pytest.param(
+            orjson and orjson.dumps,
+            marks=pytest.mark.skipif(orjson is None, reason="orjson not installed")
+        ),
+    ])
+    def test_encode(self, encode):
+        data = encode(DOC)
+        assert isinstance(data, bytes)
+        assert json.loads(data) == {
+            "sensor": "sensor-1",
+            "measurements": [
+                {"value": 1.5, "time": "2024-01-01T00:00:00"},
+                {"value": -0.25, "time": "2024-01-01T12:30:05.120000"},
+            ],
+            "next": None,
+        }
+
+    def test_same_output(self):
+        assert dumps(DOC) == stdlib_dumps(DOC)
+
+    def test_unsupported(self):
+        with pytest.raises(TypeError):
+            stdlib_dumps({"value": object()})
+
+
+class TestRows(object):
+    """
+    Tests that documents built from selected columns match those of
+    hydrated models.
+    """
+
+    def test_location(self):
+        location = Location(
+            name="lab", latitude=65.0, longitude=25.5, altitude=None, description="room"
+        )
+        for short_form in (False, True):
+            row = tuple(
+                getattr(location, column.key)
+                for column in Location.row_columns(short_form=short_form)
+            )
+            assert Location.serialize_row(row, short_form=short_form) == \
+                location.serialize(short_form=short_form)
+
+    def test_sensor(self):
+        sensor = Sensor(name="sensor-1", model="uo-test-sensor")
+        assert Sensor.serialize_row(("sensor-1", "uo-test-sensor", None)) == \
+            sensor.serialize()
+
+    def test_stats(self):
+        generated = datetime.datetime(2024, 1, 1)
+        stats = Stats(
+            generated=generated, mean=2.0, count=4, m2=4.0,
+            minimum=0.0, maximum=4.0, last=generated
+        )
+        row = tuple(getattr(stats, column.key) for column in Stats.row_columns())
+        doc = Stats.serialize_row(row)
+        assert doc == stats.serialize()
+        assert doc["stdev"] == 1.0
+        assert json.loads(dumps(doc))["generated"] == "2024-01-01T00:00:00"
+
+        stats = Stats(generated=generated, mean=2.0)
+        assert stats.serialize() == {"generated": generated, "mean": 2.0}